@@ -44,6 +44,10 @@ def get_config_path():
     path = os.path.join(home_path, ".ays-agent")
     return path
 
+def get_state_path() -> str:
+    """ Returns the path to the agent's state file, which lives next to the config file. """
+    return f"{get_config_path()}.state"
+
 def write_yaml(fh, obj):
     dump(obj, fh)
 
@@ -77,7 +81,27 @@ class CLIOptions(object):
         status_state: Optional[str] = None,
         monitor_resources: Optional[List[str]] = None,
         monitor_file: Optional[str] = None,
-        monitor_program: Optional[str] = None
+        monitor_program: Optional[str] = None,
+        cgroups: Optional[str] = None,
+        psi_triggers: Optional[str] = None,
+        monitor_timeout: Optional[int] = None,
+        disk_mounts: Optional[str] = None,
+        history: Optional[str] = None,
+        min_interval: Optional[int] = None,
+        anomaly_detection: Optional[str] = None,
+        log_files: Optional[str] = None,
+        log_patterns: Optional[List[str]] = None,
+        probe_endpoints: Optional[str] = None,
+        sock_ports: Optional[str] = None,
+        statsd_listen: Optional[str] = None,
+        quantiles: Optional[str] = None,
+        max_rss: Optional[float] = None,
+        max_cpu: Optional[float] = None,
+        send_rate: Optional[float] = None,
+        shards: Optional[int] = None,
+        directories: Optional[str] = None,
+        otlp_endpoint: Optional[str] = None,
+        export_dir: Optional[str] = None
     ):
         self.org_secret = org_secret
         self.server = server
@@ -101,6 +125,26 @@ class CLIOptions(object):
         self.monitor_resources = monitor_resources
         self.monitor_file = monitor_file
         self.monitor_program = monitor_program
+        self.cgroups = cgroups
+        self.psi_triggers = psi_triggers
+        self.monitor_timeout = monitor_timeout
+        self.disk_mounts = disk_mounts
+        self.history = history
+        self.min_interval = min_interval
+        self.anomaly_detection = anomaly_detection
+        self.log_files = log_files
+        self.log_patterns = log_patterns
+        self.probe_endpoints = probe_endpoints
+        self.sock_ports = sock_ports
+        self.statsd_listen = statsd_listen
+        self.quantiles = quantiles
+        self.max_rss = max_rss
+        self.max_cpu = max_cpu
+        self.send_rate = send_rate
+        self.shards = shards
+        self.directories = directories
+        self.otlp_endpoint = otlp_endpoint
+        self.export_dir = export_dir
 
         # Options provided to the app from the CLI
         self.cli_options = None
@@ -134,12 +178,12 @@ def get_empty_options() -> CLIOptions:
         monitor_name=""
     )
 
-def load_options() -> CLIOptions:
+def load_options(path: Optional[str] = None) -> CLIOptions:
     """ Load ays agent server options from config file.
 
     Returns an options, if config file not found.
     """
-    path = get_config_path()
+    path = path or get_config_path()
     if os.path.isfile(path):
         with open(path, "r") as fh:
             opts = read_yaml(fh)
@@ -201,6 +245,16 @@ def get_agent_payload(options) -> None:
         params["status"] = get_status(options.status_message, options.status_state)
     return options.server, params
 
+def get_node_path(msg: dict) -> Optional[str]:
+    """ Returns the path of the node an `AgentPayload` reports to. """
+    parent = msg.get("parent", {}).get("value")
+    if not parent:
+        return None
+    relationship = msg.get("relationship", {})
+    if relationship.get("type") == "child":
+        return f"{parent}.{relationship['path']}"
+    return parent
+
 # Private API
 
 def get_heartbeat_level(level: str) -> str:
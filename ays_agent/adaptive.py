@@ -0,0 +1,92 @@
+#
+# Adaptive sampling interval.
+#
+# Values that sit far from their thresholds are sampled at the (slow) interval.
+# As a value approaches, or trends toward, a breach the interval shrinks to as
+# little as the minimum interval. Once the value moves away from the breach,
+# the interval backs off gradually, so that a value hovering near its
+# threshold doesn't cause the interval to oscillate.
+#
+
+from typing import List
+from typing_extensions import Optional
+
+# Fraction of a threshold's magnitude (or range) within which a value is
+# considered near its threshold. At, or beyond, this distance the value is
+# sampled at the slow interval.
+NEAR_THRESHOLD = 0.25
+
+# Factor the interval may grow by, per sample, when backing off
+BACKOFF_FACTOR = 2
+
+def get_headroom(threshold: dict, value: float) -> Optional[float]:
+    """ Returns the distance of a value from breaching its threshold.
+
+    The distance is relative to the threshold's magnitude (or range, for
+    `outside` thresholds). `0`, or less, means the threshold is breached.
+
+    @returns `None` if the threshold has no meaningful distance (`equal`, `nequal`)
+    """
+    if "above" in threshold:
+        limit = threshold["above"]
+        return (limit - value) / (abs(limit) or 1)
+    if "below" in threshold:
+        limit = threshold["below"]
+        return (value - limit) / (abs(limit) or 1)
+    if "outside" in threshold:
+        low, high = threshold["outside"]["min"], threshold["outside"]["max"]
+        return min(value - low, high - value) / ((high - low) or 1)
+    return None
+
+class AdaptiveInterval(object):
+    def __init__(self, min_interval: float, max_interval: float, thresholds: dict):
+        """
+        @param min_interval fastest interval, used when a value is at, or beyond, its threshold
+        @param max_interval slowest interval, used when all values are far from their thresholds
+        @param thresholds `AgentThreshold`s keyed by value name
+        """
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.thresholds = thresholds
+        self.interval = max_interval
+        # Value name -> (time, headroom) of the previous sample
+        self.previous = {}
+
+    def get_value_interval(self, name: str, value: float, now: float) -> Optional[float]:
+        """ Returns the interval required to sample a single value. """
+        threshold = self.thresholds.get(name)
+        if threshold is None:
+            return None
+        headroom = get_headroom(threshold, value)
+        if headroom is None:
+            return None
+        previous = self.previous.get(name)
+        self.previous[name] = (now, headroom)
+        if headroom <= 0:
+            return self.min_interval
+        # Scale the interval by how close the value is to its threshold
+        interval = self.min_interval + (self.max_interval - self.min_interval) * min(headroom / NEAR_THRESHOLD, 1)
+        if previous is not None and previous[1] > headroom and now > previous[0]:
+            # Value is trending toward a breach. Sample at least twice before
+            # the breach is expected to happen.
+            speed = (previous[1] - headroom) / (now - previous[0])
+            interval = min(interval, headroom / speed / 2)
+        return max(interval, self.min_interval)
+
+    def update(self, values: List[dict], now: float) -> float:
+        """ Update the interval with the most recent values.
+
+        @param values list of `AgentValue`s
+        @param now monotonic time, in seconds, the values were sampled
+        @returns the interval, in seconds, until the next sample
+        """
+        interval = self.max_interval
+        for v in values:
+            if v.get("stale"):
+                continue
+            value_interval = self.get_value_interval(v["name"], v["value"], now)
+            if value_interval is not None:
+                interval = min(interval, value_interval)
+        # Speed up immediately, but back off gradually
+        self.interval = min(interval, self.interval * BACKOFF_FACTOR)
+        return self.interval
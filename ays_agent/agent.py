@@ -0,0 +1,403 @@
+#
+# Long-running agent.
+#
+# Reports to @ys every interval. When the config file changes, the new config
+# is validated and swapped in without restarting the agent. Monitors whose
+# config did not change keep running, so their state (counter baselines,
+# cached handles, etc.) is not lost.
+#
+# In steady state, the values of each tick are copied into buffers that are
+# reused between ticks, so that a tick creates little garbage. If the agent
+# exceeds its resource budget, optional monitors are shed until it is back
+# within budget.
+#
+
+import gc
+import logging
+import threading
+import time
+
+from typing import Callable, List
+from typing_extensions import Optional
+
+import ays_agent as lib
+
+from ays_agent.adaptive import AdaptiveInterval
+from ays_agent.anomaly import AnomalyDetector
+from ays_agent.budget import RESTORE, SHED, ResourceBudget
+from ays_agent.collector import Collector
+from ays_agent.stat.pressure import PressureMonitor
+from ays_agent.sender import SendQueue
+from ays_agent.store import SampleStore
+from ays_agent.trace import TraceWriter
+from ays_agent.watch import FileWatcher
+
+class AgentConfig(object):
+    """ A validated configuration.
+
+    A config is never modified. It is replaced when the config file changes.
+    """
+
+    def __init__(
+        self,
+        options,
+        server: str,
+        msg: dict,
+        monitors: Optional[dict] = None,
+        thresholds: Optional[dict] = None,
+        optional: Optional[list] = None
+    ):
+        self.options = options
+        self.server = server
+        self.msg = msg
+        # Monitors keyed by a value that identifies the monitor's resource and
+        # configuration. Values are reported in the order of the monitors.
+        self.monitors = monitors or {}
+        # `AgentThreshold`s of monitored values, keyed by value name
+        self.thresholds = thresholds or {}
+        # Keys of the monitors that may be shed when the agent is over its
+        # budget, in the order they are shed
+        self.optional = optional or []
+        self.interval = options.interval
+        self.adaptive = None
+        if options.min_interval:
+            self.adaptive = AdaptiveInterval(options.min_interval, options.interval, self.thresholds)
+        self.budget = None
+        if getattr(options, "max_rss", None) or getattr(options, "max_cpu", None):
+            self.budget = ResourceBudget(options.max_rss, options.max_cpu)
+
+    def get_interval(self) -> float:
+        """ Returns the time, in seconds, until the next report. """
+        if self.adaptive is not None:
+            return self.adaptive.interval
+        return self.interval
+
+def get_anomaly_detector(config: AgentConfig) -> Optional[AnomalyDetector]:
+    kind = config.options.anomaly_detection
+    return AnomalyDetector(kind) if kind else None
+
+def stop_monitor(monitor) -> None:
+    stop = getattr(monitor, "stop", None)
+    if stop is not None:
+        stop()
+
+class ValueBuffer(object):
+    """ The values reported each tick.
+
+    A value's dict is reused from the previous tick, if it has the same
+    properties, so that values (and their thresholds) are not copied every
+    tick. The values returned are only valid until the next update.
+    """
+
+    def __init__(self, thresholds: dict):
+        self.thresholds = thresholds
+        # Value dicts keyed by name
+        self.buffers = {}
+        self.values = []
+        self.seen = set()
+
+    def update(self, values: List[dict]) -> List[dict]:
+        thresholds, buffers, seen = self.thresholds, self.buffers, self.seen
+        out = self.values
+        out.clear()
+        seen.clear()
+        for v in values:
+            name = v["name"]
+            b = buffers.get(name)
+            if b is not None and len(v) == 2 and len(b) == 2 + (name in thresholds) and name not in seen:
+                b["value"] = v["value"]
+            else:
+                b = dict(v, threshold=thresholds[name]) if name in thresholds else dict(v)
+                if name not in seen:
+                    buffers[name] = b
+            seen.add(name)
+            out.append(b)
+        if len(buffers) > 2 * len(seen) + 64:
+            # Drop the buffers of values that are no longer reported
+            self.buffers = {name: b for name, b in buffers.items() if name in seen}
+        return out
+
+class Agent(object):
+    def __init__(
+        self,
+        config: AgentConfig,
+        send: Callable[[str, dict], bool],
+        load_config: Optional[Callable[[], AgentConfig]] = None,
+        config_path: Optional[str] = None,
+        monitor_timeout: float = 10,
+        history: Optional[SampleStore] = None,
+        recorder: Optional[TraceWriter] = None,
+        queue: Optional[SendQueue] = None,
+        sinks: Optional[list] = None,
+        clock: Optional[Callable[[], float]] = None
+    ):
+        """
+        @param config the initial config
+        @param send sends a message to @ys
+        @param load_config loads, and validates, the config when the config file changes
+        @param config_path path of the config file to watch
+        @param history stores sampled values, if provided
+        @param recorder records the values of each tick, if provided
+        @param queue queues messages to be sent, by priority, if provided. Otherwise, messages are sent by `send`.
+        @param sinks export the values of each tick to other systems, e.g. `OtlpSink`, in addition to @ys
+        @param clock returns the time, in seconds, of a tick, e.g. the recorded time of a replayed tick. Default: the system clock.
+        """
+        self.config = config
+        self.send = send
+        self.load_config = load_config
+        self.config_path = config_path
+        self.history = history
+        self.recorder = recorder
+        self.queue = queue
+        self.sinks = sinks or []
+        self.clock = clock
+        # Learned behavior of values. Kept when the config is reloaded.
+        self.anomaly = get_anomaly_detector(config)
+        # Serializes reports and config reloads
+        self.lock = threading.RLock()
+        # Set to run the next tick immediately
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        # Keys of the monitors that were shed, in the order they were shed
+        self.shed = []
+        self.buffer = ValueBuffer(config.thresholds)
+        self.msg = dict(config.msg)
+        for monitor in config.monitors.values():
+            monitor.start()
+        self.collector = Collector(list(config.monitors.values()), timeout=monitor_timeout)
+
+    def get_active_monitors(self) -> list:
+        """ Returns the monitors that were not shed. """
+        return [m for key, m in self.config.monitors.items() if key not in self.shed]
+
+    def get_time(self) -> float:
+        """ Returns the (wall clock) time of the current tick. """
+        return time.time() if self.clock is None else self.clock()
+
+    def get_monotonic_time(self) -> float:
+        return time.monotonic() if self.clock is None else self.clock()
+
+    def get_message(self) -> dict:
+        """ Returns the message to report, with the current values of all monitors.
+
+        The message is only valid until the next call.
+        """
+        with self.lock:
+            config = self.config
+            if not config.monitors:
+                return config.msg
+            values = self.collector.collect(config.interval)
+            if config.budget is not None:
+                values.extend(config.budget.get_values(len(self.shed)))
+            if self.recorder is not None:
+                self.recorder.write(self.get_time(), values)
+            # NOTE: Only values named by `value_names` have thresholds. If
+            # thresholds are required for all values, use the
+            # `com.bithead.template.agent_resources` template.
+            values = self.buffer.update(values)
+            if config.adaptive is not None:
+                config.adaptive.update(values, self.get_monotonic_time())
+            if self.history is not None:
+                now = self.get_time()
+                for v in values:
+                    if not v.get("stale"):
+                        self.history.add(v["name"], v["value"], now)
+            msg = self.msg
+            msg["values"] = values
+            return msg
+
+    def get_anomaly_message(self, msg: dict) -> Optional[dict]:
+        """ Returns a status message if the state of the message's values changed. """
+        if self.anomaly is None or "values" not in msg:
+            return None
+        change = self.anomaly.update(msg["values"], self.get_time())
+        if change is None:
+            return None
+        state, message = change
+        status = {k: v for k, v in msg.items() if k not in ("value", "values", "status")}
+        status["status"] = lib.get_status(message, state)
+        return status
+
+    def report(self) -> bool:
+        """ Report to @ys.
+
+        @returns `True` if the report was accepted, or queued
+        """
+        with self.lock:
+            msg = self.get_message()
+            status = self.get_anomaly_message(msg)
+            server = self.config.server
+            if self.queue is not None:
+                # The message is copied when it is queued
+                if status is not None:
+                    self.queue.put(server, status)
+                queued = self.queue.put(server, msg)
+                self.put_sinks(msg)
+                return queued
+            # The message is reused by the next tick, so sinks are fed while
+            # the lock is held
+            self.put_sinks(msg)
+        try:
+            if status is not None:
+                self.send(server, status)
+            return self.send(server, msg)
+        except Exception:
+            logging.exception("Failed to make request to @ys server")
+            return False
+
+    def put_sinks(self, msg: dict) -> None:
+        """ Fan the values out to every sink, after they are queued for @ys.
+
+        Each sink batches, and retries, on its own. A sink that fails does not
+        affect @ys, or the other sinks.
+        """
+        for sink in self.sinks:
+            try:
+                sink.put(msg)
+            except Exception:
+                logging.exception(f"Failed to export values to sink ({type(sink).__name__})")
+
+    def reload(self) -> bool:
+        """ Load the config and swap it in, if valid.
+
+        @returns `True` if the new config was swapped in
+        """
+        try:
+            config = self.load_config()
+        except Exception as exc:
+            logging.error(f"Ignoring invalid config ({self.config_path}): {exc}")
+            return False
+        with self.lock:
+            current = self.config
+            monitors = {}
+            started = []
+            try:
+                for key, monitor in config.monitors.items():
+                    if key in current.monitors:
+                        monitors[key] = current.monitors[key]
+                    else:
+                        monitor.start()
+                        started.append(monitor)
+                        monitors[key] = monitor
+            except Exception as exc:
+                logging.error(f"Ignoring config ({self.config_path}), a monitor failed to start: {exc}")
+                for monitor in started:
+                    stop_monitor(monitor)
+                return False
+            config.monitors = monitors
+            self.shed = [key for key in self.shed if key in monitors]
+            self.config = config
+            self.collector.set_monitors(self.get_active_monitors())
+            self.buffer = ValueBuffer(config.thresholds)
+            self.msg = dict(config.msg)
+            if config.options.anomaly_detection != current.options.anomaly_detection:
+                self.anomaly = get_anomaly_detector(config)
+            for key, monitor in current.monitors.items():
+                if key not in monitors:
+                    stop_monitor(monitor)
+            for key, monitor in monitors.items():
+                if monitor in started and key not in self.shed:
+                    self.watch_pressure(monitor)
+        logging.info(f"Reloaded config ({self.config_path})")
+        if config.interval != current.interval:
+            self.wakeup.set()
+        return True
+
+    def enforce_budget(self) -> None:
+        """ Shed, or restore, an optional monitor depending on the agent's resource usage. """
+        with self.lock:
+            config = self.config
+            if config.budget is None:
+                return
+            action = config.budget.update(can_restore=bool(self.shed))
+            if action == SHED:
+                key = next((k for k in config.optional if k in config.monitors and k not in self.shed), None)
+                if key is None:
+                    return
+                logging.warning(f"Agent is over its budget (RSS {config.budget.rss:.1f}MB, CPU {config.budget.cpu:.1f}%). Shedding monitor ({key[0]}).")
+                stop_monitor(config.monitors[key])
+                self.shed.append(key)
+            elif action == RESTORE:
+                key = self.shed[-1]
+                monitor = config.monitors[key]
+                try:
+                    monitor.start()
+                except Exception as exc:
+                    logging.error(f"Failed to restore monitor ({key[0]}): {exc}")
+                    return
+                logging.info(f"Agent is within its budget. Restoring monitor ({key[0]}).")
+                self.shed.pop()
+                self.watch_pressure(monitor)
+            else:
+                return
+            self.collector.set_monitors(self.get_active_monitors())
+
+    def run_forever(self) -> None:
+        """ Report every interval until stopped. """
+        next_tick = time.monotonic()
+        while not self.stopped.is_set():
+            try:
+                self.report()
+                self.enforce_budget()
+            except Exception:
+                # The next tick is still scheduled
+                logging.exception("Failed to report")
+            # Ticks are scheduled from the time the first tick was made, so
+            # that the time it takes to report does not cause drift.
+            # When messages can't be sent as fast as they are queued, sample
+            # less often, rather than queue values that will be dropped.
+            next_tick += self.config.get_interval() * (self.queue.get_backpressure() if self.queue is not None else 1)
+            now = time.monotonic()
+            if next_tick < now:
+                next_tick = now
+            if self.wakeup.wait(next_tick - now):
+                self.wakeup.clear()
+                next_tick = time.monotonic()
+
+    def watch_config(self) -> None:
+        """ Reload the config whenever the config file changes. """
+        watcher = FileWatcher(self.config_path)
+        while not self.stopped.is_set():
+            if watcher.wait(1):
+                self.reload()
+        watcher.close()
+
+    def watch_pressure(self, monitor) -> None:
+        """ Report as soon as a PSI trigger fires, rather than waiting for the next interval. """
+        if not isinstance(monitor, PressureMonitor) or not monitor.triggers:
+            return
+
+        def run():
+            # `poller` is removed when the monitor is stopped
+            while not self.stopped.is_set() and monitor.poller is not None:
+                try:
+                    fired = monitor.wait(1)
+                except lib.AgentException as exc:
+                    # Triggers will not fire again. Values are still reported
+                    # every interval.
+                    logging.error(f"Stopped watching PSI triggers: {exc}")
+                    return
+                if not fired:
+                    continue
+                try:
+                    self.report()
+                except Exception:
+                    logging.exception("Failed to report when PSI trigger fired")
+
+        threading.Thread(target=run, name="ays-pressure", daemon=True).start()
+
+    def start(self) -> None:
+        """ Start reporting in background threads. """
+        # Objects created at startup (modules, config, monitors) live as long
+        # as the agent. Freezing them means the garbage collector no longer
+        # traverses them every collection.
+        gc.freeze()
+        threading.Thread(target=self.run_forever, name="ays-agent", daemon=True).start()
+        if self.load_config is not None and self.config_path is not None:
+            threading.Thread(target=self.watch_config, name="ays-config", daemon=True).start()
+        for monitor in self.config.monitors.values():
+            self.watch_pressure(monitor)
+
+    def stop(self) -> None:
+        self.stopped.set()
+        self.wakeup.set()
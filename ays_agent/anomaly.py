@@ -0,0 +1,145 @@
+#
+# Streaming anomaly detection.
+#
+# Each value is scored against what it learned from its previous samples. The
+# learned state of a value is a few floats, updated in constant time, so
+# detection does not require the history of a value.
+#
+
+import math
+
+from typing import Callable, List
+from typing_extensions import Optional
+
+from ays_agent import AgentException
+
+AVAIL_DETECTORS = ["ewma", "seasonal"]
+
+# Z-scores at which a value is considered anomalous
+WARNING_ZSCORE = 3
+ERROR_ZSCORE = 5
+
+# Minimum standard deviation, relative to the mean, used to score a value. This
+# prevents a value that has been constant from scoring infinitely when it
+# changes.
+MIN_STDDEV = 0.01
+
+class EWMADetector(object):
+    """ Scores values by their distance from an exponentially weighted moving
+    average, in exponentially weighted standard deviations.
+    """
+
+    __slots__ = ("alpha", "warmup", "count", "mean", "var")
+
+    def __init__(self, alpha: float = 0.1, warmup: int = 30):
+        """
+        @param alpha weight of the most recent sample
+        @param warmup number of samples to learn from before values are scored
+        """
+        self.alpha = alpha
+        self.warmup = warmup
+        self.count = 0
+        self.mean = 0.0
+        self.var = 0.0
+
+    def update(self, value: float, timestamp: Optional[float] = None) -> Optional[float]:
+        """ Score a value and learn from it.
+
+        @returns z-score of the value, or `None` while warming up
+        """
+        self.count += 1
+        if self.count == 1:
+            self.mean = value
+            return None
+        diff = value - self.mean
+        stddev = max(math.sqrt(self.var), abs(self.mean) * MIN_STDDEV, MIN_STDDEV)
+        zscore = diff / stddev
+        self.mean += self.alpha * diff
+        self.var = (1 - self.alpha) * (self.var + self.alpha * diff * diff)
+        if self.count <= self.warmup:
+            return None
+        return zscore
+
+class SeasonalDetector(object):
+    """ Scores values against the values sampled at the same time of a period,
+    e.g. the same hour of the day.
+    """
+
+    __slots__ = ("period", "buckets")
+
+    def __init__(self, period: int = 24 * 60 * 60, num_buckets: int = 24, alpha: float = 0.3, warmup: int = 7):
+        """
+        @param period length, in seconds, of a season
+        @param num_buckets number of baselines per period
+        @param alpha weight of the most recent sample of a bucket
+        @param warmup number of samples each bucket learns from before its values are scored
+        """
+        self.period = period
+        self.buckets = [EWMADetector(alpha, warmup) for _ in range(num_buckets)]
+
+    def update(self, value: float, timestamp: float) -> Optional[float]:
+        bucket = int((timestamp % self.period) * len(self.buckets) // self.period)
+        return self.buckets[bucket].update(value)
+
+def get_detector_factory(kind: str) -> Callable[[], object]:
+    """ Returns a function that creates the detector of a value. """
+    if kind == "ewma":
+        return EWMADetector
+    if kind == "seasonal":
+        return SeasonalDetector
+    raise AgentException(f"Invalid anomaly detection ({kind}). Available options are ({', '.join(AVAIL_DETECTORS)})")
+
+class AnomalyDetector(object):
+    """ Detects anomalies in a stream of `AgentValue`s. """
+
+    def __init__(self, kind: str, warning: float = WARNING_ZSCORE, error: float = ERROR_ZSCORE):
+        self.kind = kind
+        self.factory = get_detector_factory(kind)
+        self.warning = warning
+        self.error = error
+        self.detectors = {}
+        # Value name -> anomaly message, of values that are anomalous
+        self.anomalies = {}
+        self.state = "healthy"
+
+    def get_state(self, zscore: Optional[float]) -> str:
+        if zscore is None:
+            return "healthy"
+        zscore = abs(zscore)
+        if zscore >= self.error:
+            return "error"
+        if zscore >= self.warning:
+            return "warning"
+        return "healthy"
+
+    def update(self, values: List[dict], timestamp: float) -> Optional[tuple[str, str]]:
+        """ Score and learn from the most recent values.
+
+        Stale values are not scored. They keep the state of their last score.
+
+        @param values list of `AgentValue`s
+        @param timestamp time, since epoch, the values were sampled
+        @returns the state and message of the values, if the state changed
+        """
+        for v in values:
+            if v.get("stale"):
+                continue
+            detector = self.detectors.get(v["name"])
+            if detector is None:
+                detector = self.detectors[v["name"]] = self.factory()
+            zscore = detector.update(v["value"], timestamp)
+            value_state = self.get_state(zscore)
+            if value_state == "healthy":
+                self.anomalies.pop(v["name"], None)
+            else:
+                self.anomalies[v["name"]] = (value_state, f"{v['name']} ({v['value']}) deviates {zscore:+.1f} standard deviations from normal")
+        state = "healthy"
+        for value_state, _ in self.anomalies.values():
+            if value_state == "error" or state == "healthy":
+                state = value_state
+        if state == self.state:
+            return None
+        self.state = state
+        if state == "healthy":
+            return state, "Values returned to normal"
+        return state, "; ".join(message for _, message in self.anomalies.values())
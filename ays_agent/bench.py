@@ -0,0 +1,222 @@
+#
+# Benchmark the report pipeline.
+#
+# A recorded trace is replayed through the pipeline (`Agent.report`: collection,
+# thresholds, anomaly detection, the send queue, sinks, serialization and
+# transport) as fast as possible. The recorded time of each tick is the
+# agent's clock, so replays are reproducible. Reports are posted to a stand-in
+# server on the loopback interface, which accepts every report, so the numbers
+# only depend on the agent.
+#
+# The pipeline of a real config, with live monitors, can also be run without
+# the network (`--dry-run --bench N`), to find the per-tick cost of the agent
+# on a host before it is rolled out.
+#
+
+import json
+import threading
+import time
+import tracemalloc
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List
+from typing_extensions import Optional
+
+import ays_agent as lib
+
+from ays_agent.agent import Agent, AgentConfig
+from ays_agent.sender import SEND_BURST, SendQueue
+from ays_agent.trace import ReplayMonitor, TraceReader
+
+PERCENTILES = [50, 90, 99]
+
+# Messages sent per second when a trace is replayed, so that the rate limit of
+# the send queue does not bound the throughput of the pipeline
+REPLAY_SEND_RATE = 1000000
+
+def get_percentiles(samples: List[float], percentiles: List[int] = PERCENTILES) -> Dict[str, float]:
+    """ Returns the percentiles, and max, of samples. """
+    if not samples:
+        return {}
+    samples = sorted(samples)
+    result = {f"p{p}": samples[min(int(len(samples) * p / 100), len(samples) - 1)] for p in percentiles}
+    result["max"] = samples[-1]
+    return result
+
+def format_timings(name: str, samples: List[float]) -> str:
+    """ Returns the percentiles of timings, in milliseconds, formatted on a single line. """
+    percentiles = get_percentiles(samples)
+    return f"{name:<12}" + "  ".join(f"{k} {v * 1000:.3f}ms" for k, v in percentiles.items())
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(length)
+        self.send_response(204)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_HEAD(self):
+        self.send_response(204)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+class StandInServer(object):
+    """ Accepts every report, on the loopback interface. """
+
+    def __init__(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/agent/"
+        self.thread = None
+
+    def start(self) -> None:
+        self.thread = threading.Thread(target=self.server.serve_forever, name="ays-stand-in", daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+def get_replay_config(header: dict, server: str, monitor: ReplayMonitor) -> AgentConfig:
+    """ Returns the config a trace was recorded with. """
+    options = lib.get_empty_options()
+    options.interval = header.get("interval")
+    options.min_interval = header.get("min_interval")
+    options.anomaly_detection = header.get("anomaly_detection")
+    return AgentConfig(options, server, header.get("msg", {}), {("replay",): monitor}, header.get("thresholds"))
+
+def get_replay_ticks(recorded: list, repeat: int, interval: Optional[float]) -> list:
+    """ Returns the ticks of a trace, repeated. The times of each repeat follow the last, so that time never goes backwards. """
+    if not recorded:
+        return []
+    span = recorded[-1][0] - recorded[0][0] + (interval or 1)
+    return [(now + span * i, values) for i in range(repeat) for now, values in recorded]
+
+def replay_trace(
+    path: str,
+    send: Callable[[str, dict], bool],
+    repeat: int = 1,
+    rate: float = REPLAY_SEND_RATE,
+    sinks: Optional[list] = None
+) -> dict:
+    """ Replay a trace through the pipeline as fast as possible.
+
+    @param send posts a message to a server, e.g. `post_request`. Messages are posted to a stand-in server.
+    @param repeat number of times the trace is replayed
+    @param rate messages sent per second by the send queue
+    @param sinks the values of each tick are exported to, in addition to the stand-in server
+    @returns the number of ticks, the time it took to replay (and send) them, the timings of each phase, and the send queue's metrics
+    """
+    reader = TraceReader(path)
+    recorded = list(reader.read())
+    ticks = get_replay_ticks(recorded, repeat, reader.header.get("interval"))
+    server = StandInServer()
+    server.start()
+    timings = {"report": [], "send": []}
+    sizes = []
+
+    def send_timed(server: str, msg: dict) -> bool:
+        t0 = time.perf_counter()
+        ok = send(server, msg)
+        timings["send"].append(time.perf_counter() - t0)
+        sizes.append(len(json.dumps(msg)))
+        return ok
+
+    # Every message is queued, rather than dropped, so that every tick is sent
+    queue = SendQueue(send_timed, max_size=max(2 * len(ticks), 1), rate=rate, burst=max(SEND_BURST, int(rate)))
+    sinks = sinks or []
+    monitor = ReplayMonitor(ticks)
+    agent = Agent(get_replay_config(reader.header, server.url, monitor), send=send_timed, queue=queue, sinks=sinks, clock=monitor.get_time)
+    try:
+        queue.start()
+        for sink in sinks:
+            sink.start()
+        start = time.perf_counter()
+        for _ in ticks:
+            t0 = time.perf_counter()
+            agent.report()
+            timings["report"].append(time.perf_counter() - t0)
+        # Wait for every queued message to be sent
+        queue.stop(timeout=len(ticks) / rate + 60)
+        elapsed = time.perf_counter() - start
+    finally:
+        agent.stop()
+        queue.stop(timeout=0)
+        for sink in sinks:
+            sink.stop()
+        server.stop()
+    return {
+        "ticks": len(ticks),
+        "elapsed": elapsed,
+        # Time, in seconds, the trace was recorded over
+        "recorded": recorded[-1][0] - recorded[0][0] if recorded else 0,
+        "timings": timings,
+        "sizes": sizes,
+        "queue": queue.get_stats()
+    }
+
+def bench_agent(agent: Agent, load_config: Callable[[], object], iterations: int) -> dict:
+    """ Run the pipeline of an agent, without sending reports.
+
+    Each iteration loads the config, samples the monitors, builds the payload
+    and serializes it. The pipeline is run twice: once to time each phase, and
+    once, with `tracemalloc`, to measure allocations, as tracing allocations
+    slows the pipeline down.
+
+    @param load_config loads, and validates, the config
+    @returns the timings of each phase, payload sizes, and allocations
+    """
+    def run() -> bytes:
+        load_config()
+        msg = agent.get_message()
+        agent.get_anomaly_message(msg)
+        return json.dumps(msg).encode()
+
+    # Rates (e.g. network throughput) are computed from the previous sample
+    run()
+    timings = {"config": [], "collect": [], "serialize": [], "total": []}
+    sizes = []
+    for _ in range(iterations):
+        t0 = time.perf_counter()
+        load_config()
+        t1 = time.perf_counter()
+        msg = agent.get_message()
+        agent.get_anomaly_message(msg)
+        t2 = time.perf_counter()
+        body = json.dumps(msg).encode()
+        t3 = time.perf_counter()
+        timings["config"].append(t1 - t0)
+        timings["collect"].append(t2 - t1)
+        timings["serialize"].append(t3 - t2)
+        timings["total"].append(t3 - t0)
+        sizes.append(len(body))
+
+    # Allocations of all threads, including the collector's, are traced
+    peaks = []
+    tracemalloc.start()
+    try:
+        start = tracemalloc.get_traced_memory()[0]
+        for _ in range(iterations):
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            run()
+            peaks.append(tracemalloc.get_traced_memory()[1] - before)
+        retained = tracemalloc.get_traced_memory()[0] - start
+    finally:
+        tracemalloc.stop()
+    return {
+        "iterations": iterations,
+        "timings": timings,
+        "sizes": sizes,
+        # Peak memory, in bytes, allocated by each iteration
+        "allocated": peaks,
+        # Memory, in bytes, still allocated after all iterations. Memory that
+        # grows with the number of iterations is leaked.
+        "retained": retained
+    }
@@ -0,0 +1,103 @@
+#
+# Resource budget of the agent.
+#
+# The agent samples its own memory (RSS) and CPU usage every tick. When it uses
+# more CPU than its budget, optional monitors are shed, one per tick, until it
+# is within budget. Shed monitors are restored, one at a time, once the agent
+# has been comfortably within budget for several ticks, so that an agent
+# hovering near its budget doesn't shed and restore a monitor every tick.
+#
+# Memory freed by a shed monitor is rarely returned to the system, so RSS
+# doesn't drop after a monitor is shed. When the agent uses more memory than
+# its budget, a single monitor is shed, and no other is shed for several ticks.
+# Monitors are restored once RSS is within budget.
+#
+
+import psutil
+
+from typing_extensions import Optional
+
+from ays_agent.stat import get_megabytes
+
+# Fraction of the CPU budget the agent must be under before shed monitors are
+# restored
+RESTORE_RATIO = 0.75
+
+# Number of consecutive ticks the agent must be within budget, and under
+# `RESTORE_RATIO` of its CPU budget, before a monitor is restored
+RESTORE_TICKS = 3
+
+# Number of ticks after a monitor is shed, because RSS was over budget, before
+# another monitor may be shed for RSS
+RSS_SHED_COOLDOWN = 10
+
+SHED = "shed"
+RESTORE = "restore"
+
+class ResourceBudget(object):
+    def __init__(self, max_rss: Optional[float] = None, max_cpu: Optional[float] = None, process: Optional[psutil.Process] = None):
+        """
+        @param max_rss maximum RSS, in MB
+        @param max_cpu maximum CPU usage, in percent of a single core
+        """
+        self.max_rss = max_rss
+        self.max_cpu = max_cpu
+        self.process = process or psutil.Process()
+        # Usage from the last sample
+        self.rss = None
+        self.cpu = None
+        self.under_ticks = 0
+        # Ticks until a monitor may be shed for RSS
+        self.rss_cooldown = 0
+        # The first call is always `0.0`, as there is no previous sample
+        self.process.cpu_percent(interval=None)
+
+    def sample(self) -> tuple[float, float]:
+        """ Returns the RSS, in MB, and CPU usage, in percent, since the last sample. """
+        self.rss = get_megabytes(self.process.memory_info().rss)
+        self.cpu = self.process.cpu_percent(interval=None)
+        return self.rss, self.cpu
+
+    def get_usage(self, rss: float, cpu: float) -> tuple[float, float]:
+        """ Returns the usage of the RSS, and CPU, budget. Greater than `1` is over budget. """
+        return (rss / self.max_rss if self.max_rss else 0.0, cpu / self.max_cpu if self.max_cpu else 0.0)
+
+    def update(self, can_restore: bool) -> Optional[str]:
+        """ Sample usage, and return the action the agent should take, if any.
+
+        @param can_restore `True` if any monitors were shed
+        @returns `SHED` if a monitor should be shed, `RESTORE` if one should be restored
+        """
+        rss, cpu = self.get_usage(*self.sample())
+        if self.rss_cooldown:
+            self.rss_cooldown -= 1
+        if cpu > 1:
+            self.under_ticks = 0
+            return SHED
+        if rss > 1:
+            self.under_ticks = 0
+            if self.rss_cooldown:
+                return None
+            self.rss_cooldown = RSS_SHED_COOLDOWN
+            return SHED
+        if cpu >= RESTORE_RATIO or not can_restore:
+            self.under_ticks = 0
+            return None
+        self.under_ticks += 1
+        if self.under_ticks < RESTORE_TICKS:
+            return None
+        self.under_ticks = 0
+        return RESTORE
+
+    def get_values(self, shed: int) -> list:
+        """ Get list of values that represent an `AgentValue`.
+
+        @param shed number of monitors that were shed
+        """
+        if self.rss is None:
+            return []
+        return [
+            {"name": "Agent RSS MB", "value": round(self.rss, 2)},
+            {"name": "Agent CPU %", "value": self.cpu},
+            {"name": "Agent Shed Monitors", "value": shed}
+        ]
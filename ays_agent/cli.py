@@ -6,28 +6,50 @@
 # - [Rich](https://rich.readthedocs.io/en/stable/) - Display rich text to terminal
 #
 
+import gzip
+import json
 import logging
+import os
 import typer
-import requests
 import socket
-import time
 import uvicorn
 
 from enum import Enum
-from fastapi import FastAPI
-from fastapi.responses import Response
-from fastapi_utils.tasks import repeat_every
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response
 from rich import print
-from typing import Optional
+from typing import List, Optional
 from typing_extensions import Annotated
 from pathlib import Path
 
 import ays_agent as lib
 
+from ays_agent.agent import Agent, AgentConfig, stop_monitor
+from ays_agent.anomaly import AVAIL_DETECTORS
+from ays_agent.bench import REPLAY_SEND_RATE, bench_agent, format_timings, get_percentiles, replay_trace
+from ays_agent import export
+from ays_agent.export import SegmentWriter
+from ays_agent.otlp import OtlpSink
+from ays_agent.relay import Relay, Spool
+from ays_agent.sender import SEND_BURST, SEND_RATE, SendQueue
+from ays_agent.shard import ShardedMonitor
+from ays_agent.sketch import DEFAULT_QUANTILES, parse_quantiles
+from ays_agent.store import RESOLUTIONS, SampleStore
+from ays_agent.trace import TraceWriter, get_trace_header
+from ays_agent.transport import get_endpoint_pool
+from ays_agent.stat.cgroup import CgroupMonitor
+from ays_agent.stat.counter import CounterStore
 from ays_agent.stat.cpu import CPUMonitor
+from ays_agent.stat.directory import DirectoryMonitor
 from ays_agent.stat.disk import DiskMonitor
+from ays_agent.stat.log import LogMonitor, parse_pattern
 from ays_agent.stat.memory import MemoryMonitor
 from ays_agent.stat.network import NetworkMonitor
+from ays_agent.stat.probe import ProbeMonitor
+from ays_agent.stat.pressure import PressureMonitor, parse_trigger
+from ays_agent.stat.process import ProcessMonitor
+from ays_agent.stat.statsd import StatsdMonitor
+from ays_agent.stat.tcp import SocketMonitor
 
 class NodeType(str, Enum):
     machine = "machine"
@@ -45,25 +67,54 @@ class StatusState(str, Enum):
     error = "error"
     critical = "critical"
 
+class AnomalyDetection(str, Enum):
+    ewma = "ewma"
+    seasonal = "seasonal"
+
 class MonitorResource(str, Enum):
     all = "all"
     cpu = "cpu"
     hdd = "hdd"
     ram = "ram"
     net = "net"
+    proc = "proc"
+    cgroup = "cgroup"
+    psi = "psi"
+    log = "log"
+    probe = "probe"
+    sock = "sock"
+    statsd = "statsd"
+    dir = "dir"
 
 RESOURCE_MONITORS = {
     MonitorResource.cpu: CPUMonitor,
     MonitorResource.hdd: DiskMonitor,
     MonitorResource.ram: MemoryMonitor,
-    MonitorResource.net: NetworkMonitor
+    MonitorResource.net: NetworkMonitor,
+    MonitorResource.proc: ProcessMonitor,
+    MonitorResource.cgroup: CgroupMonitor,
+    MonitorResource.psi: PressureMonitor,
+    MonitorResource.sock: SocketMonitor
 }
 
+# Resources that are not monitored by `all`, and must be provided by name. The
+# `proc` resource reports on whichever processes are busiest, which is not
+# wanted by every host.
+OPT_IN_RESOURCES = [MonitorResource.proc]
+
+# Resources that are never shed when the agent exceeds its budget
+CORE_RESOURCES = [MonitorResource.cpu, MonitorResource.ram, MonitorResource.hdd]
+
 app = typer.Typer(no_args_is_help=True, invoke_without_command=True)
+segments_app = typer.Typer(no_args_is_help=True)
+app.add_typer(segments_app, name="segments", help="List and compact the columnar segments exported with `--export-dir`.")
 
 def get_default_server():
     return "https://api.bithead.io:9443/agent/"
 
+def get_default_monitor_timeout():
+    return 10
+
 def get_hostname():
     return socket.gethostname()
 
@@ -72,11 +123,161 @@ def _version_callback(value: bool) -> None:
         typer.echo(f"{lib.get_name()} v{lib.get_version()}")
         raise typer.Exit()
 
-def send_request(server, json):
-    resp = requests.request("POST", server, json=json)
-    if resp.status_code != 204:
+def get_counter_store() -> Optional[CounterStore]:
+    """ Returns the store used to persist counter baselines between restarts. """
+    try:
+        return CounterStore(lib.get_state_path())
+    except OSError as exc:
+        logging.warning(f"Counter baselines will not be persisted: {exc}")
+        return None
+
+def get_resources(monitor_resources: str) -> list:
+    """ Returns the resources to monitor. """
+    resources = lib.strip_v(monitor_resources)
+    for res in resources:
+        if res not in MonitorResource.__members__:
+            raise lib.AgentException(f"Invalid monitor resource ({res}). Available options are ({', '.join(MonitorResource.__members__)}).")
+    if MonitorResource.all in resources:
+        opt_in = [res for res in OPT_IN_RESOURCES if res in resources]
+        return [res for res in RESOURCE_MONITORS if res not in OPT_IN_RESOURCES] + opt_in
+    return [MonitorResource(res) for res in resources]
+
+# Options that configure the monitor of the respective resource. When the
+# config is reloaded, a monitor is only replaced if one of its options changed.
+RESOURCE_OPTIONS = {
+    MonitorResource.hdd: ["disk_mounts"],
+    MonitorResource.cgroup: ["cgroups"],
+    MonitorResource.psi: ["psi_triggers"],
+    MonitorResource.log: ["log_files", "log_patterns"],
+    MonitorResource.probe: ["probe_endpoints", "shards"],
+    MonitorResource.sock: ["sock_ports"],
+    MonitorResource.statsd: ["statsd_listen", "quantiles"],
+    MonitorResource.dir: ["directories"]
+}
+
+def get_monitor_key(resource: str, options: lib.CLIOptions) -> tuple:
+    """ Returns a value that identifies a resource's monitor and its configuration. """
+    key = [MonitorResource(resource).value]
+    for name in RESOURCE_OPTIONS.get(resource, []):
+        value = getattr(options, name)
+        key.append(tuple(value) if isinstance(value, list) else value)
+    return tuple(key)
+
+def get_monitor(resource: str, options: lib.CLIOptions, store: Optional[CounterStore] = None):
+    """ Returns a new instance of the monitor for the respective resource. """
+    if resource == MonitorResource.cgroup:
+        return CgroupMonitor(options.cgroups and lib.strip_v(options.cgroups) or None)
+    if resource == MonitorResource.hdd:
+        return DiskMonitor(mounts=options.disk_mounts and lib.strip_v(options.disk_mounts) or None, store=store)
+    if resource == MonitorResource.net:
+        return NetworkMonitor(store=store)
+    if resource == MonitorResource.log:
+        return LogMonitor(options.log_files and lib.strip_v(options.log_files) or [], list(map(parse_pattern, options.log_patterns or [])))
+    if resource == MonitorResource.probe:
+        endpoints = options.probe_endpoints and lib.strip_v(options.probe_endpoints) or []
+        if options.shards and options.shards > 1:
+            return ShardedMonitor(ProbeMonitor, endpoints, options.shards)
+        return ProbeMonitor(endpoints)
+    if resource == MonitorResource.dir:
+        return DirectoryMonitor(options.directories and lib.strip_v(options.directories) or [])
+    if resource == MonitorResource.statsd:
+        return StatsdMonitor(
+            options.statsd_listen and lib.strip_v(options.statsd_listen) or None,
+            parse_quantiles(options.quantiles) if options.quantiles else DEFAULT_QUANTILES
+        )
+    if resource == MonitorResource.sock and options.sock_ports:
+        try:
+            return SocketMonitor(list(map(int, lib.strip_v(options.sock_ports))))
+        except ValueError:
+            raise lib.AgentException(f"Invalid socket ports ({options.sock_ports}). Ports must be numbers")
+    if resource == MonitorResource.psi and options.psi_triggers:
+        return PressureMonitor(list(map(parse_trigger, lib.strip_v(options.psi_triggers))))
+    return RESOURCE_MONITORS[resource]()
+
+def get_options(cli_args: dict, write_config: bool = False) -> lib.CLIOptions:
+    """ Returns the options in the config file merged with the options provided to the CLI. """
+    # Do not load options if writing new config. This prevents old options from
+    # being merged with the new.
+    if write_config:
+        options = lib.get_empty_options()
+    else:
+        # Load options from disk, if any
+        options = lib.load_options()
+    # Merge options provided
+    options.merge(**cli_args)
+
+    if not options.server:
+        options.server = get_default_server()
+    if not options.monitor_name:
+        options.monitor_name = get_hostname()
+    return options
+
+def get_thresholds(names: Optional[str], thresholds: Optional[str]) -> dict:
+    """ Returns the thresholds of monitored values, keyed by value name. """
+    if not thresholds:
+        return {}
+    if not names:
+        raise lib.AgentException("'value_names' must be provided with 'value_thresholds' when monitoring resources")
+    names = lib.strip_v(names)
+    thresholds = lib.strip_v(thresholds)
+    if len(names) != len(thresholds):
+        raise lib.AgentException(f"The number of thresholds ({len(thresholds)}) must match the number of value names ({len(names)}) provided")
+    return {name: lib.get_threshold(thresh) for name, thresh in zip(names, thresholds) if thresh}
+
+def get_agent_config(options: lib.CLIOptions, store: Optional[CounterStore] = None) -> AgentConfig:
+    """ Validates options and creates the monitors they require.
+
+    Monitors are not started.
+    """
+    server, msg = lib.get_agent_payload(options)
+    if (options.monitor_resources or options.monitor_program or options.monitor_file) and not options.interval:
+        # Default is 5 minutes
+        options.interval = 60 * 5
+    if options.interval is not None and options.interval < 15:
+        raise lib.AgentException(f"Interval provided ({options.interval}) must be 15 seconds or greater")
+    if options.min_interval is not None:
+        if not options.interval:
+            raise lib.AgentException("'interval' must be provided when 'min_interval' is provided")
+        if not 15 <= options.min_interval <= options.interval:
+            raise lib.AgentException(f"Minimum interval provided ({options.min_interval}) must be between 15 seconds and the interval ({options.interval})")
+    if options.anomaly_detection and options.anomaly_detection not in AVAIL_DETECTORS:
+        raise lib.AgentException(f"Invalid anomaly detection ({options.anomaly_detection}). Available options are ({', '.join(AVAIL_DETECTORS)})")
+    if options.send_rate is not None and options.send_rate <= 0:
+        raise lib.AgentException(f"Send rate provided ({options.send_rate}) must be greater than 0")
+    if options.shards is not None and options.shards < 1:
+        raise lib.AgentException(f"Number of shards provided ({options.shards}) must be 1 or greater")
+    if options.max_rss is not None and options.max_rss <= 0:
+        raise lib.AgentException(f"Maximum RSS provided ({options.max_rss}) must be greater than 0")
+    if options.max_cpu is not None and options.max_cpu <= 0:
+        raise lib.AgentException(f"Maximum CPU provided ({options.max_cpu}) must be greater than 0")
+    monitors = {}
+    thresholds = {}
+    optional = []
+    if options.monitor_resources:
+        for res in get_resources(options.monitor_resources):
+            key = get_monitor_key(res, options)
+            monitors[key] = get_monitor(res, options, store)
+            if res not in CORE_RESOURCES:
+                optional.append(key)
+        thresholds = get_thresholds(options.value_names, options.value_thresholds)
+    # The last resources provided are shed first
+    optional.reverse()
+    return AgentConfig(options, server, msg, monitors, thresholds, optional)
+
+def post_request(server, json) -> bool:
+    """ Send a message to @ys.
+
+    @returns `True` if the message was accepted
+    """
+    resp = get_endpoint_pool(server).send(json=json)
+    if resp is None or resp.status_code != 204:
         print("Failed to make request to @ys server")
         print(resp)
+        return False
+    return True
+
+def send_request(server, json):
+    if not post_request(server, json):
         raise typer.Exit(1)
     else:
         raise typer.Exit()
@@ -85,10 +286,66 @@ def send_request(server, json):
 
 fastapp = FastAPI()
 
+fastapp.state.store = None
+fastapp.state.relay = None
+fastapp.state.queue = None
+fastapp.state.sinks = []
+
 @fastapp.get("/test/")
 async def test():
     return Response(status_code=204)
 
+@fastapp.get("/query/")
+async def query(request: Request, name: Optional[str] = None, start: Optional[float] = None, end: Optional[float] = None, resolution: str = "raw"):
+    """ Query the samples stored in the agent's history.
+
+    Returns the names of all series if `name` is not provided.
+    """
+    store = request.app.state.store
+    if store is None:
+        return JSONResponse({"error": "History is not enabled"}, status_code=404)
+    if name is None:
+        return {"names": store.get_names(), "dropped": store.get_dropped()}
+    if resolution not in RESOLUTIONS:
+        return JSONResponse({"error": f"Invalid resolution ({resolution}). Available options are ({', '.join(RESOLUTIONS)})"}, status_code=400)
+    points = store.query(name, start, end, resolution)
+    if points is None:
+        return JSONResponse({"error": f"Series ({name}) does not exist"}, status_code=404)
+    return {"name": name, "resolution": resolution, "points": points}
+
+@fastapp.get("/queue/")
+async def queue(request: Request):
+    """ Returns the metrics of the agent's send queue. """
+    send_queue = request.app.state.queue
+    if send_queue is None:
+        return JSONResponse({"error": "Send queue is not enabled"}, status_code=404)
+    return send_queue.get_stats()
+
+@fastapp.get("/sinks/")
+async def sinks(request: Request):
+    """ Returns the metrics of the sinks values are exported to, in addition to @ys. """
+    return {"sinks": [sink.get_stats() for sink in request.app.state.sinks]}
+
+@fastapp.post("/agent/")
+async def relay_payload(request: Request):
+    """ Accept `AgentPayload`s, a single payload or a list, to relay upstream. """
+    relay = request.app.state.relay
+    if relay is None:
+        return JSONResponse({"error": "Relay is not enabled"}, status_code=404)
+    body = await request.body()
+    try:
+        if request.headers.get("content-encoding") == "gzip":
+            body = gzip.decompress(body)
+        payloads = json.loads(body)
+    except (OSError, ValueError):
+        return JSONResponse({"error": "Invalid payload"}, status_code=400)
+    if isinstance(payloads, dict):
+        payloads = [payloads]
+    if not isinstance(payloads, list) or not all(isinstance(p, dict) and p.get("org_secret") and p.get("parent") for p in payloads):
+        return JSONResponse({"error": "Payloads must provide 'org_secret' and 'parent'"}, status_code=400)
+    relay.submit(payloads)
+    return Response(status_code=204)
+
 # Typer app
 
 @app.callback()
@@ -99,7 +356,7 @@ def main(
         show_default=False
     )] = False,
     server: Annotated[str, typer.Option(
-        help=f"Path to the @ys server agent endpoint. Default: {get_default_server()}"
+        help=f"Path to the @ys server agent endpoint. Provide a comma delimited list of endpoints to fail over to when an endpoint is unavailable. Default: {get_default_server()}"
     )] = None,
     org_secret: Annotated[str, typer.Option(
         help="Organization secret. Required to interact with the respective org system graph."
@@ -107,6 +364,10 @@ def main(
     interval: Annotated[int, typer.Option(
         help="Interval, in seconds, that the agent will report a value or status. This will make the agent act as a long-running service. If a monitor is used, and the interval is not provided, the default interval will be 5 minutes."
     )] = None,
+    min_interval: Annotated[int, typer.Option(
+        help="Enables an adaptive interval. Values are reported every `interval` while they are far from their thresholds, and as often as every `min-interval` seconds as they approach, or breach, a threshold. Thresholds of monitored resources are provided with `value-names` and `value-thresholds`.",
+        show_default=False
+    )] = None,
     port: Annotated[int, typer.Option(
         help="The port the agent listens to when becoming a long running service."
     )] = 9555,
@@ -194,22 +455,106 @@ def main(
         show_default=False
     )] = None,
 
+    disk_mounts: Annotated[str, typer.Option(
+        help="Comma delimited list of mountpoint glob patterns, e.g. `*` or `/data*`, whose usage is reported by the `hdd` resource. Pseudo filesystems are ignored.",
+        show_default=False
+    )] = None,
+    cgroups: Annotated[str, typer.Option(
+        help="Comma delimited list of cgroup (v2) paths monitored by the `cgroup` resource. Default is the agent's own cgroup.",
+        show_default=False
+    )] = None,
+    psi_triggers: Annotated[str, typer.Option(
+        help="Comma delimited list of PSI triggers, in the format `resource:some|full:stall_us:window_us`, that report immediately when a resource stalls. Used by the `psi` resource.",
+        show_default=False
+    )] = None,
+    log_files: Annotated[str, typer.Option(
+        help="Comma delimited list of log files monitored by the `log` resource. Rotated files are followed.",
+        show_default=False
+    )] = None,
+    log_patterns: Annotated[Optional[List[str]], typer.Option(
+        help="Pattern, in the format `name=regex`, of the log lines counted by the `log` resource. May be provided more than once.",
+        show_default=False
+    )] = None,
+    probe_endpoints: Annotated[str, typer.Option(
+        help="Comma delimited list of endpoints, e.g. `https://example.com/health` or `tcp://db:5432`, probed by the `probe` resource.",
+        show_default=False
+    )] = None,
+    shards: Annotated[int, typer.Option(
+        help="Number of worker processes the `probe` resource's endpoints are partitioned across. Use when probing more endpoints than a single core can. Default: 1",
+        show_default=False
+    )] = None,
+    sock_ports: Annotated[str, typer.Option(
+        help="Comma delimited list of listening ports whose sockets are reported by the `sock` resource. Default is all listening ports.",
+        show_default=False
+    )] = None,
+    statsd_listen: Annotated[str, typer.Option(
+        help="Comma delimited list of addresses, e.g. `udp://127.0.0.1:8125` or `unix:///run/ays-agent/statsd.sock`, the `statsd` resource receives StatsD metrics on. Default: udp://127.0.0.1:8125",
+        show_default=False
+    )] = None,
+    quantiles: Annotated[str, typer.Option(
+        help=f"Comma delimited list of quantiles, in percent, reported for each distribution, e.g. StatsD timers. Default: {','.join(map(str, DEFAULT_QUANTILES))}",
+        show_default=False
+    )] = None,
+    directories: Annotated[str, typer.Option(
+        help="Comma delimited list of directories whose size, number of files and oldest file age are reported by the `dir` resource.",
+        show_default=False
+    )] = None,
+    max_rss: Annotated[float, typer.Option(
+        help="Maximum memory (RSS), in MB, the agent may use. When exceeded, a monitored resource other than `cpu`, `ram` and `hdd` is shed, the last provided first. Another is shed if the agent is still over budget 10 reports later.",
+        show_default=False
+    )] = None,
+    max_cpu: Annotated[float, typer.Option(
+        help="Maximum CPU, in percent of a single core, the agent may use. When exceeded, monitored resources are shed, like `--max-rss`, one each report until the agent is within budget.",
+        show_default=False
+    )] = None,
+    otlp_endpoint: Annotated[str, typer.Option(
+        help="OTLP/HTTP metrics endpoint, e.g. `http://localhost:4318/v1/metrics`, values are exported to, in addition to @ys, by a long running agent.",
+        show_default=False
+    )] = None,
+    export_dir: Annotated[str, typer.Option(
+        help="Directory the values of each tick are exported to, by a long running agent, as hourly Arrow IPC segments. Requires `pyarrow`. Segments may be listed and compacted with the `segments` command.",
+        show_default=False
+    )] = None,
+    send_rate: Annotated[float, typer.Option(
+        help=f"Maximum messages sent per second, per server, by a long running agent. Status changes and threshold breaches are sent first. Default: {SEND_RATE}",
+        show_default=False
+    )] = None,
+    monitor_timeout: Annotated[int, typer.Option(
+        help=f"Time, in seconds, a monitor has to collect its values. Monitors that exceed this report their last known values. Default: {get_default_monitor_timeout()}",
+        show_default=False
+    )] = None,
+
+    anomaly_detection: Annotated[AnomalyDetection, typer.Option(
+        help="Detect values that deviate from their learned behavior, and report a `warning` or `error` status when they do. `ewma` learns from recent values. `seasonal` learns from the values sampled at the same hour of the day.",
+        show_default=False
+    )] = None,
+
+    history: Annotated[Optional[Path], typer.Option(
+        help="Store sampled values in a fixed-size history file. History may be queried from the agent's `/query/` endpoint.",
+        show_default=False
+    )] = None,
+
     write_config: Annotated[bool, typer.Option(
         help="Write all options to configuration file."
     )] = False,
     dry_run: Annotated[bool, typer.Option(
         help="Emit the action that will take place, with the specified parameters, w/o sending data to @ys."
     )] = False,
+    bench: Annotated[int, typer.Option(
+        help="With `--dry-run`, run the pipeline (load the config, sample the monitors, build and serialize the payload) this many times, and report the time, memory and payload size of each run.",
+        show_default=False
+    )] = None,
+    record: Annotated[Optional[Path], typer.Option(
+        help="Record the values of each tick to a trace file, which can be replayed with the `replay` command.",
+        show_default=False
+    )] = None,
+    ctx: typer.Context = None
 ) -> None:
-    # Do not load options if writing new config. This prevents old options from
-    # being merged with the new.
-    if write_config:
-        options = lib.get_empty_options()
-    else:
-        # Load options from disk, if any
-        options = lib.load_options()
-    # Merge options provided
-    options.merge(
+    # Options of the agent do not apply to commands, e.g. `relay`
+    if ctx is not None and ctx.invoked_subcommand is not None:
+        return
+
+    cli_args = dict(
         org_secret=org_secret,
         server=server,
         interval=interval,
@@ -231,13 +576,29 @@ def main(
         status_state=status_state,
         monitor_resources=monitor_resources,
         monitor_file=monitor_file,
-        monitor_program=monitor_program
+        monitor_program=monitor_program,
+        cgroups=cgroups,
+        psi_triggers=psi_triggers,
+        monitor_timeout=monitor_timeout,
+        disk_mounts=disk_mounts,
+        history=history,
+        min_interval=min_interval,
+        anomaly_detection=anomaly_detection,
+        log_files=log_files,
+        log_patterns=log_patterns,
+        probe_endpoints=probe_endpoints,
+        sock_ports=sock_ports,
+        statsd_listen=statsd_listen,
+        quantiles=quantiles,
+        max_rss=max_rss,
+        max_cpu=max_cpu,
+        send_rate=send_rate,
+        shards=shards,
+        directories=directories,
+        otlp_endpoint=otlp_endpoint,
+        export_dir=export_dir
     )
-
-    if not options.server:
-        options.server = get_default_server()
-    if not options.monitor_name:
-        options.monitor_name = get_hostname()
+    options = get_options(cli_args, write_config)
 
     # Ensure options are valid. This must happen regardless if CLI options are
     # provided or not as the user may write invalid config to the config file.
@@ -249,78 +610,105 @@ def main(
         print("[green]Saved configuration to disk successfully.[/green]")
         raise typer.Exit()
 
-    if (monitor_resources or monitor_program or monitor_file) and not options.interval:
-        # Default is 5 minutes
-        options.interval = 60 * 5
-    if options.interval is not None and options.interval < 15:
-        raise lib.AgentException("Interval provided ({options.interval}) must be 15 seconds or greater")
+    if bench is not None and (not dry_run or bench < 1):
+        raise lib.AgentException("'bench' must be 1 or greater, and may only be provided with 'dry_run'")
+
+    # Counter baselines are not persisted on a dry run, or when benchmarking,
+    # as the samples are not reported. Doing so would replace the baselines of
+    # the running agent.
+    store = get_counter_store() if options.monitor_resources and not bench and not dry_run else None
+    config = get_agent_config(options, store)
 
     if dry_run:
         print(f"Server: [green]{server}[/green]")
 
-    if monitor_resources:
-        resources = lib.strip_v(monitor_resources)
-        for res in resources:
-            if res not in MonitorResource.__members__:
-                raise lib.AgentException(f"Invalid monitor resource ({res}). Available options are ({', '.join(MonitorResource.__members__)}).")
-        monitor_options = monitor_resources.split(",")
-        # Get class defintions of monitors to use
-        if MonitorResource.all in monitor_options:
-            monitors = RESOURCE_MONITORS.values()
-        else:
-            monitors = list(map(lambda x: RESOURCE_MONITORS[x], monitor_options))
-        # Instantiate and start monitors
-        monitors = list(map(lambda x: x(), monitors))
-        for m in monitors: m.start()
-
-        def get_message():
-            values = []
-            for monitor in monitors:
-                # NOTE: This doesn't provide thresholds for values. If thresholds
-                # are required, use the `com.bithead.template.agent_resources`
-                # template.
-                values.extend(monitor.get_values(options.interval))
-            msg["values"] = values
-            return msg
+    if bench:
+        agent = Agent(config, send=post_request, monitor_timeout=options.monitor_timeout or get_default_monitor_timeout())
+
+        def load_config() -> None:
+            # The config is loaded and validated as it is when reloaded. Its
+            # monitors are not used.
+            for monitor in get_agent_config(get_options(cli_args)).monitors.values():
+                stop_monitor(monitor)
+
+        result = bench_agent(agent, load_config, bench)
+        for monitor in config.monitors.values():
+            stop_monitor(monitor)
+        print(f"Ran pipeline {bench} times")
+        for name, samples in result["timings"].items():
+            print(format_timings(name, samples))
+        sizes = get_percentiles(result["sizes"])
+        print(f"{'payload':<12}p50 {sizes['p50']}B  max {sizes['max']}B")
+        allocated = get_percentiles(result["allocated"])
+        print(f"{'allocated':<12}p50 {allocated['p50'] / 1024:.1f}KB  max {allocated['max'] / 1024:.1f}KB  retained {result['retained'] / 1024:.1f}KB")
+        raise typer.Exit()
 
+    def run_agent(description: str) -> None:
+        # Monitors are called from worker threads, so that a hung monitor
+        # doesn't block the agent. The config file is reloaded, without
+        # restarting the agent, when it changes. Messages are sent, most urgent
+        # first, from a send queue. Values are also exported to other sinks,
+        # e.g. OTLP or columnar segments, if configured.
         if dry_run:
-            print(f"Monitor resources: ({monitor_resources}) every {options.interval}s")
-            print(get_message())
+            # Nothing is recorded, e.g. to a trace or the history, on a dry run
+            agent = Agent(config, send=post_request, monitor_timeout=options.monitor_timeout or get_default_monitor_timeout())
+            print(f"{description} every {options.interval}s")
+            print(agent.get_message())
             raise typer.Exit()
 
+        send_queue = SendQueue(post_request, rate=options.send_rate or SEND_RATE, burst=max(SEND_BURST, int(options.send_rate or 0)))
+        sinks = [OtlpSink(options.otlp_endpoint)] if options.otlp_endpoint else []
+        if options.export_dir:
+            sinks.append(SegmentWriter(options.export_dir))
+        agent = Agent(
+            config,
+            send=post_request,
+            load_config=lambda: get_agent_config(get_options(cli_args), store),
+            config_path=lib.get_config_path(),
+            monitor_timeout=options.monitor_timeout or get_default_monitor_timeout(),
+            history=SampleStore(str(options.history)) if options.history else None,
+            recorder=TraceWriter(str(record), get_trace_header(config)) if record else None,
+            queue=send_queue,
+            sinks=sinks
+        )
+        fastapp.state.store = agent.history
+        fastapp.state.queue = send_queue
+        fastapp.state.sinks = sinks
+
         @fastapp.on_event("startup")
-        @repeat_every(seconds=options.interval)
-        async def run_forever() -> None:
-            m = get_message()
-            send_request(server, m)
+        def run_forever() -> None:
+            send_queue.start()
+            for sink in sinks:
+                sink.start()
+            agent.start()
+
+        @fastapp.on_event("shutdown")
+        def stop_agent() -> None:
+            agent.stop()
+            send_queue.stop()
+            for sink in sinks:
+                sink.stop()
 
         uvicorn.run(fastapp, host="0.0.0.0", port=port)
-    elif monitor_program:
+
+    if options.monitor_resources:
+        run_agent(f"Monitor resources: ({options.monitor_resources})")
+    elif options.monitor_program:
         # TODO: Execute program
 
         if dry_run:
-            print(f"Monitor program: ({monitor_program}) every {options.interval}s")
+            print(f"Monitor program: ({options.monitor_program}) every {options.interval}s")
             print(msg)
             raise typer.Exit()
-    elif monitor_file:
+    elif options.monitor_file:
         # TODO: Monitor file
 
         if dry_run:
-            print(f"Monitor file: ({monitor_file}) every {options.interval}s")
+            print(f"Monitor file: ({options.monitor_file}) every {options.interval}s")
             print(msg)
             raise typer.Exit()
     elif options.interval:
-        if dry_run:
-            print(f"Sending message every {options.interval}s")
-            print(msg)
-            raise typer.Exit()
-
-        @fastapp.on_event("startup")
-        @repeat_every(seconds=options.interval)
-        async def run_forever() -> None:
-            send_request(server, msg)
-
-        uvicorn.run(fastapp, host="0.0.0.0", port=port)
+        run_agent("Sending message")
     else:
         if dry_run:
             print(f"One-shot")
@@ -328,3 +716,102 @@ def main(
             raise typer.Exit()
 
         send_request(server, msg)
+
+@app.command()
+def relay(
+    server: Annotated[str, typer.Option(
+        help=f"Path to the upstream @ys server agent endpoint, or relay. Provide a comma delimited list of endpoints to fail over to when an endpoint is unavailable. Default: {get_default_server()}"
+    )] = None,
+    port: Annotated[int, typer.Option(
+        help="The port the relay listens to. Agents post to `http://<relay>:<port>/agent/`."
+    )] = 9555,
+    spool: Annotated[Optional[Path], typer.Option(
+        help="Directory where batches that could not be forwarded are stored, until upstream recovers. If not provided, these batches are dropped.",
+        show_default=False
+    )] = None,
+    upstream_relay: Annotated[bool, typer.Option(
+        help="The upstream `--server` is another relay. Payloads are forwarded in batches, rather than one per request."
+    )] = False
+) -> None:
+    """ Relay payloads from agents on the local network to @ys. """
+    relay = Relay(server or get_default_server(), spool=Spool(str(spool)) if spool else None, upstream_relay=upstream_relay)
+    fastapp.state.relay = relay
+
+    @fastapp.on_event("startup")
+    def start_relay() -> None:
+        relay.start()
+
+    @fastapp.on_event("shutdown")
+    def stop_relay() -> None:
+        relay.stop()
+
+    uvicorn.run(fastapp, host="0.0.0.0", port=port)
+
+@app.command()
+def replay(
+    trace: Annotated[Path, typer.Argument(
+        help="Trace recorded with `--record`.",
+        exists=True,
+        dir_okay=False
+    )],
+    repeat: Annotated[int, typer.Option(
+        help="Number of times the trace is replayed."
+    )] = 1,
+    send_rate: Annotated[float, typer.Option(
+        help="Maximum messages sent per second by the send queue. Default: unlimited",
+        show_default=False
+    )] = None,
+    otlp_endpoint: Annotated[str, typer.Option(
+        help="OTLP/HTTP metrics endpoint the values of each tick are also exported to.",
+        show_default=False
+    )] = None,
+    export_dir: Annotated[str, typer.Option(
+        help="Directory the values of each tick are also exported to, as hourly Arrow IPC segments. Requires `pyarrow`.",
+        show_default=False
+    )] = None
+) -> None:
+    """ Replay a trace through the report pipeline as fast as possible, and report its throughput and latency. """
+    if send_rate is not None and send_rate <= 0:
+        raise lib.AgentException(f"Send rate provided ({send_rate}) must be greater than 0")
+    sinks = [OtlpSink(otlp_endpoint)] if otlp_endpoint else []
+    if export_dir:
+        sinks.append(SegmentWriter(export_dir))
+    result = replay_trace(str(trace), post_request, repeat, rate=send_rate or REPLAY_SEND_RATE, sinks=sinks)
+    ticks, elapsed = result["ticks"], result["elapsed"]
+    print(f"Replayed {ticks} ticks, recorded over {result['recorded']:.0f}s, in {elapsed:.3f}s ({ticks / elapsed if elapsed else 0:.0f} ticks/sec)")
+    for name, samples in result["timings"].items():
+        print(format_timings(name, samples))
+    classes = result["queue"]["classes"]
+    print(f"{'queue':<12}" + "  ".join(f"{name} {c['sent']} sent, {c['dropped']} dropped" for name, c in classes.items()) + f"  ({result['queue']['failed']} failed)")
+    sizes = get_percentiles(result["sizes"])
+    if sizes:
+        print(f"{'payload':<12}p50 {sizes['p50']}B  max {sizes['max']}B")
+
+@segments_app.command("list")
+def list_segments(
+    directory: Annotated[Path, typer.Argument(
+        help="Directory provided to `--export-dir`.",
+        exists=True,
+        file_okay=False
+    )]
+) -> None:
+    """ List the segments, and the number of rows and time range of each. """
+    for segment in export.list_segments(str(directory)):
+        start = segment["start"].isoformat() if segment["start"] else "-"
+        end = segment["end"].isoformat() if segment["end"] else "-"
+        print(f"{os.path.basename(segment['path']):<28}{segment['rows']:>10} rows {segment['size'] / 1024:>10.1f}KB  {start}  {end}")
+
+@segments_app.command("compact")
+def compact_segments(
+    directory: Annotated[Path, typer.Argument(
+        help="Directory provided to `--export-dir`.",
+        exists=True,
+        file_okay=False
+    )]
+) -> None:
+    """ Merge the hourly segments of each complete day (in UTC) into a single segment, sorted by node, name and time. """
+    compacted = export.compact_segments(str(directory))
+    for day, rows in compacted.items():
+        print(f"Compacted ({day}) into ({rows}) rows")
+    if not compacted:
+        print("No segments to compact")
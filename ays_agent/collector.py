@@ -0,0 +1,183 @@
+#
+# Collects values from monitors in a pool of worker threads.
+#
+# A monitor that hangs (e.g. `statvfs` on a hung NFS mount) or raises only
+# affects its own values. Its last known values are reported, flagged as
+# `stale`, until it recovers.
+#
+
+import logging
+import queue
+import threading
+import time
+
+from concurrent import futures
+from typing import List
+from typing_extensions import Optional
+
+class CircuitBreaker(object):
+    """ Opens after `max_failures` consecutive failures.
+
+    Once opened, calls are rejected until `cooldown` seconds have passed.
+    Then a single call is allowed through (half-open). The breaker closes if
+    the call succeeds, and re-opens if it fails.
+    """
+
+    def __init__(self, max_failures: int = 3, cooldown: float = 300):
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def allow(self, now: Optional[float] = None) -> bool:
+        """ Returns `True` if a call may be made. """
+        if self.opened_at is None:
+            return True
+        now = time.monotonic() if now is None else now
+        return now - self.opened_at >= self.cooldown
+
+    def success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+
+    def failure(self, now: Optional[float] = None) -> None:
+        self.failures += 1
+        if self.failures >= self.max_failures:
+            self.opened_at = time.monotonic() if now is None else now
+
+class WorkerPool(object):
+    """ A fixed pool of daemon threads.
+
+    Unlike `ThreadPoolExecutor`, a task that never returns does not prevent
+    the agent from exiting.
+    """
+
+    def __init__(self, size: int):
+        self.tasks = queue.SimpleQueue()
+        self.threads = []
+        self.resize(size)
+
+    def resize(self, size: int) -> None:
+        """ Grow the pool to `size` threads. The pool never shrinks. """
+        for i in range(len(self.threads), size):
+            thread = threading.Thread(target=self.run, name=f"ays-collector-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def run(self) -> None:
+        while True:
+            future, fn, args = self.tasks.get()
+            # Skip tasks that were cancelled while waiting in the queue
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = fn(*args)
+            except BaseException as exc:
+                future.set_exception(exc)
+            else:
+                future.set_result(result)
+
+    def submit(self, fn, *args) -> futures.Future:
+        future = futures.Future()
+        self.tasks.put((future, fn, args))
+        return future
+
+class MonitorState(object):
+    """ Collection state of a single monitor. """
+
+    def __init__(self, monitor, breaker: CircuitBreaker):
+        self.monitor = monitor
+        self.breaker = breaker
+        # Call to `get_values` that has yet to finish, if any
+        self.future = None
+        self.deadline = None
+        # Values from the last successful call
+        self.values = []
+
+class Collector(object):
+    def __init__(self, monitors: list, timeout: float = 10, max_failures: int = 3, cooldown: float = 300):
+        # Default time, in seconds, a monitor has to return its values. A
+        # monitor may provide its own `timeout` attribute.
+        self.timeout = timeout
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.states = [MonitorState(m, CircuitBreaker(max_failures, cooldown)) for m in monitors]
+        # A hung monitor is not called again until its last call returns.
+        # Therefore, it can occupy at most one thread.
+        self.pool = WorkerPool(max(len(monitors), 1))
+
+    def set_monitors(self, monitors: list) -> None:
+        """ Replace the monitors to collect from.
+
+        Monitors that were already being collected from keep their state.
+        """
+        states = {id(state.monitor): state for state in self.states}
+        self.states = [
+            states.get(id(m)) or MonitorState(m, CircuitBreaker(self.max_failures, self.cooldown))
+            for m in monitors
+        ]
+        self.pool.resize(len(monitors))
+
+    def get_timeout(self, monitor) -> float:
+        return getattr(monitor, "timeout", None) or self.timeout
+
+    def collect(self, delay: int) -> List[dict]:
+        """ Get the values of all monitors.
+
+        Monitors are called concurrently. Monitors that do not return before
+        their deadline, raise, or whose circuit breaker is open, report their
+        last known values with `stale` set.
+        """
+        now = time.monotonic()
+        for state in self.states:
+            if state.future is not None and state.deadline is None and state.future.done():
+                # A call that missed its deadline has since returned. Its
+                # values are discarded, as they are from an earlier tick.
+                state.future = None
+            if state.future is not None or not state.breaker.allow(now):
+                continue
+            state.deadline = now + self.get_timeout(state.monitor)
+            state.future = self.pool.submit(state.monitor.get_values, delay)
+
+        values = []
+        for state in self.states:
+            fresh = False
+            if state.future is not None and state.deadline is not None:
+                fresh = self.wait(state)
+            elif state.future is not None:
+                # Still hung from an earlier tick
+                state.breaker.failure()
+            if fresh:
+                values.extend(state.values)
+            else:
+                values.extend(dict(v, stale=True) for v in state.values)
+        return values
+
+    def wait(self, state: MonitorState) -> bool:
+        """ Wait for a monitor to return its values before its deadline.
+
+        @returns `True` if the monitor returned new values
+        """
+        name = type(state.monitor).__name__
+        try:
+            state.values = state.future.result(timeout=max(state.deadline - time.monotonic(), 0))
+        except futures.TimeoutError:
+            # The deadline only applies to the tick the call was made in. If
+            # the call is still queued, it will never run.
+            state.deadline = None
+            if state.future.cancel():
+                state.future = None
+            state.breaker.failure()
+            logging.warning(f"{name} did not return values within {self.get_timeout(state.monitor)}s")
+            return False
+        except Exception:
+            state.future = None
+            state.breaker.failure()
+            logging.exception(f"{name} failed to return values")
+            return False
+        state.future = None
+        state.breaker.success()
+        return True
@@ -0,0 +1,420 @@
+#
+# Export samples to columnar segment files.
+#
+# Every value reported is appended to an hourly segment, an Arrow IPC file
+# with the schema `time, node, name, value, level`. Segments are compressed,
+# and can be read by analytics tools (pyarrow, pandas, polars, DuckDB, etc.)
+# without parsing. Segments of complete days can be compacted into a single
+# daily segment, sorted by node, name and time, which compresses better and
+# is faster to read.
+#
+# Requires `pyarrow`, which is an optional dependency.
+#
+
+import calendar
+import collections
+import logging
+import os
+import re
+import threading
+import time
+
+from typing import Dict, List, Optional
+
+from ays_agent import AgentException, get_node_path
+from ays_agent.sender import is_breach
+
+# Hourly segments are named `ays-YYYYMMDDTHH.arrow`, and daily segments
+# `ays-YYYYMMDD.arrow`. A segment of an hour the agent was restarted in has a
+# `-N` suffix. Times are in UTC.
+SEGMENT_NAME = re.compile(r"^ays-(\d{8})(?:T(\d{2}))?(?:-\d+)?\.arrow$")
+
+# Suffix of the segment being written. Renamed when the hour ends.
+PARTIAL_SUFFIX = ".partial"
+
+# Maximum number of rows buffered before they are written
+BATCH_ROWS = 4096
+
+# Maximum time, in seconds, rows are buffered before they are written
+FLUSH_INTERVAL = 60
+
+# Maximum number of rows buffered until they are written. The oldest rows are
+# dropped first.
+MAX_PENDING_ROWS = 100000
+
+# Number of rows per record batch of a compacted segment
+COMPACT_BATCH_ROWS = 64 * 1024
+
+COMPRESSION = "zstd"
+
+def get_pyarrow():
+    """ Returns the `pyarrow` module. """
+    try:
+        import pyarrow
+        import pyarrow.compute
+        import pyarrow.ipc
+    except ImportError:
+        raise AgentException("Columnar export requires `pyarrow`. Install it with `pip install ays-agent[arrow]`")
+    return pyarrow
+
+def get_schema(pa):
+    return pa.schema([
+        ("time", pa.timestamp("ms", tz="UTC")),
+        ("node", pa.string()),
+        ("name", pa.string()),
+        ("value", pa.float64()),
+        # Level of the threshold the value breached, if any
+        ("level", pa.string())
+    ])
+
+def get_level(value: dict) -> Optional[str]:
+    """ Returns the level of the threshold a value breached, if any. """
+    threshold = value.get("threshold")
+    if threshold and is_breach(threshold, value["value"]):
+        return threshold.get("level")
+    return None
+
+def get_segment_paths(directory: str) -> List[str]:
+    """ Returns the paths of the complete segments in a directory, oldest first. """
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    return [os.path.join(directory, name) for name in sorted(names) if SEGMENT_NAME.match(name)]
+
+def get_segment_day(path: str) -> str:
+    """ Returns the day, `YYYYMMDD`, of a segment. """
+    return SEGMENT_NAME.match(os.path.basename(path)).group(1)
+
+def is_daily_segment(path: str) -> bool:
+    return SEGMENT_NAME.match(os.path.basename(path)).group(2) is None
+
+def read_segment(path: str):
+    """ Returns the table of a segment.
+
+    The segment is memory-mapped. The buffers of uncompressed columns are not
+    copied.
+    """
+    pa = get_pyarrow()
+    return pa.ipc.open_file(pa.memory_map(path)).read_all()
+
+def read_segments(directory: str, start: Optional[float] = None, end: Optional[float] = None):
+    """ Returns the samples of all segments, optionally between `start` and `end` (in seconds). """
+    pa = get_pyarrow()
+    tables = []
+    for path in get_segment_paths(directory):
+        day = get_segment_day(path)
+        day_start = calendar.timegm(time.strptime(day, "%Y%m%d"))
+        if (start is not None and day_start + 86400 <= start) or (end is not None and day_start > end):
+            # Segment is outside the range
+            continue
+        tables.append(read_segment(path))
+    if not tables:
+        return get_schema(pa).empty_table()
+    table = pa.concat_tables(tables)
+    if start is not None or end is not None:
+        pc = pa.compute
+        times = table["time"].cast(pa.int64())
+        mask = None
+        if start is not None:
+            mask = pc.greater_equal(times, int(start * 1000))
+        if end is not None:
+            upper = pc.less_equal(times, int(end * 1000))
+            mask = upper if mask is None else pc.and_(mask, upper)
+        table = table.filter(mask)
+    return table
+
+def list_segments(directory: str) -> List[dict]:
+    """ Returns the path, size, number of rows, and time range of each segment. """
+    pa = get_pyarrow()
+    segments = []
+    for path in get_segment_paths(directory):
+        table = read_segment(path)
+        times = table["time"]
+        segments.append({
+            "path": path,
+            "size": os.path.getsize(path),
+            "rows": table.num_rows,
+            "start": pa.compute.min(times).as_py() if table.num_rows else None,
+            "end": pa.compute.max(times).as_py() if table.num_rows else None
+        })
+    return segments
+
+def write_table(path: str, table, compression: str = COMPRESSION, batch_rows: int = COMPACT_BATCH_ROWS) -> None:
+    """ Write a table to a segment, atomically. """
+    pa = get_pyarrow()
+    partial = path + PARTIAL_SUFFIX
+    options = pa.ipc.IpcWriteOptions(compression=compression)
+    with pa.OSFile(partial, "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema, options=options) as writer:
+            writer.write_table(table, max_chunksize=batch_rows)
+    os.replace(partial, path)
+
+def compact_segments(directory: str, compression: str = COMPRESSION, now: Optional[float] = None) -> Dict[str, int]:
+    """ Merge the hourly segments of each complete day (in UTC) into a daily segment.
+
+    A daily segment that already exists is merged with the day's hourly
+    segments, e.g. when samples were recorded after the day was compacted.
+
+    @returns number of rows of each daily segment that was written
+    """
+    today = time.strftime("%Y%m%d", time.gmtime(time.time() if now is None else now))
+    days = {}
+    for path in get_segment_paths(directory):
+        day = get_segment_day(path)
+        if day < today:
+            days.setdefault(day, []).append(path)
+    pa = get_pyarrow()
+    compacted = {}
+    for day, paths in days.items():
+        if len(paths) == 1 and is_daily_segment(paths[0]):
+            continue
+        table = pa.concat_tables([read_segment(path) for path in paths])
+        table = table.sort_by([("node", "ascending"), ("name", "ascending"), ("time", "ascending")])
+        target = os.path.join(directory, f"ays-{day}.arrow")
+        write_table(target, table, compression)
+        for path in paths:
+            if path != target:
+                os.remove(path)
+        compacted[day] = table.num_rows
+    return compacted
+
+def recover_segment(path: str) -> Optional[str]:
+    """ Save the record batches of a segment that was not closed, e.g. because the agent was killed.
+
+    @returns the path of the recovered segment, or `None` if it had no complete batches
+    """
+    pa = get_pyarrow()
+    batches = []
+    with open(path, "rb") as fh:
+        data = fh.read()
+    try:
+        # An IPC file is the IPC stream, between a magic prefix and a footer
+        reader = pa.ipc.open_stream(pa.py_buffer(data[8:]))
+        while True:
+            batches.append(reader.read_next_batch())
+    except StopIteration:
+        pass
+    except (pa.ArrowInvalid, OSError):
+        # The last batch was partially written
+        pass
+    os.remove(path)
+    if not batches:
+        return None
+    target = get_available_path(path[:-len(PARTIAL_SUFFIX)])
+    write_table(target, pa.Table.from_batches(batches))
+    return target
+
+def get_available_path(path: str) -> str:
+    """ Returns a path, with a `-N` suffix if the path, or its partial segment, already exists. """
+    base, ext = os.path.splitext(path)
+    candidate = path
+    n = 1
+    while os.path.exists(candidate) or os.path.exists(candidate + PARTIAL_SUFFIX):
+        candidate = f"{base}-{n}{ext}"
+        n += 1
+    return candidate
+
+class SegmentWriter(object):
+    """ Appends the values of each tick to hourly segments.
+
+    Values are buffered by `put`, which is called by the agent, and written
+    from a background thread, so that encoding and writing record batches
+    (and a full disk) never delay a report.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        compression: str = COMPRESSION,
+        batch_rows: int = BATCH_ROWS,
+        flush_interval: float = FLUSH_INTERVAL,
+        max_pending: int = MAX_PENDING_ROWS
+    ):
+        """
+        @param batch_rows number of rows buffered before they are written
+        @param flush_interval time, in seconds, rows are buffered before they are written
+        @param max_pending maximum number of rows buffered. The oldest rows are dropped first.
+        """
+        self.pa = get_pyarrow()
+        self.directory = directory
+        self.schema = get_schema(self.pa)
+        self.options = self.pa.ipc.IpcWriteOptions(compression=compression)
+        self.batch_rows = batch_rows
+        self.flush_interval = flush_interval
+        # Hour (`YYYYMMDDTHH`), time, node, name, value and level of each row
+        self.pending = collections.deque(maxlen=max_pending)
+        self.cond = threading.Condition()
+        self.stopped = threading.Event()
+        # Set when stopping, to write pending rows without waiting
+        self.flushing = False
+        self.thread = None
+        # Hour and path of the segment being written. Only used by the
+        # writer thread, or once it has stopped.
+        self.hour = None
+        self.path = None
+        self.sink = None
+        self.writer = None
+        self.rows = 0
+        self.segments = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def put(self, msg: dict, now: Optional[float] = None) -> bool:
+        """ Buffer the values of a message to be written. Stale values are not exported.
+
+        @returns `True` if the message had values
+        """
+        values = msg.get("values") or ([msg["value"]] if "value" in msg else [])
+        now = time.time() if now is None else now
+        hour = time.strftime("%Y%m%dT%H", time.gmtime(now))
+        timestamp = int(now * 1000)
+        node = get_node_path(msg)
+        rows = [
+            (hour, timestamp, node, v["name"], float(v["value"]), get_level(v))
+            for v in values
+            if not v.get("stale") and isinstance(v.get("value"), (int, float))
+        ]
+        if not rows:
+            return False
+        with self.cond:
+            overflow = len(self.pending) + len(rows) - self.pending.maxlen
+            if overflow > 0:
+                self.dropped += min(overflow, len(self.pending))
+            self.pending.extend(rows)
+            if len(self.pending) >= self.batch_rows:
+                self.cond.notify()
+        return True
+
+    def get_rows(self) -> list:
+        """ Wait until rows are due to be written.
+
+        @returns the buffered rows, or an empty list if the writer was stopped
+        """
+        with self.cond:
+            deadline = time.monotonic() + self.flush_interval
+            while not self.stopped.is_set() and len(self.pending) < self.batch_rows:
+                remaining = deadline - time.monotonic()
+                if self.pending and (remaining <= 0 or self.flushing):
+                    break
+                self.cond.wait(remaining if remaining > 0 else 1)
+            if self.stopped.is_set():
+                return []
+            rows = list(self.pending)
+            self.pending.clear()
+            return rows
+
+    def open_segment(self) -> None:
+        path = os.path.join(self.directory, f"ays-{self.hour}.arrow")
+        self.path = get_available_path(path)
+        self.sink = self.pa.OSFile(self.path + PARTIAL_SUFFIX, "wb")
+        self.writer = self.pa.ipc.new_file(self.sink, self.schema, options=self.options)
+
+    def close_segment(self) -> None:
+        if self.writer is None:
+            return
+        writer, sink = self.writer, self.sink
+        self.writer = self.sink = None
+        writer.close()
+        sink.close()
+        os.replace(self.path + PARTIAL_SUFFIX, self.path)
+        self.segments += 1
+
+    def abandon_segment(self) -> None:
+        """ Stop writing to a segment that failed to be written.
+
+        The segment is left partial. Its complete record batches are recovered
+        when the writer is next started.
+        """
+        writer, sink = self.writer, self.sink
+        self.writer = self.sink = None
+        for f in (writer, sink):
+            try:
+                if f is not None:
+                    f.close()
+            except Exception:
+                pass
+
+    def write_rows(self, rows: list) -> None:
+        """ Write rows, in order, to the segment of their hour. """
+        start = 0
+        while start < len(rows):
+            hour = rows[start][0]
+            end = start
+            while end < len(rows) and rows[end][0] == hour:
+                end += 1
+            if hour != self.hour:
+                self.close_segment()
+                self.hour = hour
+            if self.writer is None:
+                self.open_segment()
+            columns = list(zip(*rows[start:end]))[1:]
+            batch = self.pa.record_batch([
+                self.pa.array(column, type=field.type) for column, field in zip(columns, self.schema)
+            ], schema=self.schema)
+            self.writer.write_batch(batch)
+            with self.cond:
+                self.rows += batch.num_rows
+            start = end
+
+    def write(self, rows: list) -> None:
+        try:
+            self.write_rows(rows)
+        except OSError as exc:
+            # e.g. the disk is full. The rows are dropped, rather than
+            # buffered, as the disk is unlikely to have room soon.
+            logging.error(f"Failed to write ({len(rows)}) rows to segment ({self.path}): {exc}")
+            self.abandon_segment()
+            self.hour = None
+            with self.cond:
+                self.failed += 1
+                self.dropped += len(rows)
+
+    def run_forever(self) -> None:
+        while True:
+            rows = self.get_rows()
+            if not rows:
+                return
+            self.write(rows)
+
+    def get_stats(self) -> dict:
+        """ Returns the metrics of the writer. """
+        with self.cond:
+            return {
+                "directory": self.directory,
+                "segment": self.path if self.writer is not None else None,
+                "pending": len(self.pending),
+                "rows": self.rows,
+                "segments": self.segments,
+                "dropped": self.dropped,
+                "failed": self.failed
+            }
+
+    def start(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        for name in os.listdir(self.directory):
+            if name.endswith(PARTIAL_SUFFIX) and SEGMENT_NAME.match(name[:-len(PARTIAL_SUFFIX)]):
+                path = recover_segment(os.path.join(self.directory, name))
+                logging.info(f"Recovered segment ({name}) as ({path})")
+        self.thread = threading.Thread(target=self.run_forever, name="ays-export", daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout: float = 5) -> None:
+        """ Stop writing, after waiting up to `timeout` seconds for pending rows to be written, and close the segment. """
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            # Write pending rows now, rather than at the end of the flush interval
+            self.flushing = True
+            self.cond.notify_all()
+        while self.thread is not None and self.pending and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.stopped.set()
+        with self.cond:
+            self.cond.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+        try:
+            self.close_segment()
+        except OSError as exc:
+            logging.error(f"Failed to close segment ({self.path}): {exc}")
+            self.abandon_segment()
@@ -0,0 +1,266 @@
+#
+# Export values to an OpenTelemetry collector over OTLP/HTTP.
+#
+# Values are exported as gauges, in the protobuf encoding of
+# `ExportMetricsServiceRequest`. The messages are small and fixed, so they are
+# encoded by hand, rather than requiring `protobuf` and the OTLP definitions.
+#
+# The sink is fed the same message that is reported to @ys, once per tick. It
+# keeps the values, batches the ticks, and exports them from a background
+# thread, retrying with an exponential delay if the collector is unavailable.
+#
+
+import collections
+import logging
+import struct
+import threading
+import time
+
+from typing import Dict, List, Tuple
+from typing_extensions import Optional
+
+import ays_agent as lib
+
+from ays_agent.transport import EndpointPool, parse_servers
+
+# Wire types
+VARINT = 0
+FIXED64 = 1
+LENGTH = 2
+
+FIXED64_VALUE = struct.Struct("<Q")
+DOUBLE_VALUE = struct.Struct("<d")
+
+# Maximum number of ticks kept until they are exported. The oldest ticks are
+# dropped first.
+MAX_PENDING = 1000
+
+# Maximum number of ticks exported per request
+MAX_BATCH = 100
+
+# Time, in seconds, ticks are batched before they are exported
+FLUSH_INTERVAL = 5
+
+# Maximum time, in seconds, to wait before retrying a failed export
+MAX_RETRY_DELAY = 30
+
+# Responses of a collector that is temporarily unavailable. Batches rejected
+# with other statuses are dropped, as they would be rejected again.
+RETRYABLE_STATUS = [429, 502, 503, 504]
+
+SCOPE_NAME = "ays-agent"
+
+def encode_varint(value: int) -> bytes:
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+def encode_tag(field: int, wire_type: int) -> bytes:
+    return encode_varint((field << 3) | wire_type)
+
+def encode_message(field: int, data: bytes) -> bytes:
+    """ Encode a length delimited field, i.e. a nested message, string or bytes. """
+    return encode_tag(field, LENGTH) + encode_varint(len(data)) + data
+
+def encode_string(field: int, value: str) -> bytes:
+    return encode_message(field, value.encode())
+
+def encode_fixed64(field: int, value: int) -> bytes:
+    return encode_tag(field, FIXED64) + FIXED64_VALUE.pack(value)
+
+def encode_double(field: int, value: float) -> bytes:
+    return encode_tag(field, FIXED64) + DOUBLE_VALUE.pack(value)
+
+def encode_attribute(key: str, value: str) -> bytes:
+    """ Encode a `KeyValue` with a string `AnyValue`. """
+    return encode_string(1, key) + encode_message(2, encode_string(1, value))
+
+def encode_data_point(time_ns: int, value: float) -> bytes:
+    """ Encode a `NumberDataPoint`. """
+    return encode_fixed64(3, time_ns) + encode_double(4, value)
+
+def encode_metric(name: str, points: List[Tuple[int, float]]) -> bytes:
+    """ Encode a `Metric` with a `Gauge` of data points. """
+    gauge = b"".join(encode_message(1, encode_data_point(t, v)) for t, v in points)
+    return encode_string(1, name) + encode_message(5, gauge)
+
+def encode_request(batches: List[Tuple[tuple, Dict[str, List[Tuple[int, float]]]]]) -> bytes:
+    """ Encode an `ExportMetricsServiceRequest`.
+
+    @param batches list of resource attributes, and the data points of each metric
+    """
+    scope = encode_string(1, SCOPE_NAME) + encode_string(2, lib.get_version())
+    out = []
+    for attributes, metrics in batches:
+        resource = b"".join(encode_message(1, encode_attribute(k, v)) for k, v in attributes)
+        scope_metrics = encode_message(1, scope) + b"".join(
+            encode_message(2, encode_metric(name, points)) for name, points in metrics.items()
+        )
+        out.append(encode_message(1, encode_message(1, resource) + encode_message(2, scope_metrics)))
+    return b"".join(out)
+
+def get_resource_attributes(msg: dict) -> tuple:
+    """ Returns the OpenTelemetry resource attributes of the node a message reports to. """
+    attributes = [("service.name", SCOPE_NAME)]
+    relationship = msg.get("relationship", {})
+    if relationship.get("monitor_name"):
+        attributes.append(("host.name", relationship["monitor_name"]))
+    path = lib.get_node_path(msg)
+    if path:
+        attributes.append(("ays.node", path))
+    return tuple(attributes)
+
+class OtlpSink(object):
+    def __init__(
+        self,
+        endpoint: str,
+        max_pending: int = MAX_PENDING,
+        max_batch: int = MAX_BATCH,
+        flush_interval: float = FLUSH_INTERVAL,
+        pool: Optional[EndpointPool] = None
+    ):
+        """
+        @param endpoint OTLP/HTTP metrics endpoint, e.g. `http://localhost:4318/v1/metrics`. May be a comma delimited list of endpoints to fail over to.
+        @param flush_interval time, in seconds, ticks are batched before they are exported
+        """
+        self.endpoint = endpoint
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.pool = pool or EndpointPool(parse_servers(endpoint))
+        # Resource attributes, time and values of each tick
+        self.pending = collections.deque(maxlen=max_pending)
+        self.cond = threading.Condition()
+        self.stopped = threading.Event()
+        # Set when stopping, to export pending ticks without waiting
+        self.flushing = False
+        self.thread = None
+        self.failures = 0
+        self.exported = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def put(self, msg: dict) -> bool:
+        """ Keep the values of a message to be exported.
+
+        The message is reused by the agent, so only the values are kept. Stale
+        values are not exported.
+
+        @returns `True` if the message had values
+        """
+        values = msg.get("values") or ([msg["value"]] if "value" in msg else [])
+        points = [
+            (v["name"], float(v["value"]))
+            for v in values
+            if not v.get("stale") and isinstance(v.get("value"), (int, float))
+        ]
+        if not points:
+            return False
+        with self.cond:
+            if len(self.pending) == self.pending.maxlen:
+                self.dropped += 1
+            self.pending.append((get_resource_attributes(msg), time.time_ns(), points))
+            self.cond.notify()
+        return True
+
+    def get_batch(self) -> list:
+        """ Wait until ticks are due to be exported.
+
+        @returns the oldest ticks, or an empty list if the sink was stopped
+        """
+        with self.cond:
+            deadline = time.monotonic() + self.flush_interval
+            while not self.stopped.is_set() and len(self.pending) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if self.pending and (remaining <= 0 or self.flushing):
+                    break
+                self.cond.wait(remaining if remaining > 0 else 1)
+            if self.stopped.is_set():
+                return []
+            return [self.pending.popleft() for _ in range(min(len(self.pending), self.max_batch))]
+
+    def requeue(self, batch: list) -> None:
+        """ Put ticks that failed to export back, ahead of newer ticks. """
+        with self.cond:
+            room = self.pending.maxlen - len(self.pending)
+            if room < len(batch):
+                self.dropped += len(batch) - room
+                batch = batch[len(batch) - room:]
+            self.pending.extendleft(reversed(batch))
+
+    def export(self, batch: list) -> bool:
+        """ Export ticks to the collector.
+
+        @returns `True` if the ticks were accepted, or rejected for good
+        """
+        resources = {}
+        for attributes, time_ns, points in batch:
+            metrics = resources.setdefault(attributes, {})
+            for name, value in points:
+                metrics.setdefault(name, []).append((time_ns, value))
+        body = encode_request(list(resources.items()))
+        resp = self.pool.send(data=body, headers={"Content-Type": "application/x-protobuf"})
+        if resp is not None and 200 <= resp.status_code < 300:
+            with self.cond:
+                self.exported += len(batch)
+            return True
+        if resp is not None and resp.status_code not in RETRYABLE_STATUS:
+            logging.error(f"OTLP endpoint ({self.endpoint}) rejected ({len(batch)}) ticks with status ({resp.status_code})")
+            with self.cond:
+                self.dropped += len(batch)
+            return True
+        return False
+
+    def run_forever(self) -> None:
+        while True:
+            batch = self.get_batch()
+            if not batch:
+                return
+            try:
+                ok = self.export(batch)
+            except Exception:
+                logging.exception(f"Failed to export to OTLP endpoint ({self.endpoint})")
+                ok = False
+            if ok:
+                self.failures = 0
+                continue
+            with self.cond:
+                self.failed += 1
+            self.failures += 1
+            self.requeue(batch)
+            # Back off, as the collector is likely unavailable
+            if self.stopped.wait(min(2 ** (self.failures - 1), MAX_RETRY_DELAY)):
+                return
+
+    def get_stats(self) -> dict:
+        """ Returns the metrics of the sink. """
+        with self.cond:
+            return {
+                "endpoint": self.endpoint,
+                "pending": len(self.pending),
+                "exported": self.exported,
+                "dropped": self.dropped,
+                "failed": self.failed
+            }
+
+    def start(self) -> None:
+        self.thread = threading.Thread(target=self.run_forever, name="ays-otlp", daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout: float = 5) -> None:
+        """ Stop exporting, after waiting up to `timeout` seconds for pending ticks to be exported. """
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            # Export pending ticks now, rather than at the end of the flush interval
+            self.flushing = True
+            self.cond.notify_all()
+        while self.thread is not None and self.pending and time.monotonic() < deadline:
+            time.sleep(0.1)
+        self.stopped.set()
+        with self.cond:
+            self.cond.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+        self.pool.stop()
@@ -0,0 +1,283 @@
+#
+# Relay agent payloads upstream.
+#
+# Agents on a LAN segment post their payloads to the relay, rather than to
+# @ys. Payloads are coalesced, per node, and forwarded gzipped over a single
+# pooled connection. @ys accepts a single payload per request, so payloads are
+# forwarded one by one, unless upstream is another relay, which accepts
+# batches. Batches that can not be forwarded are spooled to disk, and
+# forwarded, in order, once upstream recovers.
+#
+
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+
+from typing import Callable, List
+from typing_extensions import Optional
+
+from ays_agent.sketch import merge_values
+from ays_agent.transport import EndpointPool, parse_servers
+
+# Maximum number of payloads forwarded in a single batch
+BATCH_SIZE = 500
+
+# Time, in seconds, payloads are coalesced before they are forwarded
+FLUSH_INTERVAL = 1
+
+# Maximum size, in bytes, of the spool. The oldest batches are dropped when the
+# spool is full.
+MAX_SPOOL_SIZE = 64 * 1024 * 1024
+
+def get_payload_key(payload: dict) -> tuple:
+    """ Returns a value that identifies the node a payload reports on. """
+    return (
+        payload.get("org_secret"),
+        json.dumps(payload.get("parent"), sort_keys=True),
+        json.dumps(payload.get("relationship"), sort_keys=True)
+    )
+
+def encode_batch(payloads) -> bytes:
+    """ Returns a batch of payloads as a gzipped JSON array, or a single payload as a gzipped JSON object. """
+    return gzip.compress(json.dumps(payloads, separators=(",", ":")).encode(), compresslevel=6)
+
+def decode_batch(data: bytes) -> List[dict]:
+    return json.loads(gzip.decompress(data))
+
+class Spool(object):
+    """ Batches waiting to be forwarded, stored as files in a directory. """
+
+    def __init__(self, path: str, max_size: int = MAX_SPOOL_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self.seq = 0
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        # Remove batches that were partially written, e.g. when the relay was
+        # killed
+        for name in os.listdir(path):
+            if name.startswith("."):
+                self.remove(name)
+
+    def get_names(self) -> List[str]:
+        """ Returns the names of spooled batches, oldest first. """
+        return sorted(n for n in os.listdir(self.path) if n.endswith(".json.gz") and not n.startswith("."))
+
+    def get_size(self, names: List[str]) -> int:
+        size = 0
+        for name in names:
+            try:
+                size += os.path.getsize(os.path.join(self.path, name))
+            except OSError:
+                pass
+        return size
+
+    def push(self, data: bytes) -> None:
+        """ Spool a batch, after all other batches. """
+        names = self.get_names()
+        size = self.get_size(names)
+        while names and size + len(data) > self.max_size:
+            name = names.pop(0)
+            size -= self.get_size([name])
+            logging.warning(f"Spool ({self.path}) is full. Dropping batch ({name}).")
+            self.remove(name)
+        self.seq += 1
+        self.write(f"{time.time_ns():020d}-{self.seq:06d}.json.gz", data)
+
+    def write(self, name: str, data: bytes) -> None:
+        """ Write a batch, atomically replacing the batch of the same name. """
+        tmp_path = os.path.join(self.path, f".{name}")
+        with open(tmp_path, "wb") as fh:
+            fh.write(data)
+        os.rename(tmp_path, os.path.join(self.path, name))
+
+    def read(self, name: str) -> Optional[bytes]:
+        try:
+            with open(os.path.join(self.path, name), "rb") as fh:
+                return fh.read()
+        except OSError:
+            return None
+
+    def remove(self, name: str) -> None:
+        try:
+            os.unlink(os.path.join(self.path, name))
+        except FileNotFoundError:
+            pass
+
+class Relay(object):
+    def __init__(
+        self,
+        server: str,
+        spool: Optional[Spool] = None,
+        send: Optional[Callable[[bytes], bool]] = None,
+        batch_size: int = BATCH_SIZE,
+        flush_interval: float = FLUSH_INTERVAL,
+        upstream_relay: bool = False
+    ):
+        """
+        @param server upstream @ys server, or relay. May be a comma delimited list of endpoints.
+        @param spool stores batches that could not be forwarded
+        @param send forwards a gzipped request body upstream. Default posts the body to `server`.
+        @param upstream_relay `True` if `server` is another relay, which accepts batches of payloads
+        """
+        self.server = server
+        self.upstream_relay = upstream_relay
+        self.spool = spool
+        self.send = send or self.post_batch
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.pool = EndpointPool(parse_servers(server))
+        self.lock = threading.Lock()
+        # Payloads waiting to be forwarded, keyed by node
+        self.pending = {}
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+        # Number of payloads received, and forwarded
+        self.received = 0
+        self.forwarded = 0
+
+    def submit(self, payloads: List[dict]) -> None:
+        """ Queue payloads to be forwarded.
+
+        A payload replaces the queued payload of the same node. Properties of
+        the queued payload, that the new payload does not provide (e.g. a
+        status), are kept. Distributions are merged, so that no samples are
+        lost.
+        """
+        with self.lock:
+            for payload in payloads:
+                key = get_payload_key(payload)
+                queued = self.pending.get(key)
+                if queued is None:
+                    self.pending[key] = payload
+                    continue
+                merged = dict(queued, **payload)
+                if isinstance(queued.get("values"), list) and isinstance(payload.get("values"), list):
+                    merged["values"] = merge_values(queued["values"], payload["values"])
+                self.pending[key] = merged
+            self.received += len(payloads)
+            full = len(self.pending) >= self.batch_size
+        if full:
+            self.wakeup.set()
+
+    def post_batch(self, data: bytes) -> bool:
+        """ Post a gzipped payload, or batch of payloads, upstream.
+
+        @returns `True` if the request was accepted, or rejected for good
+        """
+        resp = self.pool.send(data=data, headers={"Content-Type": "application/json", "Content-Encoding": "gzip"})
+        if resp is None:
+            logging.warning(f"Failed to forward to ({self.server})")
+            return False
+        if resp.status_code in (200, 202, 204):
+            return True
+        if 400 <= resp.status_code < 500 and resp.status_code != 429:
+            # NOTE: Upstream would reject the request again. Retrying it
+            # would block every request queued after it.
+            logging.error(f"Upstream ({self.server}) rejected request with status ({resp.status_code}). Dropping it.")
+            return True
+        logging.warning(f"Failed to forward to ({self.server}): {resp.status_code}")
+        return False
+
+    def forward(self, payloads: List[dict]) -> int:
+        """ Forward payloads upstream, in order.
+
+        @returns number of payloads forwarded, before upstream failed
+        """
+        if self.upstream_relay:
+            return len(payloads) if self.send(encode_batch(payloads)) else 0
+        for i, payload in enumerate(payloads):
+            if not self.send(encode_batch(payload)):
+                return i
+        return len(payloads)
+
+    def drain_spool(self) -> int:
+        """ Forward spooled batches, oldest first, until upstream fails.
+
+        @returns number of payloads forwarded
+        """
+        forwarded = 0
+        for name in self.spool.get_names():
+            data = self.spool.read(name)
+            if data is None:
+                continue
+            try:
+                payloads = decode_batch(data)
+            except (OSError, EOFError, ValueError, zlib.error) as exc:
+                # NOTE: The batch would fail to decode again. Keeping it would
+                # block every batch spooled after it.
+                logging.error(f"Spooled batch ({name}) is corrupt. Dropping it: {exc}")
+                self.spool.remove(name)
+                continue
+            n = self.forward(payloads)
+            forwarded += n
+            if n < len(payloads):
+                if n:
+                    # Only keep the payloads that were not forwarded
+                    self.spool.write(name, encode_batch(payloads[n:]))
+                break
+            self.spool.remove(name)
+        return forwarded
+
+    def flush(self) -> int:
+        """ Forward queued, and spooled, payloads.
+
+        @returns number of payloads forwarded
+        """
+        with self.lock:
+            payloads = list(self.pending.values())
+            self.pending = {}
+        batches = [payloads[i:i + self.batch_size] for i in range(0, len(payloads), self.batch_size)]
+        if self.spool is not None and self.spool.get_names():
+            # Batches are forwarded in the order they were received. Queued
+            # batches are spooled after the spooled batches, before they are
+            # forwarded, so that they are not lost if the spool can not be
+            # drained.
+            for batch in batches:
+                self.spool.push(encode_batch(batch))
+            forwarded = self.drain_spool()
+        else:
+            forwarded = 0
+            for i, batch in enumerate(batches):
+                n = self.forward(batch)
+                forwarded += n
+                if n < len(batch):
+                    # If a batch can not be forwarded, neither can the batches
+                    # after it
+                    self.spool_batches([batch[n:]] + batches[i + 1:])
+                    break
+        self.forwarded += forwarded
+        return forwarded
+
+    def spool_batches(self, batches: List[List[dict]]) -> None:
+        """ Spool batches that could not be forwarded, or drop them if no spool is configured. """
+        for batch in batches:
+            if self.spool is not None:
+                self.spool.push(encode_batch(batch))
+            else:
+                logging.warning(f"Dropping batch of ({len(batch)}) payloads. No spool is configured.")
+
+    def run_forever(self) -> None:
+        while not self.stopped.is_set():
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logging.exception("Failed to flush relay")
+
+    def start(self) -> None:
+        self.thread = threading.Thread(target=self.run_forever, name="ays-relay", daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        """ Stop the relay, forwarding (or spooling) queued payloads. """
+        self.stopped.set()
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.flush()
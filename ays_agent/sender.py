@@ -0,0 +1,273 @@
+#
+# Priority send queue.
+#
+# Messages are sent from a background thread, most urgent first: status
+# changes and values that breach their thresholds, then heartbeats, then
+# routine values. Each endpoint is rate limited by a token bucket, so that an
+# agent recovering from an outage doesn't flood @ys with its backlog.
+#
+# The queue is bounded. When it is full, the oldest message of the least
+# urgent class is dropped. As the queue fills, the agent samples less often
+# (backpressure), rather than queueing values that would be dropped.
+#
+
+import collections
+import logging
+import threading
+import time
+
+from typing import Callable
+from typing_extensions import Optional
+
+from ays_agent.adaptive import get_headroom
+
+# Priority classes, most urgent first
+PRIORITY_STATUS = 0
+PRIORITY_HEARTBEAT = 1
+PRIORITY_VALUES = 2
+PRIORITY_NAMES = ["status", "heartbeat", "values"]
+
+# Maximum number of messages queued
+MAX_QUEUE_SIZE = 1000
+
+# Messages sent per second, per endpoint, and the number of messages that may
+# be sent in a burst
+SEND_RATE = 5
+SEND_BURST = 10
+
+# Number of times a message is sent before it is dropped
+MAX_ATTEMPTS = 5
+
+# Maximum time, in seconds, to wait before retrying a failed send
+MAX_RETRY_DELAY = 30
+
+# Fraction of the queue that may fill before the agent samples less often
+HIGH_WATER = 0.5
+
+# Factor the interval is stretched by when the queue is full
+MAX_BACKPRESSURE = 4
+
+def is_breach(threshold: dict, value: float) -> bool:
+    """ Returns `True` if a value breaches its threshold. """
+    if "equal" in threshold:
+        return value == threshold["equal"]
+    if "nequal" in threshold:
+        return value != threshold["nequal"]
+    headroom = get_headroom(threshold, value)
+    return headroom is not None and headroom <= 0
+
+def get_priority(msg: dict) -> int:
+    """ Returns the priority class of a message. """
+    if "status" in msg:
+        return PRIORITY_STATUS
+    values = msg.get("values") or ([msg["value"]] if "value" in msg else [])
+    if not values:
+        return PRIORITY_HEARTBEAT
+    for v in values:
+        threshold = v.get("threshold")
+        if threshold and not v.get("stale") and is_breach(threshold, v["value"]):
+            return PRIORITY_STATUS
+    return PRIORITY_VALUES
+
+def copy_message(msg: dict) -> dict:
+    """ Returns a copy of a message that is safe to queue.
+
+    The agent reuses the message, and its values, between ticks.
+    """
+    msg = dict(msg)
+    if "values" in msg:
+        msg["values"] = [dict(v) for v in msg["values"]]
+    return msg
+
+class TokenBucket(object):
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def get_delay(self, now: float) -> float:
+        """ Returns the time, in seconds, until a token is available. """
+        self.refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+class QueuedMessage(object):
+    __slots__ = ("server", "msg", "attempts")
+
+    def __init__(self, server: str, msg: dict):
+        self.server = server
+        self.msg = msg
+        self.attempts = 0
+
+class SendQueue(object):
+    def __init__(
+        self,
+        send: Callable[[str, dict], bool],
+        max_size: int = MAX_QUEUE_SIZE,
+        rate: float = SEND_RATE,
+        burst: int = SEND_BURST
+    ):
+        """
+        @param send sends a message to @ys
+        @param max_size maximum number of messages queued
+        @param rate messages sent per second, per endpoint
+        @param burst number of messages that may be sent in a burst, per endpoint
+        """
+        self.send = send
+        self.max_size = max_size
+        self.rate = rate
+        self.burst = burst
+        self.queues = [collections.deque() for _ in PRIORITY_NAMES]
+        self.buckets = {}
+        self.cond = threading.Condition()
+        self.stopped = threading.Event()
+        self.thread = None
+        # Time the next send may be made, after a send failed
+        self.retry_at = 0
+        self.failures = 0
+        self.sent = [0] * len(PRIORITY_NAMES)
+        self.dropped = [0] * len(PRIORITY_NAMES)
+        self.failed = 0
+
+    def get_size(self) -> int:
+        return sum(len(q) for q in self.queues)
+
+    def put(self, server: str, msg: dict) -> bool:
+        """ Queue a message to be sent.
+
+        @returns `True` if the message was queued
+        """
+        priority = get_priority(msg)
+        with self.cond:
+            if self.get_size() >= self.max_size:
+                # Drop the oldest message of the least urgent class, unless
+                # the new message is less urgent than all queued messages.
+                lowest = max(p for p, q in enumerate(self.queues) if q)
+                if lowest < priority:
+                    self.dropped[priority] += 1
+                    return False
+                self.queues[lowest].popleft()
+                self.dropped[lowest] += 1
+            self.queues[priority].append(QueuedMessage(server, copy_message(msg)))
+            self.cond.notify()
+        return True
+
+    def get_bucket(self, server: str) -> TokenBucket:
+        bucket = self.buckets.get(server)
+        if bucket is None:
+            bucket = self.buckets[server] = TokenBucket(self.rate, self.burst)
+        return bucket
+
+    def get(self) -> Optional[tuple[int, QueuedMessage]]:
+        """ Wait for the most urgent message that may be sent.
+
+        @returns the message and its priority, or `None` if the queue was stopped
+        """
+        with self.cond:
+            while not self.stopped.is_set():
+                priority = next((p for p, q in enumerate(self.queues) if q), None)
+                if priority is None:
+                    self.cond.wait(1)
+                    continue
+                item = self.queues[priority][0]
+                now = time.monotonic()
+                bucket = self.get_bucket(item.server)
+                delay = max(bucket.get_delay(now), self.retry_at - now)
+                if delay > 0:
+                    # A more urgent message may be queued while waiting
+                    self.cond.wait(delay)
+                    continue
+                bucket.take()
+                self.queues[priority].popleft()
+                return priority, item
+        return None
+
+    def requeue(self, priority: int, item: QueuedMessage) -> None:
+        """ Put a message that failed to send back at the head of its class. """
+        with self.cond:
+            if self.get_size() >= self.max_size:
+                # Drop the oldest message of the least urgent class, as `put`
+                # does. The message is older than the queued messages of its
+                # class, so it is dropped if no class is less urgent.
+                lowest = max(p for p, q in enumerate(self.queues) if q)
+                if lowest <= priority:
+                    self.dropped[priority] += 1
+                    return
+                self.queues[lowest].popleft()
+                self.dropped[lowest] += 1
+            self.queues[priority].appendleft(item)
+
+    def run_forever(self) -> None:
+        while True:
+            entry = self.get()
+            if entry is None:
+                return
+            priority, item = entry
+            item.attempts += 1
+            try:
+                ok = self.send(item.server, item.msg)
+            except Exception:
+                logging.exception("Failed to make request to @ys server")
+                ok = False
+            with self.cond:
+                if ok:
+                    self.sent[priority] += 1
+                    self.failures = 0
+                    self.retry_at = 0
+                    continue
+                self.failed += 1
+                self.failures += 1
+                # Back off, as the endpoints are likely unavailable
+                self.retry_at = time.monotonic() + min(2 ** (self.failures - 1), MAX_RETRY_DELAY)
+            if item.attempts < MAX_ATTEMPTS:
+                self.requeue(priority, item)
+            else:
+                logging.warning(f"Dropping {PRIORITY_NAMES[priority]} message after ({item.attempts}) attempts")
+                with self.cond:
+                    self.dropped[priority] += 1
+
+    def get_backpressure(self) -> float:
+        """ Returns the factor the sampling interval should be stretched by. """
+        fill = self.get_size() / self.max_size
+        if fill <= HIGH_WATER:
+            return 1
+        return 1 + (MAX_BACKPRESSURE - 1) * min((fill - HIGH_WATER) / (1 - HIGH_WATER), 1)
+
+    def get_stats(self) -> dict:
+        """ Returns the metrics of the queue. """
+        with self.cond:
+            return {
+                "size": self.get_size(),
+                "max_size": self.max_size,
+                "backpressure": self.get_backpressure(),
+                "failed": self.failed,
+                "retry_in": max(self.retry_at - time.monotonic(), 0),
+                "classes": {
+                    name: {"queued": len(self.queues[p]), "sent": self.sent[p], "dropped": self.dropped[p]}
+                    for p, name in enumerate(PRIORITY_NAMES)
+                }
+            }
+
+    def start(self) -> None:
+        self.thread = threading.Thread(target=self.run_forever, name="ays-sender", daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout: float = 5) -> None:
+        """ Stop sending, after waiting up to `timeout` seconds for queued messages to be sent. """
+        deadline = time.monotonic() + timeout
+        while self.thread is not None and self.get_size() and time.monotonic() < deadline:
+            time.sleep(0.1)
+        self.stopped.set()
+        with self.cond:
+            self.cond.notify_all()
+        if self.thread is not None:
+            self.thread.join()
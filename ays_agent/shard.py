@@ -0,0 +1,318 @@
+#
+# Sharded monitors.
+#
+# A monitor of many targets (e.g. thousands of probe endpoints) is bound by
+# the GIL once collecting, and building the values of, its targets saturates a
+# core. A sharded monitor partitions its targets across worker processes, by
+# consistent hashing, so that each worker has its own event loop and
+# connections, and runs on its own core.
+#
+# The monitor supervises its workers. A worker that crashes, or hangs, is
+# restarted. A worker that crashes repeatedly is retired, and its targets are
+# rebalanced across the other workers, until it is tried again. Consistent
+# hashing means only the retired worker's targets move.
+#
+
+import bisect
+import hashlib
+import logging
+import multiprocessing
+import threading
+import time
+import traceback
+
+from multiprocessing.connection import Connection, wait
+from typing import Callable, Dict, Iterable, List
+from typing_extensions import Optional
+
+from ays_agent import AgentException
+from ays_agent.collector import CircuitBreaker
+
+# Points on the ring per shard. More points spread targets more evenly.
+REPLICAS = 64
+
+# Time, in seconds, a worker has to start, in addition to the time its
+# monitor has to return its values
+STARTUP_TIME = 5
+
+# Time, in seconds, a monitor has to return its values, if it does not
+# provide its own `timeout`
+DEFAULT_TIMEOUT = 10
+
+def hash_key(key: str) -> int:
+    """ Returns the position of a key on the ring.
+
+    Unlike `hash`, the position is the same in every process.
+    """
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+class HashRing(object):
+    def __init__(self, shards: Iterable[int] = (), replicas: int = REPLICAS):
+        self.replicas = replicas
+        # Sorted positions, and the shard at each position
+        self.points = []
+        self.shards = {}
+        for shard in shards:
+            self.add(shard)
+
+    def __len__(self) -> int:
+        return len(self.points) // self.replicas
+
+    def add(self, shard: int) -> None:
+        for i in range(self.replicas):
+            point = hash_key(f"{shard}:{i}")
+            bisect.insort(self.points, point)
+            self.shards[point] = shard
+
+    def remove(self, shard: int) -> None:
+        for i in range(self.replicas):
+            point = hash_key(f"{shard}:{i}")
+            self.points.remove(point)
+            del self.shards[point]
+
+    def get_shard(self, key: str) -> int:
+        """ Returns the shard that owns a key. """
+        if not self.points:
+            raise AgentException("No shards to assign key to")
+        i = bisect.bisect(self.points, hash_key(key)) % len(self.points)
+        return self.shards[self.points[i]]
+
+    def partition(self, keys: Iterable[str]) -> Dict[int, List[str]]:
+        """ Returns the keys owned by each shard. Keys keep their order. """
+        parts = {}
+        for key in keys:
+            parts.setdefault(self.get_shard(key), []).append(key)
+        return parts
+
+def start_monitor(factory: Callable[[List[str]], object], targets: List[str]):
+    if not targets:
+        return None
+    monitor = factory(targets)
+    monitor.start()
+    return monitor
+
+def stop_monitor(monitor) -> None:
+    stop = getattr(monitor, "stop", None)
+    if stop is not None:
+        stop()
+
+def run_worker(conn: Connection, factory: Callable[[List[str]], object], targets: List[str]) -> None:
+    """ Collect the values of a shard's targets when asked to, until stopped.
+
+    Requests are `(command, argument)`. Values are returned as `(True, values)`,
+    or `(False, error)` if the monitor raised.
+    """
+    monitor = start_monitor(factory, targets)
+    try:
+        while True:
+            try:
+                command, arg = conn.recv()
+            except EOFError:
+                # The agent exited
+                return
+            if command == "collect":
+                try:
+                    conn.send((True, monitor.get_values(arg) if monitor is not None else []))
+                except Exception:
+                    conn.send((False, traceback.format_exc()))
+            elif command == "targets":
+                stop_monitor(monitor)
+                monitor = start_monitor(factory, arg)
+            elif command == "stop":
+                return
+    finally:
+        stop_monitor(monitor)
+
+class Shard(object):
+    def __init__(self, index: int, breaker: CircuitBreaker):
+        self.index = index
+        self.breaker = breaker
+        self.targets = []
+        # `True` if the shard's targets changed since they were sent to its worker
+        self.changed = False
+        # `False` while the shard is retired
+        self.active = True
+        self.process = None
+        self.conn = None
+        # Values from the last successful collection
+        self.values = []
+
+class ShardedMonitor(object):
+    def __init__(
+        self,
+        factory: Callable[[List[str]], object],
+        targets: List[str],
+        shards: int,
+        max_failures: int = 3,
+        cooldown: float = 300
+    ):
+        """
+        @param factory creates the monitor of a shard's targets. Must be picklable, e.g. a monitor's class.
+        @param shards number of worker processes
+        @param max_failures number of consecutive crashes before a worker is retired
+        @param cooldown time, in seconds, a worker is retired for
+        """
+        if shards < 1:
+            raise AgentException(f"Number of shards ({shards}) must be 1 or greater")
+        # Validates the targets, before any worker is started
+        monitor = factory(targets)
+        self.factory = factory
+        self.targets = list(targets)
+        # Time a worker has to return its values. The monitor of all targets
+        # is given at least as long as the monitor of a subset.
+        self.shard_timeout = (getattr(monitor, "timeout", None) or DEFAULT_TIMEOUT) + STARTUP_TIME
+        # Time the collector waits for all shards
+        self.timeout = self.shard_timeout + 1
+        self.ring = HashRing(range(shards))
+        self.shards = [Shard(i, CircuitBreaker(max_failures, cooldown)) for i in range(shards)]
+        self.context = multiprocessing.get_context("spawn")
+        # Serializes collection and stopping
+        self.lock = threading.Lock()
+        self.started = False
+        self.assign()
+
+    def assign(self) -> None:
+        """ Assign targets to the active shards. """
+        parts = self.ring.partition(self.targets)
+        for shard in self.shards:
+            targets = parts.get(shard.index, [])
+            if targets != shard.targets:
+                shard.targets = targets
+                shard.changed = True
+
+    def spawn(self, shard: Shard) -> None:
+        conn, child = self.context.Pipe()
+        # Workers are spawned, rather than forked, as the agent runs threads
+        shard.process = self.context.Process(
+            target=run_worker,
+            args=(child, self.factory, shard.targets),
+            name=f"ays-shard-{shard.index}",
+            daemon=True
+        )
+        shard.process.start()
+        child.close()
+        shard.conn = conn
+        shard.changed = False
+
+    def kill(self, shard: Shard) -> None:
+        if shard.process is None:
+            return
+        if shard.process.is_alive():
+            shard.process.kill()
+        shard.process.join()
+        shard.process.close()
+        shard.conn.close()
+        shard.process = None
+        shard.conn = None
+
+    def fail(self, shard: Shard, now: Optional[float] = None) -> None:
+        """ Record that a shard's worker crashed, or hung, and retire the shard if it did so repeatedly. """
+        self.kill(shard)
+        shard.breaker.failure(now)
+        # The last active shard is never retired, as its targets have nowhere to go
+        if shard.active and shard.breaker.is_open() and len(self.ring) > 1:
+            logging.error(f"Shard ({shard.index}) crashed ({shard.breaker.failures}) times. Moving its targets to the other shards.")
+            self.ring.remove(shard.index)
+            shard.active = False
+            self.assign()
+
+    def start(self) -> None:
+        with self.lock:
+            self.started = True
+            self.supervise()
+
+    def supervise(self, now: Optional[float] = None) -> None:
+        """ Restart workers that exited, and rebalance targets when a worker is retired or restored. """
+        now = time.monotonic() if now is None else now
+        for shard in self.shards:
+            if shard.process is not None and not shard.process.is_alive():
+                logging.warning(f"Shard ({shard.index}) exited with code ({shard.process.exitcode})")
+                self.fail(shard, now)
+            elif not shard.active and shard.breaker.allow(now):
+                # The breaker stays open until the worker returns values. If
+                # it crashes again, it is retired again.
+                logging.info(f"Restoring shard ({shard.index})")
+                self.ring.add(shard.index)
+                shard.active = True
+                self.assign()
+        for shard in self.shards:
+            if not shard.active:
+                shard.values = []
+                continue
+            if shard.process is None:
+                self.spawn(shard)
+            elif shard.changed:
+                shard.conn.send(("targets", shard.targets))
+                shard.changed = False
+
+    def get_stats(self, delay: int = 0) -> List[dict]:
+        """ Collect the values of all shards concurrently.
+
+        A shard that does not return its values in time, or raises, reports
+        its last known values with `stale` set. A worker that does not return
+        in time is killed, and restarted on the next collection.
+        """
+        with self.lock:
+            if not self.started:
+                return []
+            self.supervise()
+            pending = {}
+            for shard in self.shards:
+                if shard.active:
+                    try:
+                        shard.conn.send(("collect", delay))
+                        pending[shard.conn] = shard
+                    except OSError:
+                        # Exited. Restarted on the next collection.
+                        pass
+            fresh = set()
+            deadline = time.monotonic() + self.shard_timeout
+            while pending:
+                ready = wait(list(pending), max(deadline - time.monotonic(), 0))
+                if not ready:
+                    break
+                for conn in ready:
+                    shard = pending.pop(conn)
+                    try:
+                        ok, result = conn.recv()
+                    except (EOFError, OSError):
+                        # Crashed while collecting
+                        logging.warning(f"Shard ({shard.index}) exited while collecting values")
+                        self.fail(shard)
+                        continue
+                    if ok:
+                        shard.values = result
+                        shard.breaker.success()
+                        fresh.add(shard.index)
+                    else:
+                        logging.error(f"Shard ({shard.index}) failed to return values\n{result}")
+            for shard in pending.values():
+                logging.warning(f"Shard ({shard.index}) did not return values within {self.shard_timeout}s")
+                self.fail(shard)
+            values = []
+            for shard in self.shards:
+                if shard.index in fresh:
+                    values.extend(shard.values)
+                else:
+                    values.extend(dict(v, stale=True) for v in shard.values)
+            return values
+
+    def get_formatted_stats(self) -> List[str]:
+        return [f"{v['name']}: {v['value']}" for v in self.get_stats()]
+
+    def get_values(self, delay: int) -> List[dict]:
+        """ Get list of values that represent an `AgentValue`. """
+        return self.get_stats(delay)
+
+    def stop(self) -> None:
+        with self.lock:
+            self.started = False
+            for shard in self.shards:
+                if shard.process is None:
+                    continue
+                try:
+                    shard.conn.send(("stop", None))
+                except OSError:
+                    pass
+                shard.process.join(1)
+                self.kill(shard)
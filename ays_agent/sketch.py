@@ -0,0 +1,259 @@
+#
+# Mergeable quantile sketches.
+#
+# A distribution (e.g. the latencies of requests) is summarized by a DDSketch.
+# Values are counted in logarithmically sized buckets, so that any quantile is
+# estimated within a relative error of `alpha`, using memory that depends on
+# the range of the values, not their number. Sketches with the same `alpha`
+# merge by adding their bucket counts, so the sketches of many agents, or many
+# intervals, can be combined without losing accuracy.
+#
+# Paper: https://arxiv.org/abs/1908.10693
+#
+
+import math
+import re
+
+from typing import Dict, List
+
+from ays_agent import AgentException
+
+# Relative error of quantile estimates
+DEFAULT_ALPHA = 0.01
+
+# Maximum number of buckets per sign. When exceeded, the lowest buckets are
+# collapsed, which only affects the accuracy of the lowest quantiles. With the
+# default `alpha`, 2048 buckets cover values spanning 17 orders of magnitude.
+MAX_BUCKETS = 2048
+
+# Quantiles, in percent, reported for each distribution
+DEFAULT_QUANTILES = [50, 90, 99]
+
+# Names of the values derived from a distribution's sketch, e.g. `latency p99`
+DERIVED_VALUE = re.compile(r"^(.*) (p(\d+(?:\.\d+)?)|min|max|mean)$")
+
+class DDSketch(object):
+    def __init__(self, alpha: float = DEFAULT_ALPHA, max_buckets: int = MAX_BUCKETS):
+        if not 0 < alpha < 1:
+            raise AgentException(f"Invalid sketch accuracy ({alpha}). Must be between 0 and 1")
+        self.alpha = alpha
+        self.max_buckets = max_buckets
+        self.gamma = (1 + alpha) / (1 - alpha)
+        self.multiplier = 1 / math.log(self.gamma)
+        # Counts of positive, and negative, values keyed by bucket index
+        self.positive = {}
+        self.negative = {}
+        self.zero = 0
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def get_index(self, value: float) -> int:
+        """ Returns the bucket of an absolute value. """
+        return math.ceil(math.log(value) * self.multiplier)
+
+    def get_bucket_value(self, index: int) -> float:
+        """ Returns the value a bucket represents, which is within `alpha` of every value in the bucket. """
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    def add(self, value: float, count: int = 1) -> None:
+        if value > 0:
+            buckets = self.positive
+            index = self.get_index(value)
+        elif value < 0:
+            buckets = self.negative
+            index = self.get_index(-value)
+        else:
+            self.zero += count
+            buckets = None
+        if buckets is not None:
+            buckets[index] = buckets.get(index, 0) + count
+            if len(buckets) > self.max_buckets:
+                self.collapse(buckets)
+        self.count += count
+        self.sum += value * count
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def collapse(self, buckets: dict) -> None:
+        """ Merge the lowest buckets, until there are at most `max_buckets` buckets. """
+        indexes = sorted(buckets)
+        excess = indexes[:len(indexes) - self.max_buckets + 1]
+        lowest = indexes[len(excess)]
+        for index in excess:
+            buckets[lowest] += buckets.pop(index)
+
+    def merge(self, other: "DDSketch") -> None:
+        """ Add the values of another sketch to this sketch. """
+        if other.gamma != self.gamma:
+            raise AgentException(f"Sketches with different accuracies ({self.alpha}, {other.alpha}) can not be merged")
+        for buckets, other_buckets in ((self.positive, other.positive), (self.negative, other.negative)):
+            for index, count in other_buckets.items():
+                buckets[index] = buckets.get(index, 0) + count
+            if len(buckets) > self.max_buckets:
+                self.collapse(buckets)
+        self.zero += other.zero
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def get_quantile(self, quantile: float) -> float:
+        """ Returns the estimated value at a quantile.
+
+        @param quantile between 0 and 1
+        """
+        if self.count == 0:
+            raise AgentException("Sketch has no values")
+        # The min and max are exact
+        if quantile <= 0:
+            return self.min
+        if quantile >= 1:
+            return self.max
+        rank = quantile * (self.count - 1)
+        seen = 0
+        value = None
+        # The most negative values have the highest indexes
+        for index in sorted(self.negative, reverse=True):
+            seen += self.negative[index]
+            if seen > rank:
+                value = -self.get_bucket_value(index)
+                break
+        if value is None:
+            seen += self.zero
+            if seen > rank:
+                value = 0.0
+        if value is None:
+            for index in sorted(self.positive):
+                seen += self.positive[index]
+                if seen > rank:
+                    value = self.get_bucket_value(index)
+                    break
+        if value is None:
+            value = self.max
+        # The bucket value may be outside the range of the values in the bucket
+        return min(max(value, self.min), self.max)
+
+    def to_dict(self) -> dict:
+        """ Returns the JSON representation of the sketch. """
+        def encode(buckets: Dict[int, int]) -> dict:
+            indexes = sorted(buckets)
+            return {"index": indexes, "count": [buckets[i] for i in indexes]}
+
+        return {
+            "alpha": self.alpha,
+            "positive": encode(self.positive),
+            "negative": encode(self.negative),
+            "zero": self.zero,
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min if self.count else None,
+            "max": self.max if self.count else None
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "DDSketch":
+        """ Returns the sketch of a JSON representation. """
+        try:
+            sketch = cls(float(data["alpha"]))
+            for buckets, encoded in ((sketch.positive, data["positive"]), (sketch.negative, data["negative"])):
+                for index, count in zip(encoded["index"], encoded["count"]):
+                    buckets[int(index)] = buckets.get(int(index), 0) + int(count)
+            sketch.zero = int(data["zero"])
+            sketch.count = int(data["count"])
+            sketch.sum = float(data["sum"])
+            if sketch.count:
+                sketch.min = float(data["min"])
+                sketch.max = float(data["max"])
+        except (KeyError, TypeError, ValueError) as exc:
+            raise AgentException(f"Invalid sketch: {exc}")
+        return sketch
+
+def parse_quantiles(quantiles: str) -> List[float]:
+    """ Parse a comma delimited list of quantiles, in percent, e.g. `50,99,99.9`. """
+    try:
+        values = [float(q) for q in quantiles.split(",")]
+    except ValueError:
+        raise AgentException(f"Invalid quantiles ({quantiles}). Quantiles must be numbers, e.g. `50,90,99`")
+    for q in values:
+        if not 0 <= q <= 100:
+            raise AgentException(f"Invalid quantile ({q}). Quantiles must be between 0 and 100")
+    return values
+
+def format_quantile(quantile: float) -> str:
+    """ Returns the name of a quantile, e.g. `p99` or `p99.9`. """
+    return f"p{quantile:g}"
+
+def get_derived_values(name: str, sketch: DDSketch, quantiles: List[float]) -> List[dict]:
+    """ Returns the values derived from a distribution. """
+    values = [
+        {"name": f"{name} mean", "value": sketch.sum / sketch.count},
+        {"name": f"{name} min", "value": sketch.min},
+        {"name": f"{name} max", "value": sketch.max}
+    ]
+    for q in quantiles:
+        values.append({"name": f"{name} {format_quantile(q)}", "value": sketch.get_quantile(q / 100)})
+    return values
+
+def get_distribution_values(name: str, sketch: DDSketch, quantiles: List[float] = DEFAULT_QUANTILES) -> List[dict]:
+    """ Get list of values that represent a distribution.
+
+    The distribution's value is the number of values in the sketch. The
+    sketch is sent with it, so that distributions can be merged upstream.
+    The mean, min, max and quantiles are reported as separate values.
+    """
+    if sketch.count == 0:
+        return [{"name": name, "value": 0}]
+    value = {"name": name, "value": sketch.count, "sketch": sketch.to_dict()}
+    return [value] + get_derived_values(name, sketch, quantiles)
+
+def merge_values(queued: List[dict], values: List[dict]) -> List[dict]:
+    """ Merge the distributions of queued values into newer values of the same node.
+
+    Other values are replaced by the newer values. The values derived from a
+    merged distribution are recomputed.
+
+    @returns the newer values
+    """
+    sketches = {v["name"]: v["sketch"] for v in queued if isinstance(v, dict) and isinstance(v.get("sketch"), dict)}
+    if not sketches:
+        return values
+    merged = {}
+    for v in values:
+        if not isinstance(v, dict) or v.get("name") not in sketches:
+            continue
+        try:
+            sketch = DDSketch.from_dict(sketches[v["name"]])
+            if isinstance(v.get("sketch"), dict):
+                sketch.merge(DDSketch.from_dict(v["sketch"]))
+        except AgentException:
+            continue
+        merged[v["name"]] = sketch
+    if not merged:
+        return values
+    result = []
+    for v in values:
+        name = v.get("name") if isinstance(v, dict) else None
+        if name in merged:
+            sketch = merged[name]
+            result.append(dict(v, value=sketch.count, sketch=sketch.to_dict()))
+            continue
+        m = DERIVED_VALUE.match(name) if isinstance(name, str) else None
+        if m is not None and m.group(1) in merged and merged[m.group(1)].count:
+            sketch = merged[m.group(1)]
+            kind = m.group(2)
+            if kind == "mean":
+                value = sketch.sum / sketch.count
+            elif kind == "min":
+                value = sketch.min
+            elif kind == "max":
+                value = sketch.max
+            else:
+                value = sketch.get_quantile(float(m.group(3)) / 100)
+            result.append(dict(v, value=value))
+            continue
+        result.append(v)
+    return result
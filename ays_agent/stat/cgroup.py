@@ -0,0 +1,199 @@
+import os
+import psutil
+import time
+
+from typing import List
+from typing_extensions import Optional
+
+from ays_agent.stat import format_bytes, get_megabytes
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+PROC_SELF_CGROUP = "/proc/self/cgroup"
+
+# Files read from each cgroup. `cpu.max` is only used to determine the number
+# of CPUs available to the cgroup.
+CGROUP_FILES = ["cpu.stat", "cpu.max", "memory.current", "memory.max", "io.stat", "pids.current"]
+
+# Largest expected size of a cgroup file. `io.stat` has one line per device.
+CGROUP_READ_SIZE = 64 * 1024
+
+def get_own_cgroup(path: Optional[str] = None) -> Optional[str]:
+    """ Returns the cgroup v2 path of the agent's process.
+
+    Returns `None` if the agent is not running on a cgroup v2 system.
+    """
+    try:
+        with open(path or PROC_SELF_CGROUP, "r") as fh:
+            for line in fh:
+                # cgroup v2 has a single hierarchy with an ID of `0`
+                if line.startswith("0::"):
+                    return line[3:].strip()
+    except OSError:
+        pass
+    return None
+
+def parse_keyed(data: str) -> dict:
+    """ Parse a flat-keyed cgroup file e.g. `cpu.stat`. """
+    stats = {}
+    for line in data.splitlines():
+        parts = line.split()
+        if len(parts) == 2:
+            stats[parts[0]] = int(parts[1])
+    return stats
+
+def parse_io_stat(data: str) -> tuple[int, int]:
+    """ Parse a nested-keyed `io.stat` file.
+
+    @returns total bytes read and written, for all devices
+    """
+    rbytes = wbytes = 0
+    for line in data.splitlines():
+        for field in line.split()[1:]:
+            key, _, value = field.partition("=")
+            if key == "rbytes":
+                rbytes += int(value)
+            elif key == "wbytes":
+                wbytes += int(value)
+    return rbytes, wbytes
+
+class Cgroup(object):
+    """ A cgroup whose files are kept open between reads. """
+
+    def __init__(self, root: str, path: str):
+        self.path = path
+        self.fds = {}
+        directory = os.path.join(root, path.lstrip("/"))
+        for name in CGROUP_FILES:
+            try:
+                self.fds[name] = os.open(os.path.join(directory, name), os.O_RDONLY)
+            except OSError:
+                # Controller is not enabled for this cgroup
+                pass
+
+    def read(self, name: str) -> Optional[str]:
+        """ Re-read the contents of a cgroup file from its open handle. """
+        fd = self.fds.get(name)
+        if fd is None:
+            return None
+        try:
+            return os.pread(fd, CGROUP_READ_SIZE, 0).decode()
+        except OSError:
+            # The cgroup was removed
+            return None
+
+    def close(self) -> None:
+        for fd in self.fds.values():
+            os.close(fd)
+        self.fds = {}
+
+class CgroupMonitor(object):
+    def __init__(self, cgroups: Optional[List[str]] = None, root: Optional[str] = None, proc_cgroup: Optional[str] = None):
+        # cgroup paths, relative to the cgroup root, to monitor. The agent's
+        # own cgroup is monitored if none are provided.
+        self.paths = cgroups
+        self.root = root or CGROUP_ROOT
+        self.proc_cgroup = proc_cgroup
+        self.cgroups = []
+        self.counters = {}
+
+    def start(self):
+        """ Open the files of each cgroup and baseline their counters. """
+        for cgroup in self.cgroups:
+            cgroup.close()
+        paths = self.paths
+        if not paths:
+            own = get_own_cgroup(self.proc_cgroup)
+            paths = [own] if own is not None else []
+        self.cgroups = [Cgroup(self.root, path) for path in paths]
+        self.counters = {}
+        for cgroup in self.cgroups:
+            self.counters[cgroup.path] = self.get_counters(cgroup)
+
+    def stop(self):
+        """ Close the files of each cgroup. """
+        for cgroup in self.cgroups:
+            cgroup.close()
+        self.cgroups = []
+        self.counters = {}
+
+    def get_counters(self, cgroup: Cgroup) -> tuple[float, Optional[int], Optional[int], Optional[int]]:
+        """ Returns the time, CPU usage (µs), and bytes read & written by the cgroup. """
+        cpu = cgroup.read("cpu.stat")
+        usage = parse_keyed(cpu).get("usage_usec") if cpu is not None else None
+        io = cgroup.read("io.stat")
+        rbytes, wbytes = parse_io_stat(io) if io is not None else (None, None)
+        return time.monotonic(), usage, rbytes, wbytes
+
+    def get_num_cpus(self, cgroup: Cgroup) -> float:
+        """ Returns the number of CPUs the cgroup may use. """
+        cpu_max = cgroup.read("cpu.max")
+        if cpu_max:
+            quota, _, period = cpu_max.strip().partition(" ")
+            if quota != "max" and period:
+                return int(quota) / int(period)
+        return os.cpu_count() or 1
+
+    def get_cgroup_stats(self, cgroup: Cgroup) -> tuple:
+        then, usage_then, rbytes_then, wbytes_then = self.counters[cgroup.path]
+        now, usage, rbytes, wbytes = self.counters[cgroup.path] = self.get_counters(cgroup)
+        elapsed = now - then
+
+        cpu_percent = None
+        if usage is not None and usage_then is not None and elapsed > 0:
+            cpu_percent = (usage - usage_then) / (elapsed * 1000000) / self.get_num_cpus(cgroup) * 100
+        read_rate = write_rate = None
+        if rbytes is not None and rbytes_then is not None and elapsed > 0:
+            read_rate, write_rate = (rbytes - rbytes_then) / elapsed, (wbytes - wbytes_then) / elapsed
+
+        mem_used = cgroup.read("memory.current")
+        mem_used = int(mem_used) if mem_used is not None else None
+        mem_max = cgroup.read("memory.max")
+        if mem_max is None or mem_max.strip() == "max":
+            # No limit. The cgroup may use all of the host's memory.
+            mem_max = psutil.virtual_memory().total
+        else:
+            mem_max = int(mem_max)
+        mem_percent = mem_used / mem_max * 100 if mem_used is not None else None
+
+        pids = cgroup.read("pids.current")
+        pids = int(pids) if pids is not None else None
+        return cgroup.path, cpu_percent, mem_used, mem_max, mem_percent, read_rate, write_rate, pids
+
+    def get_stats(self) -> List[tuple]:
+        """ Get cgroup stats since the last call.
+
+        Stats that are not available, because the controller is not enabled,
+        are `None`.
+
+        @returns list of path, CPU %, memory used, memory limit, memory %, bytes read/sec, bytes written/sec, and number of PIDs for each cgroup
+        """
+        return [self.get_cgroup_stats(cgroup) for cgroup in self.cgroups]
+
+    def get_formatted_stats(self) -> List[tuple]:
+        def fmt(value, fn):
+            return fn(value) if value is not None else "-"
+        stats = []
+        for path, cpu, used, limit, percent, r, w, pids in self.get_stats():
+            stats.append((
+                path, fmt(cpu, lambda x: f"{x:.1f}%"), fmt(used, format_bytes), format_bytes(limit),
+                fmt(percent, lambda x: f"{x:.1f}%"), fmt(r, format_bytes), fmt(w, format_bytes), fmt(pids, str)
+            ))
+        return stats
+
+    def get_values(self, delay: int) -> List[dict]:
+        """ Get list of values that represent an `AgentValue`. """
+        values = []
+        for path, cpu, used, limit, percent, r, w, pids in self.get_stats():
+            # The agent's own cgroup is reported as the container
+            prefix = path if self.paths else "Container"
+            for name, value in [
+                ("CPU %", cpu),
+                ("RAM %", percent),
+                ("RAM MB", get_megabytes(used) if used is not None else None),
+                ("Disk R/s", get_megabytes(r) if r is not None else None),
+                ("Disk W/s", get_megabytes(w) if w is not None else None),
+                ("PIDs", pids)
+            ]:
+                if value is not None:
+                    values.append({"name": f"{prefix} {name}", "value": value})
+        return values
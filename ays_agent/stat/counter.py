@@ -0,0 +1,131 @@
+import mmap
+import os
+import psutil
+import struct
+import time
+
+from typing_extensions import Optional
+
+# Layout of the state file. The header contains the boot time of the system
+# the counters were recorded on. Each slot contains a counter's name, value,
+# and the (wall clock) time the value was recorded.
+STATE_MAGIC = b"AYSC"
+STATE_VERSION = 1
+STATE_HEADER = struct.Struct("<4sId")
+STATE_SLOT = struct.Struct("<32sQd")
+STATE_MAX_COUNTERS = 64
+
+# Counters are reset when the system reboots. A boot time that differs by
+# more than this, in seconds, is considered a different boot.
+BOOT_TIME_TOLERANCE = 1
+
+# Maximum age, in seconds, of a persisted value before it is no longer used
+# as a baseline.
+MAX_BASELINE_AGE = 60 * 60
+
+class CounterStore(object):
+    """ Persists the last value of counters in a fixed-size, memory-mapped file.
+
+    Values written to the map survive a crash or restart of the agent, but
+    not a reboot of the system.
+    """
+
+    def __init__(self, path: str, boot_time: Optional[float] = None):
+        self.path = path
+        self.boot_time = psutil.boot_time() if boot_time is None else boot_time
+        size = STATE_HEADER.size + STATE_SLOT.size * STATE_MAX_COUNTERS
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if os.fstat(fd).st_size != size:
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+            self.map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self.slots = {}
+        magic, version, boot_time = STATE_HEADER.unpack_from(self.map, 0)
+        if magic != STATE_MAGIC or version != STATE_VERSION or abs(boot_time - self.boot_time) > BOOT_TIME_TOLERANCE:
+            self.reset()
+            return
+        for slot in range(STATE_MAX_COUNTERS):
+            name, _, _ = STATE_SLOT.unpack_from(self.map, self.get_offset(slot))
+            name = name.rstrip(b"\0").decode()
+            if name:
+                self.slots[name] = slot
+
+    def get_offset(self, slot: int) -> int:
+        return STATE_HEADER.size + STATE_SLOT.size * slot
+
+    def reset(self) -> None:
+        """ Remove all counters. """
+        self.map[:] = bytes(len(self.map))
+        STATE_HEADER.pack_into(self.map, 0, STATE_MAGIC, STATE_VERSION, self.boot_time)
+        self.slots = {}
+
+    def get(self, name: str) -> Optional[tuple[int, float]]:
+        """ Returns the last value and (wall clock) time of a counter. """
+        slot = self.slots.get(name)
+        if slot is None:
+            return None
+        _, value, timestamp = STATE_SLOT.unpack_from(self.map, self.get_offset(slot))
+        return value, timestamp
+
+    def set(self, name: str, value: int, timestamp: float) -> None:
+        slot = self.slots.get(name)
+        if slot is None:
+            if len(self.slots) >= STATE_MAX_COUNTERS:
+                return
+            slot = self.slots[name] = len(self.slots)
+        STATE_SLOT.pack_into(self.map, self.get_offset(slot), name.encode()[:32], value, timestamp)
+
+    def close(self) -> None:
+        self.map.close()
+
+class Counter(object):
+    """ Computes the rate of a monotonically increasing counter.
+
+    Rates are relative to the (monotonic) time elapsed between samples, rather
+    than the nominal interval. If a store is provided, the last sample is
+    persisted so that the first rate after a restart covers the time the
+    agent was not running.
+    """
+
+    def __init__(self, name: str, store: Optional[CounterStore] = None):
+        self.name = name
+        self.store = store
+        self.value = None
+        self.timestamp = None
+
+    def start(self, value: int) -> None:
+        """ Set the counter's baseline. """
+        now, wall = time.monotonic(), time.time()
+        last = self.store.get(self.name) if self.store is not None else None
+        if last is not None:
+            last_value, last_wall = last
+            age = wall - last_wall
+            # The counter must not have been reset since it was persisted
+            if last_value <= value and 0 <= age <= MAX_BASELINE_AGE:
+                self.value, self.timestamp = last_value, now - age
+                return
+        self.value, self.timestamp = value, now
+        self.persist(wall)
+
+    def update(self, value: int) -> float:
+        """ Record a new value of the counter.
+
+        @returns rate, per second, since the last value
+        """
+        now = time.monotonic()
+        if self.value is None or value < self.value:
+            # Not started, or the counter was reset
+            rate = 0.0
+        else:
+            elapsed = now - self.timestamp
+            rate = (value - self.value) / elapsed if elapsed > 0 else 0.0
+        self.value, self.timestamp = value, now
+        self.persist(time.time())
+        return rate
+
+    def persist(self, wall: float) -> None:
+        if self.store is not None:
+            self.store.set(self.name, self.value, wall)
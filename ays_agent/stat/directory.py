@@ -0,0 +1,260 @@
+#
+# Size, file count and oldest file age of directory trees.
+#
+# Walking a tree of millions of files every interval is too slow. The totals
+# of the files directly in each directory are cached, and a directory is only
+# scanned again when it changes. Otherwise, a walk is a single `stat` per
+# directory.
+#
+# On Linux, every directory is watched with inotify, so a walk is a traversal
+# of the cached tree that only scans the directories that had events. Other
+# systems (or when the inotify watch limit is reached) compare the mtime of
+# each directory. A directory's mtime only changes when an entry is created,
+# removed or renamed, not when a file in it is written to, so trees are fully
+# rescanned every `RESCAN_INTERVAL` seconds.
+#
+
+import errno
+import logging
+import os
+import time
+
+from typing import List
+from typing_extensions import Optional
+
+from ays_agent import AgentException
+from ays_agent.watch import (
+    IN_ATTRIB, IN_CLOSE_WRITE, IN_CREATE, IN_DELETE, IN_IGNORED, IN_MODIFY,
+    IN_MOVED_FROM, IN_MOVED_TO, IN_ONLYDIR, IN_Q_OVERFLOW, get_inotify
+)
+
+# Events that change the totals of a directory
+DIR_CHANGED = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_MODIFY | IN_CLOSE_WRITE | IN_ATTRIB
+
+# Time, in nanoseconds, since a directory changed that it is scanned again, as
+# mtimes may be coarser than the time between changes
+RACY_TIME = 2 * 10 ** 9
+
+# Time, in seconds, between full rescans when directories are not watched
+RESCAN_INTERVAL = 60 * 60
+
+class DirNode(object):
+    __slots__ = (
+        "path", "mtime", "dirty", "wd", "children",
+        "bytes", "files", "oldest",
+        "total_bytes", "total_files", "total_oldest"
+    )
+
+    def __init__(self, path: str):
+        self.path = path
+        self.mtime = None
+        # `True` if the directory must be scanned, regardless of its mtime
+        self.dirty = True
+        # inotify watch descriptor
+        self.wd = None
+        # Subdirectories, keyed by name
+        self.children = {}
+        # Totals of the files directly in the directory. `oldest` is the mtime
+        # of the oldest file.
+        self.bytes = 0
+        self.files = 0
+        self.oldest = None
+        # Totals of the directory's tree
+        self.total_bytes = 0
+        self.total_files = 0
+        self.total_oldest = None
+
+class DirectoryMonitor(object):
+    def __init__(self, directories: List[str], watch: bool = True):
+        """
+        @param watch watch directories with inotify, if supported
+        """
+        if not directories:
+            raise AgentException("At least one directory must be provided to monitor directories")
+        self.directories = directories
+        self.roots = [DirNode(os.path.abspath(path)) for path in directories]
+        self.watch = watch
+        self.inotify = None
+        # Nodes keyed by watch descriptor. A directory may be in more than one
+        # tree, when monitored directories are nested.
+        self.watches = {}
+        self.scanned_at = None
+
+    def start(self):
+        if self.watch:
+            self.inotify = get_inotify()
+        self.scanned_at = time.monotonic()
+
+    def stop(self):
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+        self.watches = {}
+        for root in self.roots:
+            for node in self.walk(root):
+                node.wd = None
+                node.dirty = True
+
+    def walk(self, root: DirNode) -> List[DirNode]:
+        """ Returns the nodes of a tree, parents before their children. """
+        nodes = [root]
+        i = 0
+        while i < len(nodes):
+            nodes.extend(nodes[i].children.values())
+            i += 1
+        return nodes
+
+    def add_watch(self, node: DirNode) -> None:
+        try:
+            node.wd = self.inotify.add_watch(node.path, DIR_CHANGED | IN_ONLYDIR)
+        except OSError as exc:
+            if exc.errno not in (errno.ENOSPC, errno.ENOMEM):
+                raise
+            # `fs.inotify.max_user_watches` was reached
+            logging.warning(f"Failed to watch directory ({node.path}), comparing mtimes instead: {exc}")
+            self.stop()
+            return
+        self.watches.setdefault(node.wd, []).append(node)
+
+    def remove_watches(self, node: DirNode) -> None:
+        """ Stop watching a directory, and its subdirectories, that was removed from a tree. """
+        for n in self.walk(node):
+            nodes = self.watches.get(n.wd)
+            if nodes is None:
+                continue
+            nodes.remove(n)
+            if not nodes:
+                del self.watches[n.wd]
+                self.inotify.remove_watch(n.wd)
+
+    def read_events(self) -> None:
+        """ Mark the directories that had events as dirty. """
+        for wd, mask, _ in self.inotify.read(0):
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost
+                logging.warning("Directory events were lost. Rescanning all directories.")
+                for root in self.roots:
+                    for node in self.walk(root):
+                        node.dirty = True
+                continue
+            if mask & IN_IGNORED:
+                # Directory was removed. Its parent drops it when scanned.
+                for node in self.watches.pop(wd, []):
+                    node.wd = None
+                    node.dirty = True
+                continue
+            for node in self.watches.get(wd, []):
+                node.dirty = True
+
+    def scan(self, node: DirNode) -> None:
+        """ Total the files directly in a directory. """
+        if self.inotify is not None and node.wd is None:
+            # Watched before it is scanned, so that changes made while it is
+            # scanned are not missed
+            self.add_watch(node)
+        node.dirty = False
+        size = files = 0
+        oldest = None
+        children = {}
+        with os.scandir(node.path) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        children[entry.name] = node.children.get(entry.name) or DirNode(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        st = entry.stat(follow_symlinks=False)
+                        size += st.st_size
+                        files += 1
+                        if oldest is None or st.st_mtime < oldest:
+                            oldest = st.st_mtime
+                except OSError:
+                    # Removed while scanning
+                    continue
+        if self.inotify is not None:
+            for name, child in node.children.items():
+                if name not in children:
+                    self.remove_watches(child)
+        node.children = children
+        node.bytes, node.files, node.oldest = size, files, oldest
+
+    def update(self, root: DirNode) -> bool:
+        """ Scan the directories of a tree that changed, and update its totals.
+
+        @returns `False` if the directory does not exist
+        """
+        nodes = [root]
+        i = 0
+        while i < len(nodes):
+            node = nodes[i]
+            i += 1
+            try:
+                if self.inotify is None:
+                    mtime = os.stat(node.path).st_mtime_ns
+                    if mtime != node.mtime:
+                        node.dirty = True
+                    # The mtime is read before the directory is scanned, so
+                    # that changes made while it is scanned are picked up by
+                    # the next update
+                    node.mtime = mtime
+                if node.dirty:
+                    self.scan(node)
+                    if self.inotify is None and time.time_ns() - node.mtime < RACY_TIME:
+                        # Changes made in the same tick of the filesystem's
+                        # clock would not change the mtime. Scan it again.
+                        node.dirty = True
+            except OSError:
+                if node is root:
+                    root.children = {}
+                    root.mtime = None
+                    root.dirty = True
+                    return False
+                # Removed since its parent was scanned, or not readable
+                node.dirty = True
+                node.bytes, node.files, node.oldest = 0, 0, None
+                node.children = {}
+                continue
+            nodes.extend(node.children.values())
+        for node in reversed(nodes):
+            node.total_bytes, node.total_files, node.total_oldest = node.bytes, node.files, node.oldest
+            for child in node.children.values():
+                node.total_bytes += child.total_bytes
+                node.total_files += child.total_files
+                if child.total_oldest is not None and (node.total_oldest is None or child.total_oldest < node.total_oldest):
+                    node.total_oldest = child.total_oldest
+        return True
+
+    def get_stats(self) -> List[tuple[str, int, int, Optional[float]]]:
+        """ Get the totals of each directory.
+
+        @returns list of directory, bytes, number of files, and age, in seconds, of the oldest file
+        """
+        if self.inotify is not None:
+            self.read_events()
+        elif time.monotonic() - self.scanned_at >= RESCAN_INTERVAL:
+            # Files may have been written to without their directory changing
+            for root in self.roots:
+                for node in self.walk(root):
+                    node.dirty = True
+            self.scanned_at = time.monotonic()
+        stats = []
+        now = time.time()
+        for path, root in zip(self.directories, self.roots):
+            if not self.update(root):
+                logging.warning(f"Directory ({path}) does not exist")
+                stats.append((path, 0, 0, None))
+                continue
+            age = max(now - root.total_oldest, 0) if root.total_oldest is not None else None
+            stats.append((path, root.total_bytes, root.total_files, age))
+        return stats
+
+    def get_formatted_stats(self) -> List[str]:
+        return [f"{path}: {size}B, {files} files" for path, size, files, _ in self.get_stats()]
+
+    def get_values(self, delay: int) -> List[dict]:
+        """ Get list of values that represent an `AgentValue`. """
+        values = []
+        for path, size, files, age in self.get_stats():
+            values.append({"name": f"Dir Bytes ({path})", "value": size})
+            values.append({"name": f"Dir Files ({path})", "value": files})
+            values.append({"name": f"Dir Oldest File Age ({path})", "value": round(age) if age is not None else 0})
+        return values
@@ -1,37 +1,219 @@
+import fnmatch
 import logging
+import os
 import psutil
+import re
+import select
 import sys
+import time
 
+from concurrent import futures
 from typing import List
 from typing_extensions import Optional
 
+from ays_agent.collector import WorkerPool
 from ays_agent.stat import format_bytes, get_base, get_megabytes, get_default_mountpoint
+from ays_agent.stat.counter import Counter, CounterStore
+
+PROC_MOUNTINFO = "/proc/self/mountinfo"
+
+# Filesystems that are not backed by a disk
+PSEUDO_FILESYSTEMS = [
+    "autofs", "binfmt_misc", "bpf", "cgroup", "cgroup2", "configfs", "debugfs",
+    "devfs", "devpts", "devtmpfs", "efivarfs", "fusectl", "hugetlbfs", "mqueue",
+    "nsfs", "proc", "pstore", "ramfs", "rpc_pipefs", "securityfs", "selinuxfs",
+    "squashfs", "sysfs", "tmpfs", "tracefs"
+]
+
+# Time, in seconds, the mount table is cached on systems where changes to the
+# mount table can not be watched.
+MOUNT_TABLE_TTL = 60
+
+def unescape_mount(path: str) -> str:
+    """ Unescape octal characters (e.g. `\\040` is a space) in a mount path. """
+    return re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), path)
+
+def parse_mountinfo(data: str) -> List[tuple[str, str, str]]:
+    """ Parse the contents of `/proc/self/mountinfo`.
+
+    Pseudo filesystems, and bind mounts of a device that is already mounted,
+    are ignored.
+
+    @returns list of mountpoint, filesystem type, and device
+    """
+    mounts = []
+    devices = set()
+    for line in data.splitlines():
+        pre, _, post = line.partition(" - ")
+        pre, post = pre.split(), post.split()
+        if len(pre) < 6 or len(post) < 2:
+            continue
+        device_id, mountpoint = pre[2], unescape_mount(pre[4])
+        fstype, device = post[0], post[1]
+        if fstype in PSEUDO_FILESYSTEMS or device_id in devices:
+            continue
+        devices.add(device_id)
+        mounts.append((mountpoint, fstype, device))
+    return mounts
+
+class MountTable(object):
+    """ The real (disk backed) mounts of the system.
+
+    On Linux, the mount table is cached until the kernel signals that it
+    changed. Other systems refresh the mount table every `MOUNT_TABLE_TTL`
+    seconds.
+    """
 
-class DiskMonitor(object):
     def __init__(self, path: Optional[str] = None):
+        self.path = path or PROC_MOUNTINFO
+        self.fd = None
+        self.poller = None
+        self.mounts = None
+        self.refreshed_at = None
+        try:
+            self.fd = os.open(self.path, os.O_RDONLY)
+            self.poller = select.poll()
+            self.poller.register(self.fd, select.POLLPRI | select.POLLERR)
+        except (OSError, AttributeError):
+            # Not Linux. `select.poll` is not available on Windows.
+            self.fd = None
+
+    def changed(self) -> bool:
+        if self.mounts is None:
+            return True
+        if self.poller is not None:
+            return bool(self.poller.poll(0))
+        return time.monotonic() - self.refreshed_at >= MOUNT_TABLE_TTL
+
+    def read(self) -> List[tuple[str, str, str]]:
+        if self.fd is None:
+            return [(p.mountpoint, p.fstype, p.device) for p in psutil.disk_partitions(all=False)]
+        os.lseek(self.fd, 0, os.SEEK_SET)
+        chunks = []
+        while True:
+            chunk = os.read(self.fd, 65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return parse_mountinfo(b"".join(chunks).decode(errors="replace"))
+
+    def close(self) -> None:
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        self.poller = None
+        self.mounts = None
+
+    def get_mounts(self) -> List[tuple[str, str, str]]:
+        """ Returns list of mountpoint, filesystem type, and device of each real mount. """
+        if self.changed():
+            self.mounts = self.read()
+            self.refreshed_at = time.monotonic()
+        return self.mounts
+
+class DiskMonitor(object):
+    def __init__(self, path: Optional[str] = None, mounts: Optional[List[str]] = None, mount_timeout: float = 5, max_workers: int = 16, store: Optional[CounterStore] = None):
         # Disk path (mountpoint) to monitor
         self.path = path or get_default_mountpoint()
+        # Glob patterns of additional mountpoints to monitor e.g. `*` for all
+        # real mounts, or `/data*`.
+        self.mounts = mounts
+        # Time, in seconds, to wait for the usage of all mounts
+        self.mount_timeout = mount_timeout
+        self.max_workers = max_workers
+        self.mount_table = None
+        self.pool = None
+        # Mountpoints whose usage has been requested, but not yet returned
+        self.pending = {}
         self.bytes_read = 0
         self.bytes_written = 0
+        self.read_counter = Counter("disk.read_bytes", store)
+        self.write_counter = Counter("disk.write_bytes", store)
 
     def start(self):
-        """ Start monitoring network traffic. """
+        """ Start monitoring disk I/O. """
         io = psutil.disk_io_counters()
         self.bytes_read, self.bytes_written = io.read_bytes, io.write_bytes
+        self.read_counter.start(io.read_bytes)
+        self.write_counter.start(io.write_bytes)
+
+    def stop(self):
+        """ Close the mount table. It is re-opened if the monitor is started again. """
+        if self.mount_table is not None:
+            self.mount_table.close()
+            self.mount_table = None
+
+    def get_mount_table(self) -> MountTable:
+        if self.mount_table is None:
+            self.mount_table = MountTable()
+        return self.mount_table
 
     def get_num_disk(self):
         """ Get the number of physical devices. Ignores pseudo, memory, duplicate, etc. """
-        disks = psutil.disk_partitions(all=False)
-        return len(disks)
+        return len(self.get_mount_table().get_mounts())
+
+    def get_mountpoints(self) -> List[str]:
+        """ Get the mountpoints that match the configured mount patterns. """
+        if not self.mounts:
+            return []
+        mountpoints = []
+        for mountpoint, _, _ in self.get_mount_table().get_mounts():
+            if any(fnmatch.fnmatchcase(mountpoint, p) for p in self.mounts):
+                mountpoints.append(mountpoint)
+        return mountpoints
+
+    def get_mount_stats(self) -> List[tuple[str, int, int, float]]:
+        """ Get the usage of all monitored mounts.
+
+        The usage of each mount is requested concurrently. Mounts that do not
+        respond within `mount_timeout` (e.g. a hung NFS mount) are skipped. They are
+        not requested again until their last request returns.
+
+        @returns list of mountpoint, total, used, and percent
+        """
+        mountpoints = self.get_mountpoints()
+        if not mountpoints:
+            return []
+        if self.pool is None:
+            self.pool = WorkerPool(0)
+        for mountpoint in mountpoints:
+            if mountpoint not in self.pending:
+                self.pending[mountpoint] = self.pool.submit(psutil.disk_usage, mountpoint)
+        # A worker per request, including requests of hung mounts, so that
+        # mounts added since the last call, or blocked behind a hung mount,
+        # are requested in parallel
+        self.pool.resize(min(len(self.pending), self.max_workers))
+        deadline = time.monotonic() + self.mount_timeout
+        stats = []
+        for mountpoint in mountpoints:
+            future = self.pending[mountpoint]
+            try:
+                usage = future.result(timeout=max(deadline - time.monotonic(), 0))
+            except futures.TimeoutError:
+                logging.warning(f"Disk usage of ({mountpoint}) did not return within {self.mount_timeout}s")
+                continue
+            except OSError as exc:
+                logging.warning(f"Failed to get disk usage of ({mountpoint}): {exc}")
+                del self.pending[mountpoint]
+                continue
+            del self.pending[mountpoint]
+            stats.append((mountpoint, usage.total, usage.used, usage.percent))
+        # Forget requests for mounts that have since been unmounted
+        for mountpoint in [m for m, f in self.pending.items() if m not in mountpoints and f.done()]:
+            del self.pending[mountpoint]
+        return stats
 
     def get_stats(self, delay: int) -> tuple[int, int, int, int, int, int]:
-        """ Get disk stats from last delay.
+        """ Get disk stats since the last call.
+
+        Rates are relative to the time elapsed since the last call, rather
+        than `delay`.
 
-        @returns total, used, percent, total bytes read, total bytes written, bytes read, bytes written
+        @returns total, used, percent, total bytes read, total bytes written, bytes read/sec, bytes written/sec
         """
         usage = psutil.disk_usage(self.path)
         io = psutil.disk_io_counters()
-        num_read, num_written = (io.read_bytes - self.bytes_read) / delay, (io.write_bytes - self.bytes_written) / delay
+        num_read, num_written = self.read_counter.update(io.read_bytes), self.write_counter.update(io.write_bytes)
         self.bytes_read, self.bytes_written = io.read_bytes, io.write_bytes
         return usage.total, usage.used, usage.percent, self.bytes_read, self.bytes_written, num_read, num_written
 
@@ -50,4 +232,7 @@ class DiskMonitor(object):
             {"name": "Disk Used %", "value": percent},
             {"name": "Disk R/s", "value": get_megabytes(bytes_r)},
             {"name": "Disk W/s", "value": get_megabytes(bytes_w)}
+        ] + [
+            {"name": f"Disk Used % ({mountpoint})", "value": percent}
+            for mountpoint, _, _, percent in self.get_mount_stats()
         ]
@@ -0,0 +1,203 @@
+#
+# Count the log lines that match patterns.
+#
+# Log files are tailed. Only data written since the last read is scanned, and
+# rotated (renamed or truncated) files are followed. All patterns are combined
+# into a single regex, so that lines matching none of the patterns, the vast
+# majority, are skipped in a single pass of the regex engine.
+#
+
+import logging
+import os
+import re
+import time
+
+from typing import List
+
+from ays_agent import AgentException
+
+# Maximum number of bytes read from a file per read call
+READ_SIZE = 1024 * 1024
+
+# Maximum length, in bytes, of a partial line kept until the rest of the line
+# is written. Longer lines are truncated.
+MAX_LINE_LENGTH = 64 * 1024
+
+class LogPattern(object):
+    def __init__(self, name: str, pattern: str):
+        self.name = name
+        try:
+            self.regex = re.compile(pattern.encode(), re.MULTILINE)
+        except re.error as exc:
+            raise AgentException(f"Invalid log pattern ({pattern}): {exc}")
+        self.pattern = pattern
+
+def parse_pattern(pattern: str) -> LogPattern:
+    """ Parse a log pattern in the format `name=regex`. """
+    name, sep, regex = pattern.partition("=")
+    if not sep or not name.strip() or not regex:
+        raise AgentException(f"Invalid log pattern ({pattern}). Log patterns must be in the format `name=regex`")
+    return LogPattern(name.strip(), regex)
+
+class LogMatcher(object):
+    """ Counts the lines that match each pattern. """
+
+    def __init__(self, patterns: List[LogPattern]):
+        self.patterns = patterns
+        # Patterns are wrapped in a non-capturing group so that alternations
+        # within a pattern do not leak into the combined regex.
+        self.regex = re.compile(b"|".join(b"(?:" + p.regex.pattern + b")" for p in patterns), re.MULTILINE)
+
+    def count(self, data: bytes, counts: List[int]) -> None:
+        """ Count the lines in `data` that match each pattern.
+
+        @param data complete lines
+        @param counts number of matches of each pattern, which is updated
+        """
+        search = self.regex.search
+        single = len(self.patterns) == 1
+        pos = 0
+        while True:
+            m = search(data, pos)
+            if m is None:
+                break
+            start = data.rfind(b"\n", 0, m.start()) + 1
+            end = data.find(b"\n", m.end())
+            if end < 0:
+                end = len(data)
+            if single and b"\n" not in m.group():
+                counts[0] += 1
+            else:
+                # Only lines that match at least one pattern get here. Find
+                # which patterns match the line.
+                line = data[start:end]
+                for i, p in enumerate(self.patterns):
+                    if p.regex.search(line):
+                        counts[i] += 1
+            pos = end + 1
+
+class LogFile(object):
+    """ Reads the data appended to a file since the last read. """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.fh = None
+        self.inode = None
+        self.offset = 0
+        # Partial line, waiting for the rest of the line to be written
+        self.remainder = b""
+
+    def open(self, from_end: bool) -> bool:
+        try:
+            fh = open(self.path, "rb")
+        except OSError:
+            return False
+        st = os.fstat(fh.fileno())
+        self.fh = fh
+        self.inode = (st.st_dev, st.st_ino)
+        self.offset = st.st_size if from_end else 0
+        self.remainder = b""
+        return True
+
+    def start(self) -> None:
+        """ Start tailing from the end of the file. Existing data is not read. """
+        self.open(from_end=True)
+
+    def read_chunks(self):
+        """ Yields the complete lines written since the last read, in chunks. """
+        while True:
+            data = os.pread(self.fh.fileno(), READ_SIZE, self.offset)
+            if not data:
+                return
+            self.offset += len(data)
+            end = data.rfind(b"\n")
+            if end < 0:
+                self.remainder = (self.remainder + data)[-MAX_LINE_LENGTH:]
+                continue
+            chunk = self.remainder + data[:end + 1] if self.remainder else data[:end + 1]
+            self.remainder = data[end + 1:][-MAX_LINE_LENGTH:]
+            yield chunk
+
+    def read(self):
+        """ Yields the complete lines written since the last read.
+
+        Follows the file if it was rotated. The rest of a file that was
+        renamed is read before the new file.
+        """
+        if self.fh is None:
+            # File did not exist. Any data written since it was created is new.
+            if not self.open(from_end=False):
+                return
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            st = None
+        yield from self.read_chunks()
+        if st is None:
+            return
+        if (st.st_dev, st.st_ino) != self.inode:
+            # File was rotated (renamed). Data may have been written to the
+            # old file after it was read.
+            yield from self.read_chunks()
+            self.close()
+            if self.open(from_end=False):
+                yield from self.read_chunks()
+        elif st.st_size < self.offset:
+            # File was truncated
+            self.offset = 0
+            self.remainder = b""
+            yield from self.read_chunks()
+
+    def close(self) -> None:
+        if self.fh is not None:
+            self.fh.close()
+            self.fh = None
+
+class LogMonitor(object):
+    def __init__(self, files: List[str], patterns: List[LogPattern]):
+        if not files:
+            raise AgentException("At least one log file must be provided to monitor logs")
+        if not patterns:
+            raise AgentException("At least one log pattern must be provided to monitor logs")
+        self.files = [LogFile(path) for path in files]
+        self.matcher = LogMatcher(patterns)
+        self.last_time = None
+
+    def start(self):
+        for f in self.files:
+            f.start()
+        self.last_time = time.monotonic()
+
+    def stop(self):
+        for f in self.files:
+            f.close()
+
+    def get_stats(self) -> tuple[List[int], float]:
+        """ Count the new lines that match each pattern.
+
+        @returns number of matches of each pattern, and the time, in seconds, since the last call
+        """
+        counts = [0] * len(self.matcher.patterns)
+        for f in self.files:
+            try:
+                for chunk in f.read():
+                    self.matcher.count(chunk, counts)
+            except OSError as exc:
+                logging.warning(f"Failed to read log file ({f.path}): {exc}")
+        now = time.monotonic()
+        elapsed = now - self.last_time
+        self.last_time = now
+        return counts, elapsed
+
+    def get_formatted_stats(self) -> List[str]:
+        counts, _ = self.get_stats()
+        return [f"{p.name}: {count}" for p, count in zip(self.matcher.patterns, counts)]
+
+    def get_values(self, delay: int) -> List[dict]:
+        """ Get list of values that represent an `AgentValue`. """
+        counts, elapsed = self.get_stats()
+        values = []
+        for p, count in zip(self.matcher.patterns, counts):
+            values.append({"name": f"Log {p.name}", "value": count})
+            values.append({"name": f"Log {p.name}/sec", "value": count / elapsed if elapsed > 0 else 0})
+        return values
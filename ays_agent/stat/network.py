@@ -1,27 +1,36 @@
 import psutil
 
 from typing import List
+from typing_extensions import Optional
 
 from ays_agent.stat import format_bytes, get_base, get_megabytes
+from ays_agent.stat.counter import Counter, CounterStore
 
 class NetworkMonitor(object):
-    def __init__(self):
+    def __init__(self, store: Optional[CounterStore] = None):
         self.bytes_sent = 0
         self.bytes_recv = 0
+        self.sent_counter = Counter("net.bytes_sent", store)
+        self.recv_counter = Counter("net.bytes_recv", store)
 
     def start(self):
         """ Start monitoring network traffic. """
         io = psutil.net_io_counters()
         self.bytes_sent, self.bytes_recv = io.bytes_sent, io.bytes_recv
+        self.sent_counter.start(io.bytes_sent)
+        self.recv_counter.start(io.bytes_recv)
 
     def get_stats(self, delay: int) -> tuple[int, int, int, int]:
-        """ Get network stats since last delay.
+        """ Get network stats since the last call.
+
+        Speeds are relative to the time elapsed since the last call, rather
+        than `delay`.
 
         @returns the number of bytes sent, bytes received, upload speed, and
         download speed.
         """
         io = psutil.net_io_counters()
-        up_speed, dl_speed = (io.bytes_sent - self.bytes_sent) / delay, (io.bytes_recv - self.bytes_recv) / delay
+        up_speed, dl_speed = self.sent_counter.update(io.bytes_sent), self.recv_counter.update(io.bytes_recv)
         self.bytes_sent, self.bytes_recv = io.bytes_sent, io.bytes_recv
         return self.bytes_sent, self.bytes_recv, up_speed, dl_speed
 
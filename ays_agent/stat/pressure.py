@@ -0,0 +1,184 @@
+import logging
+import os
+import select
+
+from typing import List
+from typing_extensions import Optional
+
+from ays_agent import AgentException
+
+PRESSURE_ROOT = "/proc/pressure"
+PRESSURE_RESOURCES = ["cpu", "memory", "io"]
+PRESSURE_KINDS = ["some", "full"]
+PRESSURE_NAMES = {"cpu": "CPU", "memory": "RAM", "io": "IO"}
+
+# Limits of a PSI trigger's window, in microseconds, imposed by the kernel
+TRIGGER_MIN_WINDOW = 500000
+TRIGGER_MAX_WINDOW = 10000000
+
+PRESSURE_READ_SIZE = 256
+
+def parse_pressure(data: str) -> dict:
+    """ Parse the contents of a `/proc/pressure/*` file.
+
+    @returns dict of `{kind: (avg10, avg60, avg300, total)}` where `kind` is `some` or `full`
+    """
+    pressure = {}
+    for line in data.splitlines():
+        parts = line.split()
+        if not parts or parts[0] not in PRESSURE_KINDS:
+            continue
+        fields = dict(p.split("=") for p in parts[1:])
+        pressure[parts[0]] = (
+            float(fields["avg10"]),
+            float(fields["avg60"]),
+            float(fields["avg300"]),
+            int(fields["total"])
+        )
+    return pressure
+
+class PressureTrigger(object):
+    """ A PSI trigger that fires when a resource stalls for `stall` µs within a `window` of µs. """
+
+    def __init__(self, resource: str, kind: str, stall: int, window: int):
+        if resource not in PRESSURE_RESOURCES:
+            raise AgentException(f"Invalid pressure resource ({resource}). Available options are ({', '.join(PRESSURE_RESOURCES)})")
+        if kind not in PRESSURE_KINDS:
+            raise AgentException(f"Invalid pressure kind ({kind}). Available options are ({', '.join(PRESSURE_KINDS)})")
+        if window < TRIGGER_MIN_WINDOW or window > TRIGGER_MAX_WINDOW:
+            raise AgentException(f"Pressure trigger window ({window}) must be between {TRIGGER_MIN_WINDOW} and {TRIGGER_MAX_WINDOW} µs")
+        if stall <= 0 or stall > window:
+            raise AgentException(f"Pressure trigger stall ({stall}) must be greater than zero and may not exceed the window ({window})")
+        self.resource = resource
+        self.kind = kind
+        self.stall = stall
+        self.window = window
+        self.fd = None
+
+    def open(self, root: str) -> int:
+        """ Register the trigger with the kernel.
+
+        The trigger remains registered for as long as the file is open.
+        """
+        self.fd = os.open(os.path.join(root, self.resource), os.O_RDWR | os.O_NONBLOCK)
+        try:
+            os.write(self.fd, f"{self.kind} {self.stall} {self.window}\0".encode())
+        except OSError:
+            self.close()
+            raise
+        return self.fd
+
+    def close(self) -> None:
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+def parse_trigger(trigger: str) -> PressureTrigger:
+    """ Parse a trigger in the format `resource:kind:stall:window`.
+
+    e.g. `memory:some:150000:1000000` fires when memory stalls for 150ms within 1s.
+    """
+    parts = trigger.split(":")
+    if len(parts) != 4:
+        raise AgentException(f"Invalid pressure trigger ({trigger}). Expected format is `resource:kind:stall:window`")
+    return PressureTrigger(parts[0], parts[1], int(parts[2]), int(parts[3]))
+
+class PressureMonitor(object):
+    def __init__(self, triggers: Optional[List[PressureTrigger]] = None, root: Optional[str] = None):
+        self.root = root or PRESSURE_ROOT
+        self.triggers = triggers or []
+        self.fds = {}
+        self.totals = {}
+        self.poller = None
+
+    def start(self):
+        """ Start monitoring pressure and register triggers, if any. """
+        self.stop()
+        for resource in PRESSURE_RESOURCES:
+            try:
+                self.fds[resource] = os.open(os.path.join(self.root, resource), os.O_RDONLY)
+            except OSError:
+                # PSI is not supported, or disabled, on this system
+                pass
+        self.totals = self.get_totals()
+        registered = 0
+        poller = select.poll()
+        for trigger in self.triggers:
+            try:
+                poller.register(trigger.open(self.root), select.POLLPRI)
+                registered += 1
+            except OSError as exc:
+                # The agent is unprivileged, the window is not allowed, or
+                # triggers are not supported. Pressure is still reported every
+                # interval.
+                logging.warning(f"Failed to register pressure trigger ({trigger.resource}:{trigger.kind}:{trigger.stall}:{trigger.window}): {exc}")
+        if registered:
+            self.poller = poller
+
+    def stop(self):
+        for fd in self.fds.values():
+            os.close(fd)
+        self.fds = {}
+        for trigger in self.triggers:
+            trigger.close()
+        self.poller = None
+
+    def read(self, resource: str) -> dict:
+        fd = self.fds.get(resource)
+        if fd is None:
+            return {}
+        return parse_pressure(os.pread(fd, PRESSURE_READ_SIZE, 0).decode())
+
+    def get_totals(self) -> dict:
+        """ Returns the total stall time, in µs, of each resource. """
+        totals = {}
+        for resource in self.fds:
+            for kind, (_, _, _, total) in self.read(resource).items():
+                totals[(resource, kind)] = total
+        return totals
+
+    def wait(self, timeout: Optional[float] = None) -> List[PressureTrigger]:
+        """ Wait for one or more triggers to fire.
+
+        @param timeout in seconds. Waits indefinitely if `None`.
+        @returns the triggers that fired, if any
+        """
+        if self.poller is None:
+            return []
+        events = self.poller.poll(None if timeout is None else timeout * 1000)
+        fired = []
+        for fd, event in events:
+            if event & select.POLLERR:
+                raise AgentException("Pressure triggers are no longer supported by the monitored files")
+            fired.extend(t for t in self.triggers if t.fd == fd)
+        return fired
+
+    def get_stats(self) -> List[tuple[str, str, float, float, float]]:
+        """ Get pressure stats since the last call.
+
+        @returns list of resource, kind, avg10, avg60, and stall time (µs) since the last call
+        """
+        last = self.totals
+        self.totals = {}
+        stats = []
+        for resource in self.fds:
+            for kind, (avg10, avg60, _, total) in self.read(resource).items():
+                key = (resource, kind)
+                self.totals[key] = total
+                stats.append((resource, kind, avg10, avg60, total - last.get(key, total)))
+        return stats
+
+    def get_formatted_stats(self) -> List[tuple[str, str, str, str, str]]:
+        return [(r, k, f"{a10}%", f"{a60}%", f"{stall / 1000:.1f}ms") for r, k, a10, a60, stall in self.get_stats()]
+
+    def get_values(self, delay: int) -> List[dict]:
+        """ Get list of values that represent an `AgentValue`. """
+        values = []
+        for resource, kind, avg10, avg60, stall in self.get_stats():
+            name = f"PSI {PRESSURE_NAMES[resource]} {kind}"
+            values.extend([
+                {"name": f"{name} avg10", "value": avg10},
+                {"name": f"{name} avg60", "value": avg60},
+                {"name": f"{name} stall ms", "value": stall / 1000}
+            ])
+        return values
@@ -0,0 +1,164 @@
+#
+# Synthetic probes of HTTP(S) and TCP endpoints.
+#
+# All endpoints are probed concurrently, on a single thread, with asyncio. The
+# number of probes in flight is bounded, so that probing many endpoints does
+# not exhaust the agent's file descriptors, or flood the network.
+#
+
+import asyncio
+import math
+import ssl
+import time
+
+from typing import List
+from urllib.parse import urlsplit
+
+from ays_agent import AgentException
+
+PROBE_SCHEMES = ["http", "https", "tcp"]
+
+# Maximum number of endpoints probed at the same time
+MAX_IN_FLIGHT = 100
+
+# Time, in seconds, an endpoint has to respond
+PROBE_TIMEOUT = 5
+
+class Endpoint(object):
+    __slots__ = ("url", "scheme", "host", "port", "path")
+
+    def __init__(self, url: str):
+        parts = urlsplit(url)
+        if parts.scheme not in PROBE_SCHEMES:
+            raise AgentException(f"Invalid probe endpoint ({url}). Available schemes are ({', '.join(PROBE_SCHEMES)})")
+        try:
+            port = parts.port
+        except ValueError:
+            port = None
+        if not parts.hostname or (parts.scheme == "tcp" and not port):
+            raise AgentException(f"Invalid probe endpoint ({url}). A host, and a port for `tcp` endpoints, must be provided")
+        self.url = url
+        self.scheme = parts.scheme
+        self.host = parts.hostname
+        self.port = port or (443 if parts.scheme == "https" else 80)
+        self.path = parts.path or "/"
+        if parts.query:
+            self.path += f"?{parts.query}"
+
+class ProbeResult(object):
+    __slots__ = ("up", "status", "connect", "tls", "ttfb")
+
+    def __init__(self):
+        self.up = False
+        self.status = None
+        # Times, in seconds, since the start of the probe
+        self.connect = None
+        self.tls = None
+        self.ttfb = None
+
+class ProbeProtocol(asyncio.Protocol):
+    """ Waits for the status line of a response. """
+
+    def __init__(self, loop):
+        self.data = bytearray()
+        self.first_byte = None
+        self.status_line = loop.create_future()
+
+    def data_received(self, data: bytes) -> None:
+        if self.first_byte is None:
+            self.first_byte = time.monotonic()
+        self.data += data
+        end = self.data.find(b"\r\n")
+        if end >= 0 and not self.status_line.done():
+            self.status_line.set_result(bytes(self.data[:end]))
+
+    def connection_lost(self, exc) -> None:
+        if not self.status_line.done():
+            self.status_line.set_exception(exc or ConnectionError("Connection closed before response"))
+
+def get_status(status_line: bytes) -> int:
+    """ Returns the status code of an HTTP status line, e.g. `HTTP/1.1 200 OK`. """
+    parts = status_line.split(b" ", 2)
+    if len(parts) < 2 or not parts[0].startswith(b"HTTP/"):
+        raise ValueError(f"Invalid status line ({status_line!r})")
+    return int(parts[1])
+
+class ProbeMonitor(object):
+    def __init__(self, endpoints: List[str], max_in_flight: int = MAX_IN_FLIGHT, probe_timeout: float = PROBE_TIMEOUT):
+        if not endpoints:
+            raise AgentException("At least one endpoint must be provided to probe")
+        self.endpoints = [Endpoint(url) for url in endpoints]
+        self.max_in_flight = max_in_flight
+        self.probe_timeout = probe_timeout
+        # Time the collector waits for all probes to complete
+        self.timeout = probe_timeout * math.ceil(len(self.endpoints) / max_in_flight) + 1
+        self.ssl_context = None
+
+    def start(self):
+        self.ssl_context = ssl.create_default_context()
+
+    async def probe(self, endpoint: Endpoint) -> ProbeResult:
+        """ Probe a single endpoint. """
+        result = ProbeResult()
+        loop = asyncio.get_running_loop()
+        start = time.monotonic()
+        transport, protocol = await loop.create_connection(lambda: ProbeProtocol(loop), endpoint.host, endpoint.port)
+        try:
+            result.connect = time.monotonic() - start
+            if endpoint.scheme == "tcp":
+                result.up = True
+                return result
+            if endpoint.scheme == "https":
+                transport = await loop.start_tls(transport, protocol, self.ssl_context, server_hostname=endpoint.host)
+                result.tls = time.monotonic() - start
+            transport.write(
+                f"GET {endpoint.path} HTTP/1.1\r\n"
+                f"Host: {endpoint.host}\r\n"
+                "User-Agent: ays-agent\r\n"
+                "Connection: close\r\n\r\n".encode()
+            )
+            status_line = await protocol.status_line
+            result.ttfb = protocol.first_byte - start
+            result.status = get_status(status_line)
+            result.up = 200 <= result.status < 400
+            return result
+        finally:
+            transport.close()
+
+    async def probe_all(self) -> List[ProbeResult]:
+        """ Probe all endpoints concurrently. """
+        semaphore = asyncio.Semaphore(self.max_in_flight)
+
+        async def probe(endpoint: Endpoint) -> ProbeResult:
+            async with semaphore:
+                try:
+                    return await asyncio.wait_for(self.probe(endpoint), self.probe_timeout)
+                except (asyncio.TimeoutError, OSError, ValueError):
+                    return ProbeResult()
+
+        return await asyncio.gather(*(probe(e) for e in self.endpoints))
+
+    def get_stats(self) -> List[ProbeResult]:
+        return asyncio.run(self.probe_all())
+
+    def get_formatted_stats(self) -> List[str]:
+        return [f"{e.url}: {'up' if r.up else 'down'}" for e, r in zip(self.endpoints, self.get_stats())]
+
+    def get_values(self, delay: int) -> List[dict]:
+        """ Get list of values that represent an `AgentValue`. """
+        def ms(seconds: float) -> float:
+            return round(seconds * 1000, 3)
+
+        values = []
+        for endpoint, result in zip(self.endpoints, self.get_stats()):
+            name = f"Probe {endpoint.url}"
+            values.append({"name": f"{name} Up", "value": 1 if result.up else 0})
+            if result.status is not None:
+                values.append({"name": f"{name} Status", "value": result.status})
+            if result.connect is not None:
+                values.append({"name": f"{name} Connect ms", "value": ms(result.connect)})
+            if result.tls is not None:
+                values.append({"name": f"{name} TLS ms", "value": ms(result.tls)})
+            if result.ttfb is not None:
+                values.append({"name": f"{name} TTFB ms", "value": ms(result.ttfb)})
+        return values
@@ -0,0 +1,116 @@
+import heapq
+import psutil
+import time
+
+from typing import List
+
+from ays_agent.stat import format_bytes, get_megabytes
+
+class ProcessSample(object):
+    """ Cached state of a single process between ticks. """
+
+    __slots__ = ("pid", "proc", "name", "cpu_time", "timestamp", "cpu_percent", "rss")
+
+    def __init__(self, pid: int):
+        self.pid = pid
+        # `Process` handles are created lazily, the first time the process
+        # is sampled, and re-used on every tick after that.
+        self.proc = None
+        self.name = None
+        self.cpu_time = None
+        self.timestamp = None
+        self.cpu_percent = None
+        self.rss = 0
+
+class ProcessMonitor(object):
+    def __init__(self, top: int = 5, max_scan: int = 2000):
+        # Number of processes to report on
+        self.top = top
+        # Maximum number of processes sampled per tick. When a host has more
+        # processes than this, a rotating window of `max_scan` processes is
+        # sampled each tick, in addition to the current top processes.
+        self.max_scan = max_scan
+        self.samples = {}
+        self.leaders = []
+        self.cursor = 0
+
+    def start(self):
+        """ Start monitoring processes. """
+        self.sample()
+
+    def sample_process(self, sample: ProcessSample, now: float) -> bool:
+        """ Update the CPU and RSS of a single process.
+
+        @returns `False` if the process no longer exists
+        """
+        try:
+            if sample.proc is None:
+                sample.proc = psutil.Process(sample.pid)
+            with sample.proc.oneshot():
+                if sample.name is None:
+                    sample.name = sample.proc.name()
+                times = sample.proc.cpu_times()
+                sample.rss = sample.proc.memory_info().rss
+        except (psutil.NoSuchProcess, psutil.ZombieProcess):
+            return False
+        except psutil.AccessDenied:
+            return True
+        cpu_time = times.user + times.system
+        if sample.cpu_time is not None and cpu_time >= sample.cpu_time and now > sample.timestamp:
+            sample.cpu_percent = (cpu_time - sample.cpu_time) / (now - sample.timestamp) * 100
+        else:
+            # First sample, or the PID was re-used by a new process
+            sample.cpu_percent = None
+        sample.cpu_time, sample.timestamp = cpu_time, now
+        return True
+
+    def sample(self) -> None:
+        """ Sample the next window of processes and update the top processes. """
+        pids = psutil.pids()
+        now = time.monotonic()
+        if self.cursor >= len(pids):
+            # A full pass has been made. Drop the samples of processes that
+            # have exited, but were not re-visited to notice it.
+            alive = set(pids)
+            for pid in [pid for pid in self.samples if pid not in alive]:
+                del self.samples[pid]
+            self.cursor = 0
+        window = pids[self.cursor:self.cursor + self.max_scan]
+        self.cursor += len(window)
+        scan = set(window)
+        scan.update(s.pid for s in self.leaders)
+        for pid in scan:
+            sample = self.samples.get(pid)
+            if sample is None:
+                sample = self.samples[pid] = ProcessSample(pid)
+            if not self.sample_process(sample, now):
+                del self.samples[pid]
+        self.leaders = heapq.nlargest(
+            self.top,
+            (s for s in self.samples.values() if s.cpu_percent is not None),
+            key=lambda s: s.cpu_percent
+        )
+
+    def get_stats(self) -> List[tuple[int, str, float, int]]:
+        """ Get the top processes by CPU utilization.
+
+        @returns list of pid, name, percent CPU utilization (of one core), and RSS bytes
+        """
+        self.sample()
+        return [(s.pid, s.name, s.cpu_percent, s.rss) for s in self.leaders]
+
+    def get_formatted_stats(self) -> List[tuple[int, str, str, str]]:
+        return [(pid, name, f"{usage:.1f}%", format_bytes(rss)) for pid, name, usage, rss in self.get_stats()]
+
+    def get_values(self, delay: int) -> List[dict]:
+        """ Get list of values that represent an `AgentValue`.
+
+        Values are named by rank, e.g. `Top1 CPU %`, rather than by process,
+        so that a process restarting, or the top processes changing, does not
+        create new values. The name and PID of each are in the formatted stats.
+        """
+        values = []
+        for rank, (pid, name, usage, rss) in enumerate(self.get_stats(), 1):
+            values.append({"name": f"Top{rank} CPU %", "value": usage})
+            values.append({"name": f"Top{rank} RSS MB", "value": get_megabytes(rss)})
+        return values
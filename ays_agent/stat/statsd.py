@@ -0,0 +1,283 @@
+#
+# StatsD listener.
+#
+# Applications push counters, gauges, timers and sets to the agent over UDP,
+# or a Unix datagram socket, in the StatsD line format, e.g. `hits:1|c`. Values
+# are aggregated in memory, and the aggregates of each interval are reported
+# with the agent's values.
+#
+# Packets are drained from the socket in batches, and each batch is parsed in
+# a single pass of the regex engine, so that the per-packet cost is mostly the
+# `recv` call.
+#
+
+import logging
+import os
+import re
+import selectors
+import socket
+import threading
+import time
+
+from typing import List
+from urllib.parse import urlsplit
+
+from ays_agent import AgentException
+from ays_agent.sketch import DDSketch, DEFAULT_QUANTILES, get_distribution_values
+
+DEFAULT_LISTEN = "udp://127.0.0.1:8125"
+
+LISTEN_SCHEMES = ["udp", "unix"]
+
+# Maximum size, in bytes, of a packet
+MAX_PACKET_SIZE = 65535
+
+# Maximum number of packets drained from a socket before they are aggregated
+BATCH_SIZE = 1024
+
+# Size, in bytes, of the socket receive buffer requested from the kernel. A
+# larger buffer absorbs bursts while a batch is aggregated.
+RECEIVE_BUFFER_SIZE = 4 * 1024 * 1024
+
+# Maximum number of metrics aggregated per interval. Metrics seen after the
+# limit is reached are dropped, so that a misbehaving client (e.g. one that
+# puts IDs in metric names) can not exhaust the agent's memory.
+MAX_METRICS = 10000
+
+# `name:value|type[|@rate][|#tags]`. Tags are ignored.
+METRIC_LINE = re.compile(rb"^([^:\n|]+):([^|\n]+)\|(c|g|ms|h|d|s)(?:\|@([0-9.]+))?[^\n]*$", re.MULTILINE)
+
+class ListenAddress(object):
+    def __init__(self, address: str):
+        parts = urlsplit(address)
+        if parts.scheme not in LISTEN_SCHEMES:
+            raise AgentException(f"Invalid StatsD address ({address}). Available schemes are ({', '.join(LISTEN_SCHEMES)})")
+        self.address = address
+        self.scheme = parts.scheme
+        if parts.scheme == "unix":
+            self.path = parts.path
+            if not self.path:
+                raise AgentException(f"Invalid StatsD address ({address}). A path must be provided, e.g. `unix:///run/ays-agent/statsd.sock`")
+            return
+        try:
+            port = parts.port
+        except ValueError:
+            port = None
+        if not parts.hostname or port is None:
+            raise AgentException(f"Invalid StatsD address ({address}). A host and port must be provided, e.g. `udp://127.0.0.1:8125`")
+        self.host = parts.hostname
+        self.port = port
+
+    def bind(self) -> socket.socket:
+        if self.scheme == "unix":
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            try:
+                # Remove the socket of an agent that did not exit cleanly
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+            address = self.path
+        else:
+            family = socket.AF_INET6 if ":" in self.host else socket.AF_INET
+            sock = socket.socket(family, socket.SOCK_DGRAM)
+            address = (self.host, self.port)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER_SIZE)
+        except OSError:
+            pass
+        try:
+            sock.bind(address)
+        except OSError as exc:
+            sock.close()
+            raise AgentException(f"Failed to listen for StatsD metrics ({self.address}): {exc}")
+        sock.setblocking(False)
+        return sock
+
+    def close(self) -> None:
+        if self.scheme == "unix":
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+
+class Aggregates(object):
+    """ Metrics received during an interval. """
+
+    def __init__(self, gauges: dict):
+        self.counters = {}
+        # Gauges keep their value until a new value is received
+        self.gauges = gauges
+        self.timers = {}
+        self.sets = {}
+        self.packets = 0
+        self.invalid = 0
+        self.dropped = 0
+
+    def get_size(self) -> int:
+        return len(self.counters) + len(self.gauges) + len(self.timers) + len(self.sets)
+
+    def add(self, data: bytes) -> None:
+        """ Aggregate the metrics of one or more newline delimited packets. """
+        counters, gauges, timers, sets = self.counters, self.gauges, self.timers, self.sets
+        size = self.get_size()
+        matched = 0
+        for name, value, kind, rate in METRIC_LINE.findall(data):
+            matched += 1
+            if kind == b"s":
+                if name not in sets:
+                    if size >= MAX_METRICS:
+                        self.dropped += 1
+                        continue
+                    sets[name] = set()
+                    size += 1
+                sets[name].add(value)
+                continue
+            try:
+                v = float(value)
+            except ValueError:
+                self.invalid += 1
+                continue
+            if kind == b"c":
+                if name not in counters:
+                    if size >= MAX_METRICS:
+                        self.dropped += 1
+                        continue
+                    counters[name] = 0.0
+                    size += 1
+                if rate:
+                    # The client sends a sample of the events
+                    try:
+                        v /= float(rate) or 1
+                    except ValueError:
+                        pass
+                counters[name] += v
+            elif kind == b"g":
+                if name not in gauges:
+                    if size >= MAX_METRICS:
+                        self.dropped += 1
+                        continue
+                    gauges[name] = 0.0
+                    size += 1
+                if value[:1] in (b"+", b"-"):
+                    gauges[name] += v
+                else:
+                    gauges[name] = v
+            else:
+                timer = timers.get(name)
+                if timer is None:
+                    if size >= MAX_METRICS:
+                        self.dropped += 1
+                        continue
+                    timer = timers[name] = DDSketch()
+                    size += 1
+                timer.add(v)
+        # Lines that did not match are invalid. Blank lines (e.g. a trailing
+        # newline) are not.
+        lines = data.split(b"\n")
+        self.invalid += len(lines) - lines.count(b"") - matched
+
+class StatsdMonitor(object):
+    def __init__(self, addresses: List[str] = None, quantiles: List[float] = DEFAULT_QUANTILES):
+        """
+        @param addresses e.g. `udp://127.0.0.1:8125` or `unix:///run/ays-agent/statsd.sock`
+        @param quantiles quantiles, in percent, reported for each timer
+        """
+        self.addresses = [ListenAddress(a) for a in (addresses or [DEFAULT_LISTEN])]
+        self.quantiles = quantiles
+        self.sockets = []
+        self.lock = threading.Lock()
+        self.aggregates = Aggregates({})
+        self.stopped = threading.Event()
+        self.thread = None
+        self.last_time = None
+
+    def start(self):
+        self.stopped.clear()
+        try:
+            for address in self.addresses:
+                self.sockets.append(address.bind())
+        except AgentException:
+            self.stop()
+            raise
+        self.last_time = time.monotonic()
+        self.thread = threading.Thread(target=self.run_forever, name="ays-statsd", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        for sock in self.sockets:
+            sock.close()
+        self.sockets = []
+        for address in self.addresses:
+            address.close()
+
+    def drain(self, sock: socket.socket) -> None:
+        """ Receive the packets waiting on a socket, and aggregate them in batches. """
+        recv = sock.recv
+        while True:
+            packets = []
+            try:
+                for _ in range(BATCH_SIZE):
+                    packets.append(recv(MAX_PACKET_SIZE))
+            except (BlockingIOError, InterruptedError):
+                pass
+            if packets:
+                data = b"\n".join(packets)
+                with self.lock:
+                    self.aggregates.packets += len(packets)
+                    self.aggregates.add(data)
+            if len(packets) < BATCH_SIZE:
+                return
+
+    def run_forever(self) -> None:
+        with selectors.DefaultSelector() as selector:
+            for sock in self.sockets:
+                selector.register(sock, selectors.EVENT_READ)
+            while not self.stopped.is_set():
+                for key, _ in selector.select(timeout=0.5):
+                    try:
+                        self.drain(key.fileobj)
+                    except OSError as exc:
+                        logging.warning(f"Failed to receive StatsD metrics: {exc}")
+
+    def get_stats(self) -> tuple[Aggregates, float]:
+        """ Returns the metrics received since the last call, and the time, in seconds, since the last call. """
+        with self.lock:
+            aggregates = self.aggregates
+            self.aggregates = Aggregates(dict(aggregates.gauges))
+        now = time.monotonic()
+        elapsed = now - self.last_time
+        self.last_time = now
+        if aggregates.dropped:
+            logging.warning(f"Dropped ({aggregates.dropped}) StatsD metrics. More than ({MAX_METRICS}) metrics were received.")
+        return aggregates, elapsed
+
+    def get_formatted_stats(self) -> List[str]:
+        aggregates, _ = self.get_stats()
+        return [
+            f"Packets: {aggregates.packets}",
+            f"Metrics: {aggregates.get_size()}",
+            f"Invalid: {aggregates.invalid}"
+        ]
+
+    def get_values(self, delay: int) -> List[dict]:
+        """ Get list of values that represent an `AgentValue`. """
+        aggregates, elapsed = self.get_stats()
+        values = [
+            {"name": "StatsD Packets", "value": aggregates.packets},
+            {"name": "StatsD Invalid", "value": aggregates.invalid}
+        ]
+        for name, count in aggregates.counters.items():
+            name = name.decode(errors="replace")
+            values.append({"name": name, "value": count})
+            values.append({"name": f"{name}/sec", "value": count / elapsed if elapsed > 0 else 0})
+        for name, value in aggregates.gauges.items():
+            values.append({"name": name.decode(errors="replace"), "value": value})
+        for name, sketch in aggregates.timers.items():
+            values.extend(get_distribution_values(name.decode(errors="replace"), sketch, self.quantiles))
+        for name, members in aggregates.sets.items():
+            values.append({"name": name.decode(errors="replace"), "value": len(members)})
+        return values
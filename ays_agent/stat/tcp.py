@@ -0,0 +1,159 @@
+#
+# TCP socket states.
+#
+# `psutil.net_connections` creates an object per socket, and maps each socket
+# to its process, which takes seconds on hosts with 100k+ sockets. Instead,
+# `/proc/net/tcp{,6}` is read in chunks into a fixed-size buffer and the
+# sockets are counted, by local port and state, by the regex engine.
+#
+
+import collections
+import logging
+import os
+import re
+
+from typing import List
+from typing_extensions import Optional
+
+PROC_NET = "/proc/net"
+
+# Socket states, as they appear in `/proc/net/tcp`
+TCP_STATES = {
+    b"01": "ESTABLISHED",
+    b"06": "TIME_WAIT",
+    b"08": "CLOSE_WAIT",
+    b"0A": "LISTEN"
+}
+TCP_LISTEN = b"0A"
+
+# States reported for each listening port
+PORT_STATES = [b"01", b"06", b"08"]
+
+# Size, in bytes, of the buffer `/proc/net/tcp{,6}` is read into
+BUFFER_SIZE = 256 * 1024
+
+# Local port, state and receive queue length of a socket. The local port is the
+# first `:XXXX ` of an entry. The header, and the remaining fields of an entry,
+# never match.
+SOCKET_ENTRY = re.compile(rb":([0-9A-F]{4}) [0-9A-F]+:[0-9A-F]{4} ([0-9A-F]{2}) [0-9A-F]{8}:([0-9A-F]{8}) ")
+
+class SocketTable(object):
+    """ Counts the sockets of `/proc/net/tcp` formatted files. """
+
+    def __init__(self, buffer_size: int = BUFFER_SIZE):
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+
+    def read(self, path: str, sockets: collections.Counter) -> None:
+        """ Count the sockets of a file.
+
+        @param sockets number of sockets keyed by (port, state, receive queue length), in hex, which is updated
+        """
+        buffer, view = self.buffer, self.view
+        with open(path, "rb", buffering=0) as fh:
+            length = 0
+            while True:
+                n = fh.readinto(view[length:])
+                if not n:
+                    break
+                length += n
+                end = buffer.rfind(b"\n", 0, length) + 1
+                if end == 0:
+                    if length == len(buffer):
+                        raise OSError(f"Line in ({path}) exceeds buffer size ({len(buffer)})")
+                    continue
+                sockets.update(SOCKET_ENTRY.findall(view[:end]))
+                # Move the partial line to the start of the buffer
+                buffer[:length - end] = bytes(view[end:length])
+                length -= end
+            if length:
+                sockets.update(SOCKET_ENTRY.findall(view[:length]))
+
+def read_netstat(path: str) -> dict:
+    """ Returns the `TcpExt` counters of `/proc/net/netstat`. """
+    with open(path, "r") as fh:
+        lines = fh.readlines()
+    for names, values in zip(lines[::2], lines[1::2]):
+        if names.startswith("TcpExt:"):
+            return dict(zip(names.split()[1:], map(int, values.split()[1:])))
+    return {}
+
+class SocketMonitor(object):
+    def __init__(self, ports: Optional[List[int]] = None, root: str = PROC_NET):
+        """
+        @param ports the listening ports to report. Default is all listening ports.
+        @param root path to `/proc/net`
+        """
+        self.ports = ports
+        self.root = root
+        self.table = SocketTable()
+        self.overflows = None
+
+    def start(self):
+        self.get_listen_overflows()
+
+    def get_listen_overflows(self) -> Optional[int]:
+        """ Returns the number of listen queue overflows since the last call. """
+        try:
+            total = read_netstat(os.path.join(self.root, "netstat")).get("ListenOverflows")
+        except OSError:
+            return None
+        if total is None:
+            return None
+        previous, self.overflows = self.overflows, total
+        if previous is None or total < previous:
+            return 0
+        return total - previous
+
+    def get_stats(self) -> tuple[collections.Counter, dict]:
+        """ Count sockets by local port and state.
+
+        @returns number of sockets keyed by (port, state), and accept queue length keyed by listening port
+        """
+        sockets = collections.Counter()
+        for name in ("tcp", "tcp6"):
+            try:
+                self.table.read(os.path.join(self.root, name), sockets)
+            except FileNotFoundError:
+                # IPv6 is disabled
+                pass
+            except OSError as exc:
+                logging.warning(f"Failed to read sockets ({name}): {exc}")
+        states = collections.Counter()
+        queues = {}
+        for (port, state, queue), count in sockets.items():
+            states[(port, state)] += count
+            if state == TCP_LISTEN:
+                # The receive queue of a listening socket is its accept queue
+                queues[port] = queues.get(port, 0) + int(queue, 16) * count
+        return states, queues
+
+    def get_formatted_stats(self) -> List[str]:
+        states, _ = self.get_stats()
+        totals = collections.Counter()
+        for (_, state), count in states.items():
+            totals[state] += count
+        return [f"{TCP_STATES[state]}: {totals[state]}" for state in TCP_STATES]
+
+    def get_values(self, delay: int) -> List[dict]:
+        """ Get list of values that represent an `AgentValue`. """
+        states, queues = self.get_stats()
+        totals = collections.Counter()
+        for (_, state), count in states.items():
+            totals[state] += count
+        values = [
+            {"name": f"Sockets {TCP_STATES[state]}", "value": totals[state]}
+            for state in TCP_STATES if state != TCP_LISTEN
+        ]
+        overflows = self.get_listen_overflows()
+        if overflows is not None:
+            values.append({"name": "Listen Overflows", "value": overflows})
+        ports = sorted(int(port, 16) for port in queues)
+        if self.ports is not None:
+            ports = [port for port in ports if port in self.ports]
+        for port in ports:
+            key = b"%04X" % port
+            for state in PORT_STATES:
+                values.append({"name": f"Sockets {TCP_STATES[state]} (:{port})", "value": states[(key, state)]})
+            values.append({"name": f"Listen Queue (:{port})", "value": queues[key]})
+        return values
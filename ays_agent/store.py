@@ -0,0 +1,174 @@
+#
+# Fixed-size, round-robin store of sampled values.
+#
+# Samples are written to a memory-mapped file. Each series (value name) has a
+# ring of raw samples and two rings of rollups (min, max, sum, count). Rings
+# are overwritten as time passes, so the size of the file never changes and
+# each sample is written in constant time.
+#
+
+import logging
+import mmap
+import os
+import struct
+import time
+
+from typing import List
+from typing_extensions import Optional
+
+STORE_MAGIC = b"AYSS"
+STORE_VERSION = 1
+
+# Number of raw samples kept per series. At the minimum interval of 15s this
+# is more than an hour of samples.
+RAW_SLOTS = 360
+RAW_RETENTION = 60 * 60
+
+# Resolution name, step (seconds) and number of slots of each rollup
+ROLLUPS = [
+    ("1m", 60, 24 * 60),
+    ("10m", 600, 30 * 24 * 6)
+]
+RESOLUTIONS = ["raw"] + [name for name, _, _ in ROLLUPS]
+
+# Maximum length, in bytes, of a series name
+MAX_NAME_LENGTH = 64
+
+HEADER = struct.Struct("<4sII")
+SERIES = struct.Struct(f"<{MAX_NAME_LENGTH}sI4x")
+SAMPLE = struct.Struct("<dd")
+ROLLUP = struct.Struct("<ddddd")
+
+SERIES_SIZE = RAW_SLOTS * SAMPLE.size + sum(slots for _, _, slots in ROLLUPS) * ROLLUP.size
+
+# Maximum number of series names the store remembers refusing, so that each is
+# only logged once
+MAX_DROPPED_SERIES = 1024
+
+def get_series_name(name: str) -> str:
+    """ Returns the name of a series, truncated to the maximum length. """
+    return name.encode()[:MAX_NAME_LENGTH].decode(errors="ignore")
+
+class SampleStore(object):
+    def __init__(self, path: str, max_series: int = 64):
+        self.path = path
+        self.max_series = max_series
+        self.data_offset = HEADER.size + SERIES.size * max_series
+        size = self.data_offset + SERIES_SIZE * max_series
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if os.fstat(fd).st_size != size:
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+            self.map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self.series = {}
+        # Names of the series refused because the store is full, and the
+        # number of samples refused
+        self.dropped = set()
+        self.dropped_samples = 0
+        magic, version, max_series = HEADER.unpack_from(self.map, 0)
+        if magic != STORE_MAGIC or version != STORE_VERSION or max_series != self.max_series:
+            self.map[:] = bytes(size)
+            HEADER.pack_into(self.map, 0, STORE_MAGIC, STORE_VERSION, self.max_series)
+            return
+        for index in range(self.max_series):
+            name, _ = SERIES.unpack_from(self.map, HEADER.size + SERIES.size * index)
+            name = name.rstrip(b"\0").decode(errors="ignore")
+            if name:
+                self.series[name] = index
+
+    def get_names(self) -> List[str]:
+        return list(self.series.keys())
+
+    def get_dropped(self) -> dict:
+        """ Returns the number of series, and samples, refused because the store is full. """
+        return {"series": len(self.dropped), "samples": self.dropped_samples}
+
+    def drop(self, name: str) -> None:
+        self.dropped_samples += 1
+        name = get_series_name(name)
+        if name in self.dropped or len(self.dropped) >= MAX_DROPPED_SERIES:
+            return
+        self.dropped.add(name)
+        logging.warning(f"History is full ({self.max_series} series). Samples of ({name}) will not be stored.")
+
+    def get_series(self, name: str, create: bool = False) -> Optional[int]:
+        """ Returns the index of a series.
+
+        Returns `None` if the series does not exist, or the store is full.
+        """
+        name = get_series_name(name)
+        index = self.series.get(name)
+        if index is None and create and len(self.series) < self.max_series:
+            index = self.series[name] = len(self.series)
+            SERIES.pack_into(self.map, HEADER.size + SERIES.size * index, name.encode(), 0)
+        return index
+
+    def get_raw_offset(self, index: int, slot: int) -> int:
+        return self.data_offset + SERIES_SIZE * index + SAMPLE.size * slot
+
+    def get_rollup_offset(self, index: int, rollup: int, slot: int) -> int:
+        offset = self.data_offset + SERIES_SIZE * index + SAMPLE.size * RAW_SLOTS
+        for _, _, slots in ROLLUPS[:rollup]:
+            offset += ROLLUP.size * slots
+        return offset + ROLLUP.size * slot
+
+    def add(self, name: str, value: float, timestamp: Optional[float] = None) -> bool:
+        """ Add a sample to a series.
+
+        @returns `False` if the sample could not be stored because the store is full
+        """
+        index = self.get_series(name, create=True)
+        if index is None:
+            self.drop(name)
+            return False
+        timestamp = time.time() if timestamp is None else timestamp
+        value = float(value)
+
+        series_offset = HEADER.size + SERIES.size * index
+        _, head = SERIES.unpack_from(self.map, series_offset)
+        SAMPLE.pack_into(self.map, self.get_raw_offset(index, head), timestamp, value)
+        struct.pack_into("<I", self.map, series_offset + MAX_NAME_LENGTH, (head + 1) % RAW_SLOTS)
+
+        for rollup, (_, step, slots) in enumerate(ROLLUPS):
+            bucket = int(timestamp // step) * step
+            offset = self.get_rollup_offset(index, rollup, (bucket // step) % slots)
+            start, low, high, total, count = ROLLUP.unpack_from(self.map, offset)
+            if start != bucket or count == 0:
+                # Slot contains an older bucket, which is overwritten
+                ROLLUP.pack_into(self.map, offset, bucket, value, value, value, 1)
+            else:
+                ROLLUP.pack_into(self.map, offset, bucket, min(low, value), max(high, value), total + value, count + 1)
+        return True
+
+    def query(self, name: str, start: Optional[float] = None, end: Optional[float] = None, resolution: str = "raw") -> Optional[List[dict]]:
+        """ Get the samples, or rollups, of a series between `start` and `end`.
+
+        @returns list of samples ordered by time, or `None` if the series does not exist
+        """
+        index = self.get_series(name)
+        if index is None:
+            return None
+        end = time.time() if end is None else end
+        points = []
+        if resolution == "raw":
+            start = max(start or 0, end - RAW_RETENTION)
+            for slot in range(RAW_SLOTS):
+                timestamp, value = SAMPLE.unpack_from(self.map, self.get_raw_offset(index, slot))
+                if timestamp and start <= timestamp <= end:
+                    points.append({"time": timestamp, "value": value})
+        else:
+            rollup = RESOLUTIONS.index(resolution) - 1
+            _, step, slots = ROLLUPS[rollup]
+            start = max(start or 0, end - step * slots)
+            for slot in range(slots):
+                bucket, low, high, total, count = ROLLUP.unpack_from(self.map, self.get_rollup_offset(index, rollup, slot))
+                if count and bucket + step > start and bucket <= end:
+                    points.append({"time": bucket, "min": low, "max": high, "avg": total / count, "count": int(count)})
+        points.sort(key=lambda p: p["time"])
+        return points
+
+    def close(self) -> None:
+        self.map.close()
@@ -0,0 +1,193 @@
+#
+# Record and replay monitor traces.
+#
+# A trace is the sequence of values the monitors returned, and the time each
+# tick was collected. Replaying a trace feeds the exact same values through
+# the rest of the pipeline, so that changes to the pipeline can be benchmarked
+# without the noise of live monitors.
+#
+# Format: a header (magic, JSON length, JSON), followed by records. Value names
+# are written once, in a name record, and referred to by id, so a tick costs
+# 13 bytes per value.
+#
+#   name record: `N`, id (u32), length (u16), name
+#   tick record: `T`, time (f64), number of values (u32), values
+#   value:       name id (u32), value (f64), flags (u8), [length (u32), JSON]
+#
+
+import json
+import struct
+
+from typing import Iterator, List, Tuple
+from typing_extensions import Optional
+
+from ays_agent import AgentException
+
+TRACE_MAGIC = b"AYSTRC01"
+
+HEADER = struct.Struct("<8sI")
+NAME = struct.Struct("<IH")
+TICK = struct.Struct("<dI")
+VALUE = struct.Struct("<IdB")
+EXTRA = struct.Struct("<I")
+
+# Value flags
+FLAG_STALE = 1
+FLAG_INT = 2
+# Properties, other than the name, value and stale flag, follow the value as JSON
+FLAG_EXTRA = 4
+
+def get_trace_header(config) -> dict:
+    """ Returns the header of a trace recorded with an `AgentConfig`.
+
+    The org secret is not recorded, so that traces can be shared.
+    """
+    return {
+        "msg": {k: v for k, v in config.msg.items() if k != "org_secret"},
+        "interval": config.options.interval,
+        "min_interval": config.options.min_interval,
+        "anomaly_detection": config.options.anomaly_detection,
+        "thresholds": config.thresholds
+    }
+
+class TraceWriter(object):
+    def __init__(self, path: str, header: dict):
+        """
+        @param header describes the config the trace was recorded with
+        """
+        self.path = path
+        self.names = {}
+        self.fh = open(path, "wb")
+        data = json.dumps(header, separators=(",", ":")).encode()
+        self.fh.write(HEADER.pack(TRACE_MAGIC, len(data)) + data)
+        self.fh.flush()
+
+    def get_name_id(self, name: str, chunks: List[bytes]) -> int:
+        name_id = self.names.get(name)
+        if name_id is None:
+            name_id = self.names[name] = len(self.names)
+            data = name.encode()
+            chunks.append(b"N" + NAME.pack(name_id, len(data)) + data)
+        return name_id
+
+    def write(self, now: float, values: List[dict]) -> None:
+        """ Write the values of a tick. The tick is flushed, so that a trace survives the agent being killed. """
+        chunks = []
+        ticks = [b"T" + TICK.pack(now, len(values))]
+        for v in values:
+            name_id = self.get_name_id(v["name"], chunks)
+            value = v["value"]
+            flags = FLAG_STALE if v.get("stale") else 0
+            if isinstance(value, int) and not isinstance(value, bool):
+                flags |= FLAG_INT
+            extra = {k: x for k, x in v.items() if k not in ("name", "value", "stale")}
+            if not isinstance(value, (int, float)):
+                # e.g. `None`. Such values are kept with the other properties.
+                extra["value"] = value
+                value = 0
+            if extra:
+                flags |= FLAG_EXTRA
+                data = json.dumps(extra, separators=(",", ":")).encode()
+                ticks.append(VALUE.pack(name_id, value, flags) + EXTRA.pack(len(data)) + data)
+            else:
+                ticks.append(VALUE.pack(name_id, value, flags))
+        self.fh.write(b"".join(chunks + ticks))
+        self.fh.flush()
+
+    def close(self) -> None:
+        self.fh.close()
+
+class TraceReader(object):
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as fh:
+            self.data = fh.read()
+        if len(self.data) < HEADER.size:
+            raise AgentException(f"Invalid trace ({path}). The file is too small")
+        magic, length = HEADER.unpack_from(self.data)
+        if magic != TRACE_MAGIC:
+            raise AgentException(f"Invalid trace ({path}). The file is not a trace, or was recorded by an incompatible version")
+        try:
+            self.header = json.loads(self.data[HEADER.size:HEADER.size + length])
+        except ValueError as exc:
+            raise AgentException(f"Invalid trace ({path}): {exc}")
+        self.offset = HEADER.size + length
+
+    def read(self) -> Iterator[Tuple[float, List[dict]]]:
+        """ Yields the time, and values, of each tick.
+
+        A tick that was partially written (i.e. the agent was killed while it
+        was written) ends the trace.
+        """
+        data = self.data
+        offset = self.offset
+        names = []
+        try:
+            while offset < len(data):
+                kind = data[offset:offset + 1]
+                offset += 1
+                if kind == b"N":
+                    name_id, length = NAME.unpack_from(data, offset)
+                    offset += NAME.size
+                    name = data[offset:offset + length]
+                    if len(name) != length or name_id != len(names):
+                        return
+                    names.append(name.decode())
+                    offset += length
+                    continue
+                if kind != b"T":
+                    raise AgentException(f"Invalid trace ({self.path}). Unknown record at offset ({offset - 1})")
+                now, count = TICK.unpack_from(data, offset)
+                offset += TICK.size
+                values = []
+                for _ in range(count):
+                    name_id, value, flags = VALUE.unpack_from(data, offset)
+                    offset += VALUE.size
+                    v = {"name": names[name_id], "value": int(value) if flags & FLAG_INT else value}
+                    if flags & FLAG_EXTRA:
+                        length, = EXTRA.unpack_from(data, offset)
+                        offset += EXTRA.size
+                        extra = data[offset:offset + length]
+                        if len(extra) != length:
+                            return
+                        v.update(json.loads(extra))
+                        offset += length
+                    if flags & FLAG_STALE:
+                        v["stale"] = True
+                    values.append(v)
+                yield now, values
+        except struct.error:
+            return
+
+class ReplayMonitor(object):
+    """ Returns the values of a trace, one tick per call. """
+
+    def __init__(self, ticks: List[Tuple[float, List[dict]]]):
+        self.ticks = ticks
+        self.index = 0
+
+    def start(self):
+        pass
+
+    def get_time(self) -> float:
+        """ Returns the recorded time of the last tick returned. """
+        return self.ticks[max(self.index - 1, 0)][0]
+
+    def get_stats(self) -> Optional[Tuple[float, List[dict]]]:
+        if self.index >= len(self.ticks):
+            return None
+        tick = self.ticks[self.index]
+        self.index += 1
+        return tick
+
+    def get_formatted_stats(self) -> List[str]:
+        tick = self.get_stats()
+        return [] if tick is None else [f"{v['name']}: {v['value']}" for v in tick[1]]
+
+    def get_values(self, delay: int) -> List[dict]:
+        """ Get list of values that represent an `AgentValue`. """
+        tick = self.get_stats()
+        if tick is None:
+            return []
+        # The values are copied, as the pipeline may modify them
+        return [dict(v) for v in tick[1]]
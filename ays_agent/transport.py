@@ -0,0 +1,181 @@
+#
+# Send requests to one of many @ys endpoints.
+#
+# The health of each endpoint is tracked passively, from the requests that are
+# made to it. Requests are sent to the healthiest endpoint (lowest latency and
+# error rate) and fail over, immediately, to the next healthiest endpoint. An
+# endpoint that fails repeatedly is removed from rotation (its circuit breaker
+# opens) until a background probe finds that it recovered.
+#
+
+import logging
+import threading
+import time
+
+from typing import List
+from typing_extensions import Optional
+
+import requests
+
+from ays_agent.collector import CircuitBreaker
+
+# Weight of the most recent request in an endpoint's latency and error rate
+HEALTH_ALPHA = 0.2
+
+# Latency, in seconds, an error adds to an endpoint's score. An endpoint that
+# fails half of its requests is scored as if it were 5s slower.
+ERROR_PENALTY = 10
+
+# Time, in seconds, for an endpoint's error rate to halve. The error rate of an
+# endpoint that no longer receives requests (e.g. a primary that failed over)
+# decays, so that it is eventually preferred, and tried, again.
+ERROR_HALF_LIFE = 60
+
+# Error rates below this are considered 0, so that a recovered endpoint is
+# ranked by its order of preference again
+MIN_ERROR_RATE = 0.01
+
+# Time, in seconds, a request has before the next endpoint is tried
+REQUEST_TIMEOUT = 10
+
+# Time, in seconds, between probes of an endpoint removed from rotation
+PROBE_INTERVAL = 30
+
+class Endpoint(object):
+    def __init__(self, url: str, max_failures: int = 3, cooldown: float = PROBE_INTERVAL):
+        self.url = url
+        self.breaker = CircuitBreaker(max_failures=max_failures, cooldown=cooldown)
+        # EWMA of the latency, in seconds, of responses
+        self.latency = None
+        # EWMA of the rate of failed requests, as of `updated_at`
+        self.error_rate = 0.0
+        self.updated_at = time.monotonic()
+
+    def get_error_rate(self, now: Optional[float] = None) -> float:
+        """ Returns the error rate, decayed by the time since it was last updated. """
+        now = time.monotonic() if now is None else now
+        rate = self.error_rate * 0.5 ** (max(now - self.updated_at, 0) / ERROR_HALF_LIFE)
+        return rate if rate >= MIN_ERROR_RATE else 0.0
+
+    def get_score(self, now: Optional[float] = None) -> float:
+        """ Returns the score of the endpoint. Lower is healthier. """
+        return (self.latency or 0) + self.get_error_rate(now) * ERROR_PENALTY
+
+    def success(self, latency: float, now: Optional[float] = None) -> None:
+        now = time.monotonic() if now is None else now
+        self.latency = latency if self.latency is None else self.latency + HEALTH_ALPHA * (latency - self.latency)
+        error_rate = self.get_error_rate(now)
+        self.error_rate, self.updated_at = error_rate - HEALTH_ALPHA * error_rate, now
+        self.breaker.success()
+
+    def failure(self, now: Optional[float] = None) -> None:
+        now = time.monotonic() if now is None else now
+        error_rate = self.get_error_rate(now)
+        self.error_rate, self.updated_at = error_rate + HEALTH_ALPHA * (1 - error_rate), now
+        self.breaker.failure(now)
+
+def parse_servers(server: str) -> List[str]:
+    """ Returns the URLs of a comma delimited list of servers. """
+    return [s.strip() for s in server.split(",") if s.strip()]
+
+class EndpointPool(object):
+    def __init__(
+        self,
+        urls: List[str],
+        timeout: float = REQUEST_TIMEOUT,
+        max_failures: int = 3,
+        probe_interval: float = PROBE_INTERVAL,
+        session: Optional[requests.Session] = None
+    ):
+        """
+        @param urls endpoints, in order of preference
+        @param timeout time, in seconds, a request has before the next endpoint is tried
+        @param max_failures consecutive failures before an endpoint is removed from rotation
+        @param probe_interval time, in seconds, between probes of an endpoint removed from rotation
+        """
+        self.endpoints = [Endpoint(url, max_failures, probe_interval) for url in urls]
+        self.timeout = timeout
+        self.probe_interval = probe_interval
+        self.session = session or requests.Session()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def get_endpoints(self) -> List[Endpoint]:
+        """ Returns the endpoints in rotation, healthiest first.
+
+        If all endpoints are out of rotation, all endpoints are returned, as
+        failing to report is worse than a slow report.
+        """
+        with self.lock:
+            endpoints = [e for e in self.endpoints if not e.breaker.is_open()] or list(self.endpoints)
+            # `sorted` is stable. Endpoints with the same score keep their order of preference.
+            now = time.monotonic()
+            return sorted(endpoints, key=lambda e: e.get_score(now))
+
+    def send(self, **kwargs) -> Optional[requests.Response]:
+        """ POST a request to the healthiest endpoint, failing over to the next.
+
+        @param kwargs arguments of `requests.post`
+        @returns the response, or `None` if no endpoint could be reached
+        """
+        for endpoint in self.get_endpoints():
+            start = time.monotonic()
+            try:
+                resp = self.session.post(endpoint.url, timeout=self.timeout, **kwargs)
+            except requests.RequestException as exc:
+                logging.warning(f"Failed to make request to ({endpoint.url}): {exc}")
+                resp = None
+            with self.lock:
+                if resp is not None and resp.status_code < 500:
+                    # NOTE: A 4xx response means the request, not the
+                    # endpoint, is invalid. Another endpoint would reject it too.
+                    endpoint.success(time.monotonic() - start)
+                    return resp
+                endpoint.failure()
+            self.start_probing()
+        return None
+
+    def probe(self, endpoint: Endpoint) -> bool:
+        """ Returns `True` if the endpoint responds. """
+        start = time.monotonic()
+        try:
+            resp = self.session.head(endpoint.url, timeout=self.timeout)
+        except requests.RequestException:
+            return False
+        if resp.status_code >= 500:
+            return False
+        with self.lock:
+            endpoint.success(time.monotonic() - start)
+        return True
+
+    def probe_forever(self) -> None:
+        """ Probe endpoints removed from rotation, returning them when they respond. """
+        while not self.stopped.wait(1):
+            for endpoint in self.endpoints:
+                if endpoint.breaker.is_open() and endpoint.breaker.allow() and not self.probe(endpoint):
+                    with self.lock:
+                        endpoint.failure()
+                    logging.info(f"Endpoint ({endpoint.url}) is still unavailable")
+
+    def start_probing(self) -> None:
+        with self.lock:
+            if self.thread is not None or len(self.endpoints) < 2:
+                return
+            self.thread = threading.Thread(target=self.probe_forever, name="ays-transport", daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stopped.set()
+
+# Pools keyed by the (comma delimited) server option, so that the health of
+# endpoints is shared by all requests to the same servers.
+POOLS = {}
+POOLS_LOCK = threading.Lock()
+
+def get_endpoint_pool(server: str) -> EndpointPool:
+    with POOLS_LOCK:
+        pool = POOLS.get(server)
+        if pool is None:
+            pool = POOLS[server] = EndpointPool(parse_servers(server))
+        return pool
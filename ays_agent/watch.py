@@ -0,0 +1,160 @@
+#
+# Watch files for changes.
+#
+# Uses inotify on Linux. Other systems poll the file's metadata.
+#
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+
+from typing import List
+from typing_extensions import Optional
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+INOTIFY_EVENT = struct.Struct("iIII")
+
+# Events that indicate a file was written, replaced or removed
+FILE_CHANGED = IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM | IN_CREATE | IN_DELETE
+
+# Time, in seconds, to wait for more events after a change is detected. Editors
+# often make several changes (write, rename, chmod) when saving a file.
+SETTLE_TIME = 0.1
+
+class Inotify(object):
+    """ Minimal `inotify(7)` wrapper. """
+
+    def __init__(self):
+        name = ctypes.util.find_library("c")
+        self.libc = ctypes.CDLL(name or "libc.so.6", use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self.poller = select.poll()
+        self.poller.register(self.fd, select.POLLIN)
+
+    def add_watch(self, path: str, mask: int) -> int:
+        """ Watch a file or directory.
+
+        @returns watch descriptor
+        """
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+        return wd
+
+    def remove_watch(self, wd: int) -> None:
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout: Optional[float] = None) -> List[tuple[int, int, str]]:
+        """ Wait for events.
+
+        @param timeout in seconds. Waits indefinitely if `None`.
+        @returns list of watch descriptor, event mask, and name of the file (relative to a watched directory)
+        """
+        if not self.poller.poll(None if timeout is None else timeout * 1000):
+            return []
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+                offset += INOTIFY_EVENT.size
+                name = data[offset:offset + length].rstrip(b"\0").decode(errors="replace")
+                offset += length
+                events.append((wd, mask, name))
+        return events
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+def get_inotify() -> Optional[Inotify]:
+    """ Returns an `Inotify` instance, or `None` if inotify is not supported. """
+    try:
+        return Inotify()
+    except (AttributeError, OSError):
+        return None
+
+class FileWatcher(object):
+    """ Detects changes to a single file.
+
+    The file's directory is watched, rather than the file, so that files
+    replaced by a rename (as most editors do) are detected.
+    """
+
+    def __init__(self, path: str, poll_interval: float = 5):
+        self.path = os.path.abspath(path)
+        self.poll_interval = poll_interval
+        self.signature = self.get_signature()
+        self.inotify = get_inotify()
+        if self.inotify is not None:
+            try:
+                self.inotify.add_watch(os.path.dirname(self.path), FILE_CHANGED | IN_ONLYDIR)
+            except OSError:
+                self.inotify.close()
+                self.inotify = None
+
+    def get_signature(self) -> Optional[tuple[int, int, int]]:
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return st.st_ino, st.st_size, st.st_mtime_ns
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """ Wait for the file to change.
+
+        @param timeout in seconds. Waits indefinitely if `None`.
+        @returns `True` if the file changed
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+            if self.inotify is not None:
+                name = os.path.basename(self.path)
+                events = self.inotify.read(remaining)
+                if any(n == name or mask & IN_Q_OVERFLOW for _, mask, n in events):
+                    # Drain the remaining events of the change
+                    while self.inotify.read(SETTLE_TIME):
+                        pass
+                    self.signature = self.get_signature()
+                    return True
+            else:
+                time.sleep(self.poll_interval if remaining is None else min(self.poll_interval, remaining))
+                if self.get_signature() != self.signature:
+                    # Wait for the change to complete
+                    time.sleep(SETTLE_TIME)
+                    self.signature = self.get_signature()
+                    return True
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+
+    def close(self) -> None:
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
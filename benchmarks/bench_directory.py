@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+#
+# Benchmark the `dir` resource.
+#
+# A tree of files is created in a temporary directory. The time of the first
+# scan, which walks the whole tree, is compared to the time of each following
+# interval, in which a single file is added, with and without inotify.
+#
+# Usage: python3 benchmarks/bench_directory.py [files]
+#
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from ays_agent.bench import format_timings
+from ays_agent.stat.directory import DirectoryMonitor
+
+# Files per directory
+FILES_PER_DIR = 100
+
+def make_tree(root: str, files: int) -> None:
+    for i in range(files):
+        path = os.path.join(root, f"{i // (FILES_PER_DIR * FILES_PER_DIR)}", f"{i // FILES_PER_DIR}")
+        if i % FILES_PER_DIR == 0:
+            os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, f"{i}"), "wb") as fh:
+            fh.write(b"x" * (i % 4096))
+    # A directory that changed in the last 2 seconds is scanned every interval
+    past = time.time() - 3600
+    for path, _, _ in os.walk(root):
+        os.utime(path, (past, past))
+
+def bench(root: str, watch: bool, ticks: int = 20) -> None:
+    monitor = DirectoryMonitor([root], watch=watch)
+    monitor.start()
+    start = time.perf_counter()
+    _, _, files, _ = monitor.get_stats()[0]
+    first = time.perf_counter() - start
+    samples = []
+    for i in range(ticks):
+        with open(os.path.join(root, "0", "0", f"new-{watch}-{i}"), "wb") as fh:
+            fh.write(b"x")
+        start = time.perf_counter()
+        monitor.get_stats()
+        samples.append(time.perf_counter() - start)
+    monitor.stop()
+    mode = "inotify" if watch else "mtime"
+    print(f"  {mode:<8} first scan {first * 1000:.1f}ms ({files:,} files)")
+    print("  " + format_timings(mode, samples))
+
+def main():
+    files = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    root = tempfile.mkdtemp(prefix="ays-bench-")
+    try:
+        make_tree(root, files)
+        print(f"directory: {files:,} files, {files // FILES_PER_DIR:,} directories")
+        bench(root, watch=False)
+        bench(root, watch=True)
+    finally:
+        shutil.rmtree(root)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+#
+# Benchmark reading the exported history in bulk.
+#
+# A day of ticks, for a number of nodes, is written both as JSON lines (one
+# payload per line, like the payloads sent to @ys) and as Arrow IPC segments.
+# The size of each, and the time to read every value back, is compared:
+#
+# - `hourly` segments, as written by the agent (zstd)
+# - `daily` segments, after `segments compact` (zstd)
+# - `daily-raw` an uncompressed daily segment, whose columns are read without
+#   being copied out of the memory map
+#
+# Usage: python3 benchmarks/bench_export.py [nodes] [ticks]
+#
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from ays_agent.bench import format_timings
+from ays_agent.export import SegmentWriter, compact_segments, read_segments, write_table
+
+# Values reported by each node, each tick
+VALUE_NAMES = ["CPU %", "RAM %", "Disk Used %", "Load 1m", "Load 5m", "Load 15m", "Net In", "Net Out", "Procs", "Open Files"]
+
+def get_msg(node: int, tick: int) -> dict:
+    return {
+        "parent": {"property": "path", "value": "com.example"},
+        "relationship": {"type": "child", "monitor_name": f"web-{node}", "path": f"web-{node}"},
+        "values": [
+            {"name": name, "value": (node * 31 + tick * 7 + i) % 100, "threshold": {"above": 95, "level": "critical"}}
+            for i, name in enumerate(VALUE_NAMES)
+        ]
+    }
+
+def read_json(path: str) -> int:
+    total = 0
+    with open(path, "r") as fh:
+        for line in fh:
+            total += len(json.loads(line)["values"])
+    return total
+
+def get_size(path: str) -> int:
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+def bench(name: str, path: str, read, runs: int = 5) -> None:
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        rows = read()
+        samples.append(time.perf_counter() - start)
+    print(f"  {name:<12}{get_size(path) / 1024 / 1024:.1f}MB ({rows:,} values)")
+    print("  " + format_timings(name, samples))
+
+def main():
+    nodes = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    ticks = int(sys.argv[2]) if len(sys.argv) > 2 else 1440
+    root = tempfile.mkdtemp(prefix="ays-bench-")
+    try:
+        json_path = os.path.join(root, "payloads.jsonl")
+        hourly = os.path.join(root, "hourly")
+        # Every row is kept until it is written, as rows are put faster than
+        # an agent would
+        writer = SegmentWriter(hourly, max_pending=nodes * ticks * len(VALUE_NAMES))
+        writer.start()
+        # A day, a tick per minute, starting at midnight (UTC)
+        day = 1700006400
+        with open(json_path, "w") as fh:
+            for tick in range(ticks):
+                now = day + tick * 86400 / ticks
+                for node in range(nodes):
+                    msg = get_msg(node, tick)
+                    fh.write(json.dumps(msg) + "\n")
+                    writer.put(msg, now=now)
+        writer.stop(timeout=600)
+        daily = os.path.join(root, "daily")
+        shutil.copytree(hourly, daily)
+        compact_segments(daily, now=day + 86400)
+        uncompressed = os.path.join(root, "uncompressed")
+        os.makedirs(uncompressed)
+        write_table(os.path.join(uncompressed, "ays-20231115.arrow"), read_segments(daily), compression=None)
+
+        print(f"export: {nodes} nodes, {ticks} ticks, {len(VALUE_NAMES)} values per tick")
+        bench("json", json_path, lambda: read_json(json_path))
+        bench("hourly", hourly, lambda: read_segments(hourly).num_rows)
+        bench("daily", daily, lambda: read_segments(daily).num_rows)
+        bench("daily-raw", uncompressed, lambda: read_segments(uncompressed).num_rows)
+    finally:
+        shutil.rmtree(root)
+
+if __name__ == "__main__":
+    main()
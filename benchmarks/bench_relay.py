@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+#
+# Benchmark the throughput, in payloads per second, of the relay.
+#
+# - core: coalescing, batching and compressing payloads, for an upstream relay
+# - http: agents posting payloads to the relay's `/agent/` endpoint
+#
+# Usage: python3 benchmarks/bench_relay.py [payloads] [agents]
+#
+
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import requests
+import uvicorn
+
+from ays_agent import cli
+from ays_agent.relay import Relay
+
+def get_payload(i: int) -> dict:
+    return {
+        "org_secret": "secret",
+        "parent": {"property": "path", "value": "com.example.servers"},
+        "relationship": {"type": "child", "monitor_name": f"host-{i % 5000}", "path": f"host-{i % 5000}"},
+        "values": [
+            {"name": "CPU %", "value": 12.5},
+            {"name": "RAM %", "value": 48.1},
+            {"name": "Disk Used %", "value": 71.0}
+        ]
+    }
+
+def bench_core(num_payloads: int) -> None:
+    sent = []
+    relay = Relay("http://upstream/agent/", send=lambda data: sent.append(len(data)) or True, upstream_relay=True)
+    payloads = [get_payload(i) for i in range(num_payloads)]
+    start = time.perf_counter()
+    for i in range(0, num_payloads, 100):
+        relay.submit(payloads[i:i + 100])
+        if len(relay.pending) >= relay.batch_size:
+            relay.flush()
+    relay.flush()
+    elapsed = time.perf_counter() - start
+    print(f"core: {num_payloads / elapsed:,.0f} payloads/s ({relay.forwarded} forwarded in {len(sent)} batches, {sum(sent) / max(relay.forwarded, 1):.0f} bytes/payload)")
+
+def get_free_port() -> int:
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def bench_http(num_payloads: int, num_agents: int) -> None:
+    relay = Relay("http://upstream/agent/", send=lambda data: True)
+    cli.fastapp.state.relay = relay
+    relay.start()
+    port = get_free_port()
+    server = uvicorn.Server(uvicorn.Config(cli.fastapp, host="127.0.0.1", port=port, log_level="error"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+
+    url = f"http://127.0.0.1:{port}/agent/"
+
+    def agent(index: int) -> None:
+        session = requests.Session()
+        for i in range(index, num_payloads, num_agents):
+            session.post(url, json=get_payload(i))
+
+    threads = [threading.Thread(target=agent, args=(i,)) for i in range(num_agents)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    relay.stop()
+    server.should_exit = True
+    print(f"http: {num_payloads / elapsed:,.0f} payloads/s ({num_agents} agents, {relay.received} received, {relay.forwarded} forwarded)")
+
+def main():
+    num_payloads = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    num_agents = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    bench_core(num_payloads * 10)
+    bench_http(num_payloads, num_agents)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+#
+# Benchmark the throughput of sharded monitors.
+#
+# A synthetic monitor does a fixed amount of CPU work to collect, and build
+# the values of, each target. The number of targets collected per second is
+# reported for 1 shard, up to one shard per core. Throughput should scale
+# close to linearly with the number of shards, until the cores are saturated.
+#
+# Usage: python3 benchmarks/bench_shard.py [targets] [seconds]
+#
+
+import hashlib
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from ays_agent.shard import ShardedMonitor
+
+# Rounds of hashing per target. Roughly the cost of probing an endpoint, and
+# building its values.
+ROUNDS = 200
+
+class SyntheticMonitor(object):
+    def __init__(self, targets):
+        self.targets = targets
+        self.timeout = 60
+
+    def start(self):
+        pass
+
+    def get_values(self, delay):
+        values = []
+        for target in self.targets:
+            digest = target.encode()
+            for _ in range(ROUNDS):
+                digest = hashlib.sha256(digest).digest()
+            values.append({"name": f"Probe {target} Up", "value": digest[0] & 1})
+        return values
+
+def bench(targets: list, shards: int, seconds: float) -> float:
+    monitor = ShardedMonitor(SyntheticMonitor, targets, shards)
+    monitor.start()
+    try:
+        # Wait for the workers to start
+        monitor.get_values(0)
+        ticks = 0
+        start = time.perf_counter()
+        while time.perf_counter() - start < seconds:
+            monitor.get_values(0)
+            ticks += 1
+        elapsed = time.perf_counter() - start
+    finally:
+        monitor.stop()
+    return ticks * len(targets) / elapsed
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 5
+    targets = [f"https://host-{i}.example.com/health" for i in range(count)]
+    cores = os.cpu_count() or 1
+    shards = [1]
+    while shards[-1] * 2 <= cores:
+        shards.append(shards[-1] * 2)
+    print(f"shard: {count} targets, {cores} cores, {seconds}s")
+    baseline = None
+    for n in shards:
+        rate = bench(targets, n, seconds)
+        baseline = baseline or rate
+        print(f"  {n:>3} shards  {rate:,.0f} targets/sec  {rate / baseline:.2f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+#
+# Soak the report pipeline of the `all` resources.
+#
+# Runs the pipeline, without sending reports, for the given number of ticks and
+# reports the agent's RSS, the memory allocated per tick, and the number of
+# garbage collections. RSS should stay flat once the agent is warmed up.
+#
+# Usage: python3 benchmarks/bench_soak.py [ticks]
+#
+
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+import psutil
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from ays_agent import CLIOptions
+from ays_agent.agent import Agent
+from ays_agent.cli import get_agent_config
+
+def main():
+    ticks = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    options = CLIOptions(org_secret="bench", server="", parent="com.bench.soak", monitor_name="soak", monitor_resources="cpu,ram,hdd,net", interval=60)
+    agent = Agent(get_agent_config(options), send=lambda server, msg: True)
+    process = psutil.Process()
+    for _ in range(100):
+        agent.get_message()
+    gc.collect()
+    gc.freeze()
+    rss = [process.memory_info().rss]
+    collections = sum(s["collections"] for s in gc.get_stats())
+    start = time.perf_counter()
+    tracemalloc.start()
+    for i in range(ticks):
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        agent.get_message()
+        peak = tracemalloc.get_traced_memory()[1] - before
+        if (i + 1) % max(ticks // 5, 1) == 0:
+            rss.append(process.memory_info().rss)
+    tracemalloc.stop()
+    elapsed = time.perf_counter() - start
+    collections = sum(s["collections"] for s in gc.get_stats()) - collections
+    print(f"soak: {ticks} ticks in {elapsed:.1f}s")
+    print(f"  rss {'  '.join(f'{r / 1024 / 1024:.1f}MB' for r in rss)}")
+    print(f"  allocated per tick (last) {peak / 1024:.1f}KB  gc collections {collections}")
+
+if __name__ == "__main__":
+    main()
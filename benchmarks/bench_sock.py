@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+#
+# Benchmark the per-tick cost of the `sock` resource.
+#
+# Generates a `/proc/net` tree with the given number of sockets and measures
+# the time it takes to collect the values of the socket monitor.
+#
+# Usage: python3 benchmarks/bench_sock.py [sockets] [ticks]
+#
+
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from ays_agent.stat.tcp import SocketMonitor
+
+HEADER = "  sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode\n"
+
+def write_sockets(path: str, num_sockets: int) -> None:
+    states = ["01"] * 6 + ["06"] * 3 + ["08"]
+    with open(path, "w") as fh:
+        fh.write(HEADER)
+        for port in (80, 443, 8080):
+            fh.write(f"   0: 00000000:{port:04X} 00000000:0000 0A 00000000:00000000 00:00000000 00000000     0        0 1 1 0000000000000000 100 0 0 10 0\n")
+        for i in range(num_sockets):
+            port = random.choice((80, 443, 8080, random.randint(32768, 60999)))
+            fh.write(f"{i:6d}: 0A000001:{port:04X} 0A0000{i % 256:02X}:{random.randint(1024, 65535):04X} {random.choice(states)} 00000000:00000000 00:00000000 00000000     0        0 {i} 1 0000000000000000 20 4 30 10 -1\n")
+
+def main():
+    num_sockets = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    ticks = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    with tempfile.TemporaryDirectory() as root:
+        write_sockets(os.path.join(root, "tcp"), num_sockets)
+        with open(os.path.join(root, "netstat"), "w") as fh:
+            fh.write("TcpExt: ListenOverflows\nTcpExt: 0\n")
+        monitor = SocketMonitor(root=root)
+        monitor.start()
+        times = []
+        for _ in range(ticks):
+            start = time.perf_counter()
+            monitor.get_values(0)
+            times.append(time.perf_counter() - start)
+    times.sort()
+    print(f"sock: {num_sockets} sockets, {ticks} ticks")
+    print(f"  min {times[0] * 1000:.1f}ms  median {times[len(times) // 2] * 1000:.1f}ms  max {times[-1] * 1000:.1f}ms")
+
+if __name__ == "__main__":
+    main()
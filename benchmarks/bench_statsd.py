@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+#
+# Benchmark the throughput of the `statsd` resource.
+#
+# A separate process sends StatsD packets, over UDP, as fast as it can. The
+# number of packets the listener receives, and aggregates, per second is
+# reported, along with the number of packets the kernel dropped.
+#
+# Usage: python3 benchmarks/bench_statsd.py [seconds]
+#
+
+import multiprocessing
+import os
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from ays_agent.stat.statsd import StatsdMonitor
+
+PACKETS = [
+    b"api.requests:1|c",
+    b"api.errors:1|c|@0.1",
+    b"api.latency:%d|ms",
+    b"queue.depth:%d|g",
+    b"users:%d|s"
+]
+
+def send(port: int, seconds: float, sent) -> None:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.connect(("127.0.0.1", port))
+    packets = [p % i if b"%d" in p else p for i in range(100) for p in PACKETS]
+    count = 0
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        for packet in packets:
+            try:
+                sock.send(packet)
+            except OSError:
+                # Receive buffer is full
+                pass
+        count += len(packets)
+    sent.value = count
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    monitor = StatsdMonitor(["udp://127.0.0.1:0"])
+    monitor.start()
+    port = monitor.sockets[0].getsockname()[1]
+    sent = multiprocessing.Value("q", 0)
+    sender = multiprocessing.Process(target=send, args=(port, seconds, sent))
+    sender.start()
+    sender.join()
+    # Let the listener drain the socket
+    time.sleep(0.5)
+    aggregates, _ = monitor.get_stats()
+    monitor.stop()
+    print(f"statsd: {seconds}s")
+    print(f"  sent {sent.value / seconds:,.0f}/sec  received {aggregates.packets / seconds:,.0f}/sec  dropped {1 - aggregates.packets / max(sent.value, 1):.1%}")
+
+if __name__ == "__main__":
+    main()
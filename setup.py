@@ -32,6 +32,10 @@ setup(
         "urllib3>=1.26.18,<2",
         "uvicorn>=0.18.3"
     ],
+    extras_require={
+        # Columnar export, `--export-dir`
+        "arrow": ["pyarrow>=12"]
+    },
     classifiers=[
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: MIT License",
@@ -0,0 +1,45 @@
+from .context import ays_agent
+
+import pytest
+
+from ays_agent import get_threshold
+from ays_agent.adaptive import AdaptiveInterval, get_headroom
+
+def test_headroom():
+    assert get_headroom(get_threshold(">80"), 60) == 0.25
+    assert get_headroom(get_threshold("<20"), 10) == -0.5, "it: should be negative when breached"
+    assert get_headroom(get_threshold("20-80:error"), 35) == 0.25
+    assert get_headroom(get_threshold("e1"), 1) is None, "it: should ignore thresholds without a distance"
+
+def test_adaptive_interval():
+    adaptive = AdaptiveInterval(15, 300, {"CPU %": get_threshold(">80"), "RAM %": get_threshold(">90")})
+
+    def update(now, cpu, ram=10, stale=False):
+        return adaptive.update([
+            {"name": "CPU %", "value": cpu, "stale": stale},
+            {"name": "RAM %", "value": ram},
+            {"name": "Disk Used %", "value": 99}
+        ], now)
+
+    # describe: values are far from their thresholds
+    assert update(0, 10) == 300, "it: should sample at the slow interval"
+
+    # describe: value is near its threshold
+    adaptive.previous.clear()
+    assert update(0, 72) == pytest.approx(15 + 285 * 0.4), "it: should speed up in proportion to the distance from the threshold"
+    assert update(129, 74) == pytest.approx(15 + 285 * 0.3)
+
+    # describe: value trends quickly toward its threshold
+    assert update(229.5, 78) == pytest.approx(25.125), "it: should sample at least twice before the expected breach"
+
+    # describe: value breaches its threshold
+    assert update(255, 95) == 15, "it: should sample at the minimum interval"
+
+    # describe: value is stale
+    assert update(270, 10, stale=True) == 30, "it: should ignore stale values"
+
+    # describe: value recovers
+    assert update(300, 10) == 60, "it: should back off gradually"
+    assert update(360, 10) == 120
+    assert update(480, 10) == 240
+    assert update(720, 10) == 300, "it: should not exceed the interval"
@@ -3,11 +3,15 @@ from .context import ays_agent
 import logging
 import os
 import pytest
+import threading
 
 from typer.testing import CliRunner
-from unittest.mock import patch
+from unittest.mock import Mock, patch
 
-from ays_agent import set_config_path, get_config_path, get_name, get_version, cli, AgentException, load_options, CLIOptions
+from ays_agent import set_config_path, get_config_path, get_state_path, get_name, get_version, cli, AgentException, load_options, save_options, CLIOptions
+from ays_agent.agent import Agent, AgentConfig
+from ays_agent.anomaly import EWMADetector
+from ays_agent.stat.pressure import PressureMonitor
 
 runner = CliRunner()
 
@@ -420,3 +424,172 @@ def test_write_config():
         monitor_name="",
     )
     assert opts.__dict__ == expected.__dict__, "it: should return empty options"
+
+@patch("ays_agent.cli.get_hostname", patch_string)
+def test_reload_config():
+    cli_args = dict(org_secret="", server=None, parent=None, monitor_name=None)
+
+    def write_config(**kwargs):
+        options = CLIOptions(org_secret="aaa", server="", parent="com.unittest.reload", monitor_name="", **kwargs)
+        save_options(options)
+
+    write_config(monitor_resources="cpu,hdd", interval=60)
+    load_config = lambda: cli.get_agent_config(cli.get_options(cli_args))
+    sent = []
+    agent = Agent(load_config(), send=lambda server, msg: sent.append(msg) or True, load_config=load_config, config_path=get_config_path())
+    cpu, hdd = agent.config.monitors.values()
+
+    # describe: interval and monitor options change
+    write_config(monitor_resources="cpu,hdd,ram", interval=30, disk_mounts="/")
+    assert agent.reload(), "it: should swap in the new config"
+    assert agent.config.interval == 30
+    assert agent.wakeup.is_set(), "it: should wake the agent to use the new interval"
+    monitors = list(agent.config.monitors.values())
+    assert len(monitors) == 3
+    assert monitors[0] is cpu, "it: should keep monitors whose config did not change"
+    assert monitors[1] is not hdd, "it: should replace monitors whose config changed"
+    assert agent.report()
+    names = [v["name"] for v in sent[0]["values"]]
+    assert "CPU %" in names and "RAM %" in names
+
+    # describe: config is invalid
+    write_config(monitor_resources="cpu,gpu", interval=30)
+    assert not agent.reload(), "it: should ignore the config"
+    assert list(agent.config.monitors.values()) == monitors, "it: should keep the current config"
+    write_config(interval=5)
+    assert not agent.reload()
+    assert agent.config.interval == 30
+
+    # describe: monitors are removed
+    write_config(interval=30)
+    assert agent.reload()
+    assert agent.config.monitors == {}
+    assert agent.get_message() == agent.config.msg, "it: should send the static message"
+    agent.stop()
+
+@patch("ays_agent.cli.get_hostname", patch_string)
+def test_adaptive_config():
+    def get_config(**kwargs):
+        options = CLIOptions(org_secret="aaa", server="", parent="com.unittest.adaptive", monitor_name="testing", monitor_resources="cpu", **kwargs)
+        return cli.get_agent_config(options)
+
+    # describe: resource thresholds
+    config = get_config(interval=300, min_interval=15, value_names="CPU %", value_thresholds=">80:warning")
+    assert config.thresholds == {"CPU %": {"above": 80.0, "level": "warning"}}
+    assert config.get_interval() == 300
+    agent = Agent(config, send=lambda server, msg: True)
+    msg = agent.get_message()
+    assert msg["values"][0]["threshold"] == {"above": 80.0, "level": "warning"}, "it: should report the value's threshold"
+
+    # describe: invalid adaptive interval
+    with pytest.raises(AgentException):
+        get_config(interval=300, min_interval=5)
+    with pytest.raises(AgentException):
+        get_config(interval=60, min_interval=120)
+    with pytest.raises(AgentException):
+        get_config(interval=60, value_thresholds=">80")
+
+@patch("ays_agent.cli.get_hostname", patch_string)
+def test_anomaly_status():
+    options = CLIOptions(org_secret="aaa", server="", parent="com.unittest.anomaly", monitor_name="testing", monitor_resources="cpu", interval=60, anomaly_detection="ewma")
+    sent = []
+    agent = Agent(cli.get_agent_config(options), send=lambda server, msg: sent.append(msg) or True)
+    agent.anomaly.factory = lambda: EWMADetector(warmup=2)
+    values = iter([20, 21, 20, 95, 20])
+    agent.collector.collect = lambda delay: [{"name": "CPU %", "value": next(values)}]
+
+    for _ in range(3):
+        agent.report()
+    assert all("status" not in msg for msg in sent)
+
+    # describe: value deviates
+    sent.clear()
+    agent.report()
+    status, msg = sent
+    assert status["status"]["state"] == "error", "it: should report the anomaly as a status"
+    assert "values" not in status
+    assert status["parent"] == msg["parent"]
+    assert msg["values"] == [{"name": "CPU %", "value": 95}], "it: should report the values"
+
+@patch("ays_agent.cli.get_hostname", patch_string)
+def test_bench_dry_run():
+    options = ["--org-secret=aaa", "--parent=com.unittest.bench", "--monitor-resources=cpu,ram", "--interval=60"]
+    # describe: pipeline is benchmarked
+    with patch("ays_agent.cli.get_agent_config", wraps=cli.get_agent_config) as get_agent_config:
+        result = runner.invoke(cli.app, options + ["--dry-run", "--bench=5"])
+    assert result.exit_code == 0, result.output
+    assert get_agent_config.call_count > 5, "it: should load and validate the config each run"
+    assert "Ran pipeline 5 times" in result.output
+    for phase in ("config", "collect", "serialize", "payload", "allocated"):
+        assert phase in result.output, f"it: should report {phase}"
+
+    # describe: not a dry run
+    result = runner.invoke(cli.app, options + ["--bench=5"])
+    assert isinstance(result.exception, AgentException), "it: should require a dry run"
+
+def test_get_resources():
+    resources = cli.get_resources("all")
+    assert cli.MonitorResource.cpu in resources
+    assert cli.MonitorResource.proc not in resources, "it: should not monitor opt-in resources with `all`"
+    assert cli.get_resources("all,proc")[-1] == cli.MonitorResource.proc, "it: should monitor opt-in resources provided by name"
+    assert cli.get_resources("proc") == [cli.MonitorResource.proc]
+
+def test_watch_pressure(caplog):
+    options = ays_agent.get_empty_options()
+    options.interval = 60
+    agent = Agent(AgentConfig(options, "server", {"parent": "a"}, {}), send=lambda server, msg: True)
+    agent.report = Mock(side_effect=OSError("No space left on device"))
+    monitor = Mock(spec=PressureMonitor, triggers=["cpu"], poller=object())
+    monitor.wait.side_effect = [["cpu"], ["cpu"], AgentException("Pressure triggers are no longer supported by the monitored files")]
+    agent.watch_pressure(monitor)
+    for thread in threading.enumerate():
+        if thread.name == "ays-pressure":
+            thread.join(5)
+    assert agent.report.call_count == 2, "it: should keep watching when a report fails"
+    assert "Stopped watching PSI triggers" in caplog.text, "it: should stop watching when triggers are no longer supported"
+
+def test_run_forever(caplog):
+    options = ays_agent.get_empty_options()
+    options.interval = 60
+    agent = Agent(AgentConfig(options, "server", {"parent": "a"}, {}), send=lambda server, msg: True)
+    calls = []
+
+    def report():
+        calls.append(len(calls))
+        if len(calls) == 1:
+            agent.wakeup.set()
+            raise OSError("No space left on device")
+        agent.stop()
+        return True
+
+    agent.report = report
+    thread = threading.Thread(target=agent.run_forever)
+    thread.start()
+    thread.join(5)
+    assert len(calls) == 2, "it: should schedule the next tick when a tick fails"
+    assert "Failed to report" in caplog.text
+
+@patch("ays_agent.cli.get_hostname", patch_string)
+def test_dry_run_counter_store():
+    state_path = get_state_path()
+    if os.path.isfile(state_path):
+        os.unlink(state_path)
+    options = ["--org-secret=aaa", "--parent=com.unittest.dry", "--monitor-resources=hdd,net", "--interval=60"]
+    result = runner.invoke(cli.app, options + ["--dry-run"])
+    assert result.exit_code == 0, result.output
+    assert not os.path.exists(state_path), "it: should not persist counter baselines on a dry run"
+
+@patch("ays_agent.cli.get_hostname", patch_string)
+def test_dry_run_record(tmp_path):
+    state_path = get_state_path()
+    if os.path.isfile(state_path):
+        os.unlink(state_path)
+    trace = tmp_path / "agent.trace"
+    trace.write_bytes(b"recorded")
+    history = tmp_path / "history"
+    options = ["--org-secret=aaa", "--parent=com.unittest.dry", "--monitor-resources=cpu", "--interval=60"]
+    result = runner.invoke(cli.app, options + ["--dry-run", f"--record={trace}", f"--history={history}"])
+    assert result.exit_code == 0, result.output
+    assert trace.read_bytes() == b"recorded", "it: should not write to the trace on a dry run"
+    assert not history.exists(), "it: should not create the history on a dry run"
+    assert not os.path.exists(state_path), "it: should not persist counter baselines on a dry run"
@@ -0,0 +1,61 @@
+from .context import ays_agent
+
+import pytest
+
+from ays_agent import AgentException
+from ays_agent.anomaly import AnomalyDetector, EWMADetector, SeasonalDetector
+
+def test_ewma_detector():
+    detector = EWMADetector(alpha=0.1, warmup=10)
+    # describe: detector is warming up
+    for i in range(10):
+        assert detector.update(50 + (i % 2) * 2) is None, "it: should not score values"
+
+    # describe: value is within normal behavior
+    assert abs(detector.update(51)) < 1
+
+    # describe: value deviates from normal behavior
+    assert detector.update(90) > 5, "it: should score the value in standard deviations"
+    assert detector.update(10) < -3
+
+    # describe: value has been constant
+    detector = EWMADetector(warmup=0)
+    for i in range(20):
+        detector.update(0)
+    assert detector.update(0.001) < 1, "it: should not score small changes infinitely"
+
+def test_seasonal_detector():
+    detector = SeasonalDetector(period=100, num_buckets=2, warmup=3)
+    # describe: values are high in the first half of the period, and low in the second
+    for day in range(5):
+        detector.update(90, day * 100 + 10)
+        detector.update(10, day * 100 + 60)
+    assert abs(detector.update(90, 510)) < 1, "it: should compare values to the same time of the period"
+    assert abs(detector.update(10, 560)) < 1
+    assert detector.update(90, 560) > 5
+
+def test_anomaly_detector():
+    detector = AnomalyDetector("ewma")
+    detector.factory = lambda: EWMADetector(warmup=5)
+
+    def update(cpu, ram=10, stale=False):
+        return detector.update([
+            {"name": "CPU %", "value": cpu, "stale": stale},
+            {"name": "RAM %", "value": ram}
+        ], 0)
+
+    for i in range(10):
+        assert update(20 + i % 2) is None, "it: should not report while values are normal"
+
+    # describe: values deviate
+    state, message = update(80)
+    assert state == "error"
+    assert message.startswith("CPU % (80) deviates"), "it: should describe the anomaly"
+    assert update(200, stale=True) is None, "it: should ignore stale values"
+
+    # describe: values return to normal
+    assert update(21) == ("healthy", "Values returned to normal")
+    assert update(20) is None, "it: should only report changes in state"
+
+    with pytest.raises(AgentException):
+        AnomalyDetector("arima")
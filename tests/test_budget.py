@@ -0,0 +1,141 @@
+from .context import ays_agent
+
+import tracemalloc
+
+from unittest.mock import Mock
+
+from ays_agent import CLIOptions, cli
+from ays_agent.agent import Agent, AgentConfig, ValueBuffer
+from ays_agent.budget import RESTORE, RESTORE_TICKS, RSS_SHED_COOLDOWN, SHED, ResourceBudget
+
+MB = 1024 * 1024
+
+def get_process(rss_mb):
+    """ Returns a process whose RSS is read from `rss_mb[0]`. """
+    process = Mock()
+    process.memory_info.side_effect = lambda: Mock(rss=rss_mb[0] * MB)
+    process.cpu_percent.return_value = 1.0
+    return process
+
+class FakeMonitor(object):
+    def __init__(self, name, count=1):
+        self.name = name
+        self.count = count
+        self.running = False
+        self.tick = 0
+
+    def start(self):
+        self.running = True
+
+    def stop(self):
+        self.running = False
+
+    def get_values(self, delay):
+        self.tick += 1
+        return [{"name": f"{self.name} {i}", "value": self.tick + i} for i in range(self.count)]
+
+def test_resource_budget():
+    rss = [50]
+    process = get_process(rss)
+    budget = ResourceBudget(max_rss=100, max_cpu=50, process=process)
+
+    # describe: agent is within budget
+    assert budget.update(can_restore=False) is None
+
+    # describe: agent uses too much CPU
+    process.cpu_percent.return_value = 60
+    assert [budget.update(can_restore=False) for _ in range(2)] == [SHED, SHED], "it: should shed a monitor each tick"
+
+    # describe: agent is back within its CPU budget
+    process.cpu_percent.return_value = 45
+    assert [budget.update(can_restore=True) for _ in range(RESTORE_TICKS)] == [None] * RESTORE_TICKS, "it: should not restore near the budget"
+    process.cpu_percent.return_value = 10
+    actions = [budget.update(can_restore=True) for _ in range(RESTORE_TICKS)]
+    assert actions == [None] * (RESTORE_TICKS - 1) + [RESTORE], "it: should restore after several ticks under budget"
+
+    # describe: agent uses too much memory
+    rss[0] = 120
+    assert budget.update(can_restore=True) == SHED
+    actions = [budget.update(can_restore=True) for _ in range(RSS_SHED_COOLDOWN)]
+    assert actions == [None] * (RSS_SHED_COOLDOWN - 1) + [SHED], "it: should wait for memory to be released before shedding another monitor"
+
+    # describe: memory is within budget, but was not released to the system
+    rss[0] = 90
+    actions = [budget.update(can_restore=True) for _ in range(RESTORE_TICKS)]
+    assert actions == [None] * (RESTORE_TICKS - 1) + [RESTORE], "it: should restore once memory is within budget"
+    assert budget.get_values(0)[0] == {"name": "Agent RSS MB", "value": 90}
+
+def test_shed_monitors():
+    rss = [50]
+    options = CLIOptions(org_secret="aaa", server="", parent="com.unittest.budget", monitor_name="testing", interval=60, max_rss=100, max_cpu=50)
+    monitors = {("cpu",): FakeMonitor("cpu"), ("log",): FakeMonitor("log"), ("probe",): FakeMonitor("probe")}
+    config = AgentConfig(options, "", {}, monitors, optional=[("probe",), ("log",)])
+    config.budget.process = process = get_process(rss)
+    agent = Agent(config, send=lambda server, msg: True)
+
+    def get_names():
+        return {v["name"].split()[0] for v in agent.get_message()["values"] if not v["name"].startswith("Agent")}
+
+    assert get_names() == {"cpu", "log", "probe"}
+
+    # describe: agent uses too much CPU
+    process.cpu_percent.return_value = 80
+    for _ in range(3):
+        agent.enforce_budget()
+    assert agent.shed == [("probe",), ("log",)], "it: should shed optional monitors, in order"
+    assert not monitors[("probe",)].running
+    assert get_names() == {"cpu"}, "it: should not shed core monitors"
+    values = {v["name"]: v["value"] for v in agent.get_message()["values"]}
+    assert values["Agent Shed Monitors"] == 2
+
+    # describe: agent is back within budget
+    process.cpu_percent.return_value = 1.0
+    for _ in range(RESTORE_TICKS):
+        agent.enforce_budget()
+    assert agent.shed == [("probe",)], "it: should restore the last shed monitor first"
+    assert monitors[("log",)].running
+    assert get_names() == {"cpu", "log"}
+
+    # describe: agent uses too much memory, for a moment
+    rss[0] = 200
+    for _ in range(3):
+        agent.enforce_budget()
+    assert agent.shed == [("probe",), ("log",)], "it: should only shed a single monitor"
+    rss[0] = 95
+    for _ in range(2 * RESTORE_TICKS):
+        agent.enforce_budget()
+    assert agent.shed == [], "it: should restore the monitors, though memory was not released"
+
+def test_value_buffer():
+    buffer = ValueBuffer({"b": {"above": 1}})
+    first = buffer.update([{"name": "a", "value": 1}, {"name": "b", "value": 2}])
+    first_ids = [id(v) for v in first]
+    second = buffer.update([{"name": "a", "value": 3}, {"name": "b", "value": 4}])
+    assert [id(v) for v in second] == first_ids, "it: should reuse the value dicts"
+    assert second == [{"name": "a", "value": 3}, {"name": "b", "value": 4, "threshold": {"above": 1}}]
+
+    # describe: value has other properties
+    values = buffer.update([{"name": "a", "value": 5, "stale": True}, {"name": "a", "value": 6}])
+    assert values == [{"name": "a", "value": 5, "stale": True}, {"name": "a", "value": 6}], "it: should not reuse a dict twice in a tick"
+
+def test_soak():
+    options = CLIOptions(org_secret="aaa", server="", parent="com.unittest.soak", monitor_name="testing", interval=60, value_names="cpu 0", value_thresholds=">90")
+    thresholds = cli.get_thresholds(options.value_names, options.value_thresholds)
+    monitors = {(name,): FakeMonitor(name, 20) for name in ("cpu", "ram", "net")}
+    agent = Agent(AgentConfig(options, "", {"parent": "com.unittest.soak"}, monitors, thresholds), send=lambda server, msg: True)
+    # Warm up, e.g. the collector's threads and value buffers
+    for _ in range(200):
+        agent.get_message()
+
+    tracemalloc.start()
+    try:
+        start = tracemalloc.get_traced_memory()[0]
+        for i in range(3000):
+            agent.get_message()
+            if i == 999:
+                middle = tracemalloc.get_traced_memory()[0]
+        end = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    assert end - start < 64 * 1024, "it: should not grow memory over time"
+    assert abs(end - middle) < 16 * 1024, "it: should keep memory flat"
@@ -0,0 +1,83 @@
+from .context import ays_agent
+
+import threading
+
+from ays_agent.collector import CircuitBreaker, Collector
+
+class FakeMonitor(object):
+    def __init__(self, name):
+        self.name = name
+        self.value = 0
+        self.calls = 0
+        # When set, `get_values` blocks until released
+        self.hang = None
+        self.error = None
+
+    def get_values(self, delay):
+        self.calls += 1
+        if self.hang is not None:
+            self.hang.wait()
+        if self.error is not None:
+            raise self.error
+        self.value += 1
+        return [{"name": self.name, "value": self.value}]
+
+def test_circuit_breaker():
+    breaker = CircuitBreaker(max_failures=2, cooldown=10)
+    breaker.failure(now=0)
+    assert breaker.allow(now=0), "it: should allow calls until max failures"
+    breaker.failure(now=0)
+    assert breaker.is_open()
+    assert not breaker.allow(now=5), "it: should reject calls during cooldown"
+    assert breaker.allow(now=10), "it: should allow a call after cooldown"
+    breaker.success()
+    assert not breaker.is_open(), "it: should close after a success"
+
+def test_collector():
+    fast = FakeMonitor("fast")
+    slow = FakeMonitor("slow")
+    collector = Collector([fast, slow], timeout=0.1, max_failures=2, cooldown=300)
+
+    # describe: all monitors return in time
+    assert collector.collect(1) == [
+        {"name": "fast", "value": 1},
+        {"name": "slow", "value": 1}
+    ]
+
+    # describe: monitor hangs
+    slow.hang = threading.Event()
+    assert collector.collect(1) == [
+        {"name": "fast", "value": 2},
+        {"name": "slow", "value": 1, "stale": True}
+    ], "it: should report the last known value as stale"
+
+    # describe: hung monitor has not returned
+    assert collector.collect(1) == [
+        {"name": "fast", "value": 3},
+        {"name": "slow", "value": 1, "stale": True}
+    ]
+    assert slow.calls == 2, "it: should not call the monitor until its last call returns"
+
+    # describe: hung monitor returns; breaker is open
+    slow.hang.set()
+    slow.hang = None
+    collector.states[1].future.result()
+    assert collector.collect(1) == [
+        {"name": "fast", "value": 4},
+        {"name": "slow", "value": 1, "stale": True}
+    ]
+    assert slow.calls == 2, "it: should skip the monitor while its breaker is open"
+
+    # describe: cooldown has passed
+    collector.states[1].breaker.opened_at -= 300
+    assert collector.collect(1) == [
+        {"name": "fast", "value": 5},
+        {"name": "slow", "value": 3}
+    ], "it: should call the monitor again"
+
+    # describe: monitor raises
+    fast.error = OSError("Stale file handle")
+    assert collector.collect(1) == [
+        {"name": "fast", "value": 5, "stale": True},
+        {"name": "slow", "value": 4}
+    ]
@@ -0,0 +1,129 @@
+from .context import ays_agent
+
+import calendar
+import os
+import pytest
+import time
+
+from unittest.mock import patch
+
+from typer.testing import CliRunner
+
+from ays_agent import cli
+from ays_agent.export import SegmentWriter, compact_segments, list_segments, read_segments
+
+pa = pytest.importorskip("pyarrow")
+
+# 2024-03-01 23:30:00 UTC
+T0 = calendar.timegm((2024, 3, 1, 23, 30, 0))
+
+def get_msg(cpu: float) -> dict:
+    return {
+        "parent": {"property": "path", "value": "com.example"},
+        "relationship": {"type": "child", "monitor_name": "web-1", "path": "web-1"},
+        "values": [
+            {"name": "CPU %", "value": cpu, "threshold": {"above": 90, "level": "critical"}},
+            {"name": "Disk Used %", "value": 1, "stale": True},
+            {"name": "Status", "value": "up"}
+        ]
+    }
+
+def wait_for_rows(writer, rows):
+    deadline = time.monotonic() + 5
+    while writer.get_stats()["rows"] < rows and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+def test_segment_writer(tmp_path):
+    writer = SegmentWriter(str(tmp_path), batch_rows=2)
+    writer.start()
+    assert writer.put(get_msg(10), now=T0)
+    assert writer.put(get_msg(95), now=T0 + 60)
+    assert not writer.put({"parent": {"value": "com.example"}}, now=T0 + 60), "it: should not export messages without values"
+    wait_for_rows(writer, 2)
+    assert writer.get_stats()["segment"].endswith("ays-20240301T23.arrow"), "it: should write the rows once the batch is full"
+
+    # describe: the hour ends
+    writer.put(get_msg(20), now=T0 + 1800)
+    writer.put(get_msg(30), now=T0 + 1860)
+    writer.stop()
+    assert sorted(os.listdir(tmp_path)) == ["ays-20240301T23.arrow", "ays-20240302T00.arrow"], "it: should rotate segments hourly"
+    assert writer.get_stats() == {"directory": str(tmp_path), "segment": None, "pending": 0, "rows": 4, "segments": 2, "dropped": 0, "failed": 0}
+
+    table = read_segments(str(tmp_path))
+    assert table.schema.names == ["time", "node", "name", "value", "level"]
+    assert table["value"].to_pylist() == [10, 95, 20, 30], "it: should not export stale, or non-numeric, values"
+    assert set(table["node"].to_pylist()) == {"com.example.web-1"}
+    assert table["level"].to_pylist() == [None, "critical", None, None], "it: should record the level of the breached threshold"
+    assert table["time"][0].as_py().timestamp() == T0
+
+    # describe: read a time range
+    assert read_segments(str(tmp_path), start=T0 + 1800)["value"].to_pylist() == [20, 30]
+    assert read_segments(str(tmp_path), end=T0 + 60)["value"].to_pylist() == [10, 95]
+
+def test_recover_segment(tmp_path):
+    writer = SegmentWriter(str(tmp_path), batch_rows=1)
+    writer.start()
+    writer.put(get_msg(10), now=T0)
+    writer.put(get_msg(20), now=T0 + 60)
+    wait_for_rows(writer, 2)
+    # The agent is killed before the segment is closed
+    writer.stopped.set()
+    with writer.cond:
+        writer.cond.notify_all()
+    writer.thread.join()
+    writer.sink.close()
+
+    writer = SegmentWriter(str(tmp_path))
+    writer.start()
+    assert os.listdir(tmp_path) == ["ays-20240301T23.arrow"], "it: should recover the rows of a segment that was not closed"
+    assert read_segments(str(tmp_path))["value"].to_pylist() == [10, 20]
+
+    # describe: the agent is restarted in the same hour
+    writer.put(get_msg(30), now=T0 + 120)
+    writer.stop()
+    assert sorted(os.listdir(tmp_path)) == ["ays-20240301T23-1.arrow", "ays-20240301T23.arrow"], "it: should not overwrite the segment of the hour"
+
+def test_compact_segments(tmp_path):
+    writer = SegmentWriter(str(tmp_path))
+    writer.start()
+    for hour in range(3):
+        for i in range(2):
+            msg = get_msg(hour * 10 + i)
+            msg["relationship"]["path"] = f"web-{2 - i}"
+            writer.put(msg, now=T0 - 3600 * hour)
+    # Today's segment is not compacted
+    writer.put(get_msg(99), now=T0 + 3600)
+    writer.stop()
+
+    assert compact_segments(str(tmp_path), now=T0 + 3600) == {"20240301": 6}
+    assert sorted(os.listdir(tmp_path)) == ["ays-20240301.arrow", "ays-20240302T00.arrow"]
+    table = read_segments(str(tmp_path))
+    assert table["node"].to_pylist()[:6] == ["com.example.web-1"] * 3 + ["com.example.web-2"] * 3, "it: should sort rows by node, name and time"
+    assert table["value"].to_pylist() == [21, 11, 1, 20, 10, 0, 99]
+    assert compact_segments(str(tmp_path), now=T0 + 3600) == {}, "it: should not compact a day twice"
+
+    # describe: segments command
+    runner = CliRunner()
+    result = runner.invoke(cli.app, ["segments", "list", str(tmp_path)])
+    assert result.exit_code == 0
+    assert "ays-20240301.arrow" in result.stdout and "6 rows" in result.stdout
+    assert [s["rows"] for s in list_segments(str(tmp_path))] == [6, 1]
+    result = runner.invoke(cli.app, ["segments", "compact", str(tmp_path)])
+    assert result.exit_code == 0
+    assert "Compacted (20240302)" in result.stdout
+
+def test_segment_writer_disk_full(tmp_path):
+    writer = SegmentWriter(str(tmp_path), batch_rows=1)
+    writer.start()
+    with patch.object(writer, "open_segment", side_effect=OSError(28, "No space left on device")):
+        assert writer.put(get_msg(10), now=T0), "it: should not raise into the agent"
+        deadline = time.monotonic() + 5
+        while writer.get_stats()["failed"] < 1 and time.monotonic() < deadline:
+            time.sleep(0.01)
+    stats = writer.get_stats()
+    assert (stats["failed"], stats["dropped"]) == (1, 1), "it: should count the rows that could not be written"
+
+    # describe: disk has room again
+    writer.put(get_msg(20), now=T0 + 60)
+    writer.stop()
+    assert read_segments(str(tmp_path))["value"].to_pylist() == [20], "it: should keep writing"
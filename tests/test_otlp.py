@@ -0,0 +1,167 @@
+from .context import ays_agent
+
+import asyncio
+import http.server
+import pytest
+import struct
+import threading
+import time
+
+from unittest.mock import Mock
+
+from ays_agent import cli
+from ays_agent.agent import Agent, AgentConfig
+from ays_agent.otlp import OtlpSink, encode_varint, get_resource_attributes
+
+def decode_varint(data: bytes, offset: int) -> tuple:
+    value = shift = 0
+    while True:
+        b = data[offset]
+        offset += 1
+        value |= (b & 0x7f) << shift
+        shift += 7
+        if not b & 0x80:
+            return value, offset
+
+def decode(data: bytes) -> dict:
+    """ Decode a protobuf message into lists of raw field values, keyed by field number. """
+    fields = {}
+    offset = 0
+    while offset < len(data):
+        tag, offset = decode_varint(data, offset)
+        field, wire_type = tag >> 3, tag & 7
+        if wire_type == 0:
+            value, offset = decode_varint(data, offset)
+        elif wire_type == 1:
+            value = data[offset:offset + 8]
+            offset += 8
+        elif wire_type == 2:
+            length, offset = decode_varint(data, offset)
+            value = data[offset:offset + length]
+            offset += length
+        else:
+            raise ValueError(f"Unexpected wire type ({wire_type})")
+        fields.setdefault(field, []).append(value)
+    return fields
+
+def decode_request(data: bytes) -> list:
+    """ Returns the resource attributes, and gauge data points, of an `ExportMetricsServiceRequest`. """
+    resources = []
+    for rm in decode(data)[1]:
+        rm = decode(rm)
+        attributes = {}
+        for kv in decode(rm[1][0]).get(1, []):
+            kv = decode(kv)
+            attributes[kv[1][0].decode()] = decode(kv[2][0])[1][0].decode()
+        metrics = {}
+        for sm in rm[2]:
+            sm = decode(sm)
+            assert decode(sm[1][0])[1][0] == b"ays-agent"
+            for metric in sm.get(2, []):
+                metric = decode(metric)
+                points = []
+                for point in decode(metric[5][0])[1]:
+                    point = decode(point)
+                    points.append((struct.unpack("<Q", point[3][0])[0], struct.unpack("<d", point[4][0])[0]))
+                metrics[metric[1][0].decode()] = points
+        resources.append((attributes, metrics))
+    return resources
+
+class Receiver(http.server.BaseHTTPRequestHandler):
+    """ Stand-in OTLP/HTTP receiver. """
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.server.requests.append((self.headers["Content-Type"], body))
+        status = self.server.statuses.pop(0) if self.server.statuses else 200
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def receiver():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Receiver)
+    server.requests = []
+    server.statuses = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def test_encode_varint():
+    assert encode_varint(0) == b"\x00"
+    assert encode_varint(300) == b"\xac\x02"
+    assert decode_varint(encode_varint(2 ** 63), 0)[0] == 2 ** 63
+
+def test_resource_attributes():
+    msg = {"parent": {"property": "path", "value": "com.example"}, "relationship": {"type": "child", "monitor_name": "web-1", "path": "web-1"}}
+    assert dict(get_resource_attributes(msg)) == {"service.name": "ays-agent", "host.name": "web-1", "ays.node": "com.example.web-1"}
+
+def test_otlp_sink(receiver):
+    msg = {
+        "parent": {"property": "path", "value": "com.example"},
+        "relationship": {"type": "parent", "monitor_name": "web-1"},
+        "values": [{"name": "CPU %", "value": 10}, {"name": "RAM %", "value": 50.5}, {"name": "Disk Used %", "value": 1, "stale": True}]
+    }
+    sink = OtlpSink(f"http://127.0.0.1:{receiver.server_address[1]}/v1/metrics", flush_interval=0.1)
+    sink.start()
+    assert sink.put(msg)
+    msg["values"][0]["value"] = 20
+    assert sink.put(msg)
+    assert not sink.put({"parent": {"value": "com.example"}}), "it: should not export messages without values"
+    deadline = time.monotonic() + 5
+    while not receiver.requests and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+    content_type, body = receiver.requests[0]
+    assert content_type == "application/x-protobuf"
+    [(attributes, metrics)] = decode_request(body)
+    assert attributes == {"service.name": "ays-agent", "host.name": "web-1", "ays.node": "com.example"}
+    assert [v for _, v in metrics["CPU %"]] == [10, 20], "it: should batch the ticks, and keep the values of each tick"
+    assert [v for _, v in metrics["RAM %"]] == [50.5, 50.5]
+    assert metrics["CPU %"][0][0] <= metrics["CPU %"][1][0] <= time.time_ns()
+    assert "Disk Used %" not in metrics, "it: should not export stale values"
+
+    # describe: the receiver is unavailable
+    receiver.statuses = [503, 400]
+    sink.put(msg)
+    deadline = time.monotonic() + 5
+    while sink.get_stats()["failed"] < 1 and time.monotonic() < deadline:
+        time.sleep(0.05)
+    sink.stop()
+    stats = sink.get_stats()
+    assert len(receiver.requests) == 3, "it: should retry the batch"
+    assert stats == {"endpoint": sink.endpoint, "pending": 0, "exported": 2, "dropped": 1, "failed": 1}, "it: should drop batches that are rejected"
+
+def test_agent_sinks():
+    options = ays_agent.get_empty_options()
+    options.interval = 60
+    monitor = Mock(spec=["start", "get_values"], get_values=lambda delay: [{"name": "CPU %", "value": 10}])
+    sent = []
+    sink = Mock()
+    agent = Agent(AgentConfig(options, "server", {"parent": "a"}, {("cpu",): monitor}), send=lambda server, msg: sent.append(msg) or True, sinks=[sink])
+    agent.report()
+    assert sink.put.call_args_list == [((sent[0],),)], "it: should fan out the message sent to @ys to every sink"
+
+    # describe: a sink fails
+    sink.put.side_effect = OSError(28, "No space left on device")
+    other = Mock()
+    agent.sinks = [sink, other]
+    assert agent.report(), "it: should report to @ys"
+    assert len(sent) == 2
+    assert other.put.call_count == 1, "it: should still export to the other sinks"
+
+    # describe: messages are sent from a queue
+    calls = []
+    queue = Mock(put=lambda server, msg: calls.append("queue") or True)
+    sink = Mock(put=Mock(side_effect=lambda msg: calls.append("sink")))
+    agent = Agent(AgentConfig(options, "server", {"parent": "a"}, {("cpu",): monitor}), send=Mock(), queue=queue, sinks=[sink])
+    assert agent.report()
+    assert calls == ["queue", "sink"], "it: should queue the message for @ys before the sinks"
+
+    # describe: sinks endpoint
+    request = Mock(app=Mock(state=Mock(sinks=[Mock(get_stats=lambda: {"pending": 0})])))
+    assert asyncio.run(cli.sinks(request)) == {"sinks": [{"pending": 0}]}
@@ -0,0 +1,83 @@
+from .context import ays_agent
+
+import http.server
+import pytest
+import socket
+import threading
+import time
+
+from ays_agent import AgentException
+from ays_agent.stat.probe import Endpoint, ProbeMonitor
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(503 if self.path == "/down" else 200)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+class Server(http.server.ThreadingHTTPServer):
+    request_queue_size = 128
+
+@pytest.fixture
+def http_server():
+    server = Server(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server.server_address[1]
+    server.shutdown()
+    server.server_close()
+
+def get_closed_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def test_endpoint():
+    endpoint = Endpoint("https://example.com/health?full=1")
+    assert (endpoint.host, endpoint.port, endpoint.path) == ("example.com", 443, "/health?full=1")
+    with pytest.raises(AgentException):
+        Endpoint("ftp://example.com")
+    with pytest.raises(AgentException):
+        Endpoint("tcp://db")
+
+def test_probe_monitor(http_server):
+    # Accepts connections, but never responds
+    silent = socket.socket()
+    silent.bind(("127.0.0.1", 0))
+    silent.listen()
+    silent_port = silent.getsockname()[1]
+
+    endpoints = [
+        f"http://127.0.0.1:{http_server}/health",
+        f"http://127.0.0.1:{http_server}/down",
+        f"tcp://127.0.0.1:{http_server}",
+        f"tcp://127.0.0.1:{get_closed_port()}",
+        f"http://127.0.0.1:{silent_port}/"
+    ]
+    monitor = ProbeMonitor(endpoints, max_in_flight=2, probe_timeout=0.5)
+    monitor.start()
+    values = {v["name"]: v["value"] for v in monitor.get_values(0)}
+
+    name = f"Probe {endpoints[0]}"
+    assert values[f"{name} Up"] == 1
+    assert values[f"{name} Status"] == 200
+    assert 0 < values[f"{name} Connect ms"] <= values[f"{name} TTFB ms"], "it: should measure latency"
+    assert values[f"Probe {endpoints[1]} Up"] == 0, "it: should be down if the server responds with an error"
+    assert values[f"Probe {endpoints[1]} Status"] == 503
+    assert values[f"Probe {endpoints[2]} Up"] == 1
+    assert f"Probe {endpoints[2]} TTFB ms" not in values, "it: should only connect to TCP endpoints"
+    assert values[f"Probe {endpoints[3]} Up"] == 0, "it: should be down if the connection is refused"
+    assert values[f"Probe {endpoints[4]} Up"] == 0, "it: should be down if the server does not respond in time"
+    silent.close()
+
+def test_probe_many_endpoints(http_server):
+    # describe: probe many endpoints
+    monitor = ProbeMonitor([f"http://127.0.0.1:{http_server}/{i}" for i in range(200)], max_in_flight=50)
+    monitor.start()
+    start = time.monotonic()
+    results = monitor.get_stats()
+    assert all(r.up for r in results)
+    assert time.monotonic() - start < monitor.timeout, "it: should probe all endpoints within the monitor's timeout"
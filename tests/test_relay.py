@@ -0,0 +1,190 @@
+from .context import ays_agent
+
+import asyncio
+import gzip
+import http.server
+import json
+import threading
+
+from unittest.mock import Mock
+
+from ays_agent import cli
+from ays_agent.relay import Relay, Spool, encode_batch
+from ays_agent.sketch import DDSketch, get_distribution_values
+
+def payload(parent, value, monitor_name="testing"):
+    return {
+        "org_secret": "aaa",
+        "parent": {"property": "path", "value": parent},
+        "relationship": {"type": "parent", "monitor_name": monitor_name},
+        "value": {"name": "value", "value": value}
+    }
+
+def decode(data):
+    return json.loads(gzip.decompress(data))
+
+def test_relay(tmp_path):
+    batches = []
+    upstream = {"up": True}
+
+    def send(data):
+        if upstream["up"]:
+            batches.append(decode(data))
+        return upstream["up"]
+
+    relay = Relay("http://upstream/agent/", spool=Spool(str(tmp_path / "spool")), send=send, batch_size=2, upstream_relay=True)
+
+    # describe: node reports more than once before a flush
+    relay.submit([payload("com.a", 1), payload("com.b", 1)])
+    relay.submit([payload("com.a", 2)])
+    status = payload("com.c", 1)
+    status.pop("value")
+    status["status"] = {"message": "", "state": "error"}
+    relay.submit([status, payload("com.c", 2)])
+    assert relay.flush() == 3
+    assert batches[0] == [payload("com.a", 2), payload("com.b", 1)], "it: should coalesce payloads of the same node"
+    assert batches[1] == [dict(payload("com.c", 2), status={"message": "", "state": "error"})], "it: should keep the properties of coalesced payloads"
+
+    # describe: node reports distributions more than once before a flush
+    batches.clear()
+    for samples in ([1, 2, 3], [4, 5]):
+        sketch = DDSketch()
+        for v in samples:
+            sketch.add(v)
+        relay.submit([dict(payload("com.d", 1), values=get_distribution_values("latency", sketch))])
+    assert relay.flush() == 1
+    values = {v["name"]: v["value"] for v in batches[0][0]["values"]}
+    assert values["latency"] == 5, "it: should merge the distributions of coalesced payloads"
+    assert values["latency min"] == 1
+
+    # describe: upstream is down
+    batches.clear()
+    upstream["up"] = False
+    relay.submit([payload("com.a", 3)])
+    assert relay.flush() == 0
+    relay.submit([payload("com.a", 4)])
+    assert relay.flush() == 0
+    assert len(relay.spool.get_names()) == 2, "it: should spool batches"
+
+    # describe: upstream recovers
+    upstream["up"] = True
+    relay.submit([payload("com.a", 5)])
+    assert relay.flush() == 3, "it: should count the spooled payloads forwarded"
+    assert [b[0]["value"]["value"] for b in batches] == [3, 4, 5], "it: should forward spooled batches in order"
+    assert relay.spool.get_names() == []
+
+class AgentEndpoint(http.server.BaseHTTPRequestHandler):
+    """ Stand-in @ys agent endpoint, which accepts a single `AgentPayload` per request. """
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        payload = json.loads(body)
+        if self.server.statuses:
+            status = self.server.statuses.pop(0)
+        elif isinstance(payload, dict):
+            self.server.payloads.append(payload)
+            status = 204
+        else:
+            status = 400
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+def test_relay_upstream(tmp_path):
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), AgentEndpoint)
+    server.payloads = []
+    server.statuses = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        relay = Relay(f"http://127.0.0.1:{server.server_address[1]}/agent/", spool=Spool(str(tmp_path / "spool")))
+        relay.submit([payload("com.a", 1), payload("com.b", 1)])
+        assert relay.flush() == 2
+        assert server.payloads == [payload("com.a", 1), payload("com.b", 1)], "it: should forward each payload to @ys on its own"
+
+        # describe: upstream fails part way through a batch
+        server.payloads.clear()
+        server.statuses = [204, 503]
+        relay.submit([payload("com.a", 2), payload("com.b", 2), payload("com.c", 2)])
+        assert relay.flush() == 1
+        spooled = relay.spool.get_names()
+        assert len(spooled) == 1
+        assert json.loads(gzip.decompress(relay.spool.read(spooled[0]))) == [payload("com.b", 2), payload("com.c", 2)], "it: should only spool the payloads that were not forwarded"
+
+        # describe: upstream recovers
+        assert relay.flush() == 2
+        assert server.payloads == [payload("com.b", 2), payload("com.c", 2)], "it: should forward spooled payloads"
+        assert relay.spool.get_names() == []
+
+        # describe: upstream rejects a payload
+        server.payloads.clear()
+        server.statuses = [400]
+        relay.submit([payload("com.a", 3), payload("com.b", 3)])
+        assert relay.flush() == 2
+        assert server.payloads == [payload("com.b", 3)], "it: should drop a rejected payload, rather than retry it forever"
+        relay.pool.stop()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def test_spool_corrupt(tmp_path):
+    path = tmp_path / "spool"
+    path.mkdir()
+    # Batches were partially written when the relay was killed
+    (path / ".00000000000000000000-000001.json.gz").write_bytes(b"partial")
+    (path / "00000000000000000001-000001.json.gz").write_bytes(encode_batch([payload("com.a", 1)])[:10])
+    (path / "00000000000000000002-000001.json.gz").write_bytes(b"not gzipped")
+    (path / "00000000000000000003-000001.json.gz").write_bytes(encode_batch([payload("com.b", 1)]))
+    spool = Spool(str(path))
+    assert not (path / ".00000000000000000000-000001.json.gz").exists(), "it: should remove partially written batches"
+    batches = []
+    upstream = {"up": False}
+
+    def send(data):
+        if upstream["up"]:
+            batches.append(decode(data))
+        return upstream["up"]
+
+    relay = Relay("http://upstream/agent/", spool=spool, send=send, upstream_relay=True)
+    relay.submit([payload("com.c", 1)])
+    assert relay.flush() == 0
+    assert len(spool.get_names()) == 2, "it: should drop corrupt batches, and spool the queued payloads"
+
+    # describe: upstream recovers
+    upstream["up"] = True
+    relay.submit([payload("com.d", 1)])
+    assert relay.flush() == 3
+    assert batches == [[payload("com.b", 1)], [payload("com.c", 1)], [payload("com.d", 1)]], "it: should not lose queued payloads"
+    assert spool.get_names() == []
+
+def test_spool_limit(tmp_path):
+    spool = Spool(str(tmp_path / "spool"), max_size=250)
+    for i in range(5):
+        spool.push(bytes([i]) * 100)
+    names = spool.get_names()
+    assert len(names) == 2, "it: should drop the oldest batches"
+    assert spool.read(names[0]) == bytes([3]) * 100
+
+def test_relay_endpoint():
+    relay = Relay("http://upstream/agent/", send=lambda data: True)
+
+    def post(body, gzipped=False):
+        data = json.dumps(body).encode()
+        if gzipped:
+            data = gzip.compress(data)
+
+        async def read_body():
+            return data
+
+        request = Mock(app=Mock(state=Mock(relay=relay)), headers={"content-encoding": "gzip"} if gzipped else {}, body=read_body)
+        return asyncio.run(cli.relay_payload(request)).status_code
+
+    assert post(payload("com.a", 1)) == 204
+    assert post([payload("com.b", 1), payload("com.c", 1)], gzipped=True) == 204, "it: should accept batches from other relays"
+    assert post({"value": 1}) == 400
+    assert len(relay.pending) == 3
+    relay.pending.clear()
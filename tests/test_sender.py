@@ -0,0 +1,114 @@
+from .context import ays_agent
+
+import asyncio
+import pytest
+import time
+
+from unittest.mock import Mock
+
+from ays_agent import cli
+from ays_agent.sender import PRIORITY_HEARTBEAT, PRIORITY_STATUS, PRIORITY_VALUES, SendQueue, TokenBucket, get_priority
+
+def values_msg(value, threshold=None):
+    v = {"name": "CPU %", "value": value}
+    if threshold:
+        v["threshold"] = threshold
+    return {"parent": "com.unittest.sender", "values": [v]}
+
+def test_priority():
+    assert get_priority({"parent": "a", "status": {"state": "error"}}) == PRIORITY_STATUS
+    assert get_priority(values_msg(95, {"above": 90, "level": "error"})) == PRIORITY_STATUS, "it: should send breaches first"
+    assert get_priority(values_msg(50, {"above": 90, "level": "error"})) == PRIORITY_VALUES
+    assert get_priority(values_msg(1, {"nequal": 0, "level": "error"})) == PRIORITY_STATUS
+    assert get_priority({"parent": "a"}) == PRIORITY_HEARTBEAT
+    assert get_priority(values_msg(50)) == PRIORITY_VALUES
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=10, burst=2)
+    now = bucket.updated
+    for _ in range(2):
+        assert bucket.get_delay(now) == 0
+        bucket.take()
+    assert bucket.get_delay(now) == pytest.approx(0.1), "it: should wait for a token once the burst is spent"
+    assert bucket.get_delay(now + 0.11) == 0
+
+def test_send_queue():
+    queue = SendQueue(lambda server, msg: True, max_size=3, rate=1000, burst=1000)
+
+    # describe: queue is full
+    for i in range(3):
+        assert queue.put("server", values_msg(i))
+    assert queue.put("server", {"parent": "a"}), "it: should queue a more urgent message"
+    assert [item.msg["values"][0]["value"] for item in queue.queues[PRIORITY_VALUES]] == [1, 2], "it: should drop the oldest routine values"
+    for _ in range(2):
+        assert queue.put("server", {"parent": "a", "status": {"state": "error"}})
+    assert not queue.put("server", values_msg(3)), "it: should drop routine values when all queued messages are more urgent"
+    stats = queue.get_stats()
+    assert stats["classes"]["values"] == {"queued": 0, "sent": 0, "dropped": 4}
+    assert stats["backpressure"] == 4, "it: should slow sampling when the queue is full"
+
+    # describe: messages are sent
+    assert queue.get()[0] == PRIORITY_STATUS, "it: should send the most urgent message first"
+    assert queue.get()[0] == PRIORITY_STATUS
+    assert queue.get()[0] == PRIORITY_HEARTBEAT
+
+    # describe: message is modified after it was queued
+    msg = values_msg(1)
+    queue.put("server", msg)
+    msg["values"][0]["value"] = 2
+    assert queue.get()[1].msg["values"][0]["value"] == 1, "it: should queue a copy of the message"
+
+def test_requeue():
+    queue = SendQueue(lambda server, msg: True, max_size=2, rate=1000, burst=1000)
+    queue.put("server", {"parent": "a", "status": {"state": "error"}})
+    queue.put("server", values_msg(1))
+    priority, item = queue.get()
+    assert priority == PRIORITY_STATUS
+    queue.put("server", values_msg(2))
+
+    # describe: urgent message fails to send, and the queue is full
+    queue.requeue(priority, item)
+    assert queue.queues[PRIORITY_STATUS][0] is item, "it: should keep the urgent message"
+    assert [i.msg["values"][0]["value"] for i in queue.queues[PRIORITY_VALUES]] == [2], "it: should drop the oldest routine values"
+
+    # describe: no queued message is less urgent
+    queue.put("server", {"parent": "b", "status": {"state": "error"}})
+    priority, item = queue.get()
+    queue.put("server", {"parent": "c", "status": {"state": "error"}})
+    queue.requeue(priority, item)
+    assert [i.msg["parent"] for i in queue.queues[PRIORITY_STATUS]] == ["b", "c"], "it: should drop the failed message, as it is the oldest"
+    assert queue.get_stats()["classes"]["status"]["dropped"] == 1
+
+def test_send_queue_retry():
+    sent = []
+    upstream = {"up": False}
+
+    def send(server, msg):
+        if upstream["up"]:
+            sent.append(msg)
+        return upstream["up"]
+
+    queue = SendQueue(send, rate=1000, burst=1000)
+    queue.start()
+    queue.put("server", values_msg(1))
+    deadline = time.monotonic() + 5
+    while queue.failed < 1 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert queue.get_stats()["retry_in"] > 0, "it: should back off after a failure"
+
+    # describe: upstream recovers
+    upstream["up"] = True
+    queue.retry_at = 0
+    with queue.cond:
+        queue.cond.notify()
+    queue.stop()
+    assert sent == [values_msg(1)], "it: should retry the message"
+    assert queue.get_stats()["classes"]["values"]["sent"] == 1
+
+def test_queue_endpoint():
+    def get(send_queue):
+        request = Mock(app=Mock(state=Mock(queue=send_queue)))
+        return asyncio.run(cli.queue(request))
+
+    assert get(None).status_code == 404
+    assert get(SendQueue(lambda server, msg: True))["size"] == 0
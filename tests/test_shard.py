@@ -0,0 +1,90 @@
+from .context import ays_agent
+
+import multiprocessing
+import os
+import pytest
+import signal
+import time
+
+from ays_agent import AgentException
+from ays_agent.shard import HashRing, ShardedMonitor
+
+class PidMonitor(object):
+    """ Reports the process each target was collected in.
+
+    The first shard's worker crashes while the file at `CRASH_PATH` exists.
+    """
+
+    def __init__(self, targets):
+        self.targets = targets
+        self.timeout = 2
+
+    def start(self):
+        pass
+
+    def get_values(self, delay):
+        if multiprocessing.current_process().name == "ays-shard-0" and os.path.exists(os.environ.get("CRASH_PATH", "")):
+            os._exit(1)
+        return [{"name": t, "value": os.getpid()} for t in self.targets]
+
+def test_hash_ring():
+    keys = [f"https://host-{i}.example.com/health" for i in range(1000)]
+    ring = HashRing(range(4))
+    parts = ring.partition(keys)
+    assert sorted(k for part in parts.values() for k in part) == sorted(keys), "it: should assign every key to a shard"
+    assert all(150 <= len(part) <= 350 for part in parts.values()), "it: should spread keys evenly"
+    assert HashRing(range(4)).get_shard(keys[0]) == ring.get_shard(keys[0]), "it: should assign keys the same way every time"
+
+    # describe: remove a shard
+    ring.remove(2)
+    assert len(ring) == 3
+    moved = [k for k in keys if ring.get_shard(k) != next(s for s, part in parts.items() if k in part)]
+    assert sorted(moved) == sorted(parts[2]), "it: should only move the keys of the removed shard"
+
+    with pytest.raises(AgentException):
+        HashRing().get_shard("key")
+
+def test_sharded_monitor(tmp_path, monkeypatch):
+    crash_path = tmp_path / "crash"
+    # Inherited by the workers
+    monkeypatch.setenv("CRASH_PATH", str(crash_path))
+    targets = [f"target-{i}" for i in range(20)]
+    with pytest.raises(AgentException):
+        ShardedMonitor(PidMonitor, targets, 0)
+
+    monitor = ShardedMonitor(PidMonitor, targets, 2, max_failures=2, cooldown=60)
+    monitor.start()
+    try:
+        values = monitor.get_values(0)
+        assert sorted(v["name"] for v in values) == sorted(targets)
+        pids = {v["value"] for v in values}
+        assert len(pids) == 2 and os.getpid() not in pids, "it: should collect targets in worker processes"
+
+        # describe: worker crashes
+        crashed = monitor.shards[0]
+        os.kill(crashed.process.pid, signal.SIGKILL)
+        crashed.process.join()
+        values = monitor.get_values(0)
+        assert sorted(v["name"] for v in values) == sorted(targets), "it: should restart the worker"
+        assert not any(v.get("stale") for v in values)
+
+        # describe: worker crashes repeatedly
+        crash_path.touch()
+        values = monitor.get_values(0)
+        assert sorted(v["name"] for v in values) == sorted(targets)
+        assert any(v.get("stale") for v in values), "it: should report the last known values of a crashed worker"
+        assert crashed.active
+        monitor.get_values(0)
+        assert not crashed.active, "it: should retire the worker"
+        values = monitor.get_values(0)
+        assert sorted(v["name"] for v in values) == sorted(targets), "it: should move its targets to the other workers"
+        assert len({v["value"] for v in values}) == 1
+
+        # describe: retired worker cools down
+        crash_path.unlink()
+        monitor.supervise(time.monotonic() + 60)
+        assert crashed.active, "it: should restore the worker"
+        assert len({v["value"] for v in monitor.get_values(0)}) == 2
+    finally:
+        monitor.stop()
+    assert all(shard.process is None for shard in monitor.shards), "it: should stop all workers"
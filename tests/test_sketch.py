@@ -0,0 +1,75 @@
+from .context import ays_agent
+
+import json
+import pytest
+import random
+
+from ays_agent import AgentException
+from ays_agent.sketch import DDSketch, get_distribution_values, merge_values, parse_quantiles
+
+def test_sketch_accuracy():
+    random.seed(1)
+    samples = [random.lognormvariate(3, 1.5) for _ in range(10000)]
+    sketch = DDSketch(alpha=0.01)
+    for v in samples:
+        sketch.add(v)
+    samples.sort()
+    for q in (0.01, 0.5, 0.9, 0.99, 0.999):
+        expected = samples[int(q * (len(samples) - 1))]
+        assert abs(sketch.get_quantile(q) - expected) <= expected * 0.01, f"it: should estimate p{q * 100:g} within the relative error"
+    assert sketch.get_quantile(0) == samples[0]
+    assert sketch.get_quantile(1) == samples[-1]
+    assert len(sketch.positive) < 1000, "it: should use memory that depends on the range of the values"
+
+    # describe: values are negative, or zero
+    sketch = DDSketch()
+    for v in (-10, -1, 0, 0, 1, 10):
+        sketch.add(v)
+    assert sketch.get_quantile(0) == -10
+    assert sketch.get_quantile(0.5) == 0
+
+    # describe: sketch has too many buckets
+    sketch = DDSketch(max_buckets=10)
+    for i in range(1, 1000):
+        sketch.add(i)
+    assert len(sketch.positive) == 10
+    assert abs(sketch.get_quantile(0.99) - 989) < 10, "it: should only lose accuracy of the lowest quantiles"
+
+def test_sketch_merge():
+    a, b, both = DDSketch(), DDSketch(), DDSketch()
+    for i in range(1, 1001):
+        (a if i % 3 else b).add(i)
+        both.add(i)
+    a.merge(DDSketch.from_dict(json.loads(json.dumps(b.to_dict()))))
+    assert a.to_dict() == both.to_dict(), "it: should be the same as a sketch of all values"
+
+    # describe: sketches have different accuracies
+    with pytest.raises(AgentException):
+        a.merge(DDSketch(alpha=0.05))
+
+    # describe: sketch is invalid
+    with pytest.raises(AgentException):
+        DDSketch.from_dict({"alpha": 0.01})
+
+def test_merge_values():
+    def values(samples):
+        sketch = DDSketch()
+        for v in samples:
+            sketch.add(v)
+        return get_distribution_values("latency", sketch, [50, 99.9]) + [{"name": "CPU", "value": len(samples)}]
+
+    merged = merge_values(values([1] * 10), values([100] * 30))
+    by_name = {v["name"]: v["value"] for v in merged}
+    assert by_name["latency"] == 40, "it: should merge the distributions"
+    assert by_name["latency min"] == 1
+    assert by_name["latency mean"] == pytest.approx(75.25)
+    assert abs(by_name["latency p50"] - 100) <= 1, "it: should recompute the quantiles"
+    assert "latency p99.9" in by_name
+    assert by_name["CPU"] == 30, "it: should replace other values"
+
+def test_parse_quantiles():
+    assert parse_quantiles("50, 99.9") == [50, 99.9]
+    with pytest.raises(AgentException):
+        parse_quantiles("50,p99")
+    with pytest.raises(AgentException):
+        parse_quantiles("101")
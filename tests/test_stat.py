@@ -0,0 +1,488 @@
+from .context import ays_agent
+
+import collections
+import os
+import psutil
+import pytest
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from unittest.mock import Mock, patch
+
+from ays_agent import AgentException
+from ays_agent.stat.cgroup import CgroupMonitor
+from ays_agent.stat.counter import Counter, CounterStore
+from ays_agent.stat.directory import DirectoryMonitor
+from ays_agent.stat.disk import DiskMonitor, MountTable, parse_mountinfo
+from ays_agent.stat.log import LogMatcher, LogMonitor, parse_pattern
+from ays_agent.stat.pressure import PressureMonitor, parse_trigger
+from ays_agent.stat.process import ProcessMonitor
+from ays_agent.stat.statsd import Aggregates, StatsdMonitor
+from ays_agent.stat.tcp import SocketMonitor, SocketTable
+
+def test_process_monitor():
+    busy = subprocess.Popen([sys.executable, "-c", "while True: pass"])
+    try:
+        monitor = ProcessMonitor(top=3)
+        monitor.start()
+        time.sleep(0.5)
+        stats = monitor.get_stats()
+        assert len(stats) <= 3, "it: should report at most the top N processes"
+        assert busy.pid in [pid for pid, _, _, _ in stats], "it: should report the busiest process"
+        assert busy.pid in monitor.samples, "it: should cache the process handle"
+
+        values = monitor.get_values(1)
+        assert len(values) == len(stats) * 2
+        assert values[0]["name"] == "Top1 CPU %", "it: should name values by rank, so that restarts do not create new values"
+        assert values[1]["name"] == "Top1 RSS MB"
+    finally:
+        busy.kill()
+        busy.wait()
+
+    # describe: a top process exits
+    monitor.get_stats()
+    assert busy.pid not in monitor.samples, "it: should drop the dead process"
+
+def test_process_monitor_window():
+    # describe: more processes than may be scanned per tick
+    monitor = ProcessMonitor(top=1, max_scan=1)
+    monitor.start()
+    for _ in range(3):
+        monitor.get_stats()
+    # One window for `start` and one for each tick
+    assert monitor.cursor == 4
+    assert len(monitor.samples) <= 4, "it: should only scan a window of processes per tick"
+
+def write_cgroup(path, usage_usec, memory_current, rbytes, wbytes, pids, memory_max="max", cpu_max="max 100000"):
+    os.makedirs(path, exist_ok=True)
+    files = {
+        "cpu.stat": f"usage_usec {usage_usec}\nuser_usec 0\nsystem_usec 0\n",
+        "cpu.max": f"{cpu_max}\n",
+        "memory.current": f"{memory_current}\n",
+        "memory.max": f"{memory_max}\n",
+        "io.stat": f"8:0 rbytes={rbytes} wbytes={wbytes} rios=1 wios=1 dbytes=0 dios=0\n8:16 rbytes={rbytes} wbytes=0 rios=1 wios=0 dbytes=0 dios=0\n",
+        "pids.current": f"{pids}\n"
+    }
+    for name, data in files.items():
+        # Write in place. The monitor keeps its file handles open.
+        with open(os.path.join(path, name), "r+" if os.path.exists(os.path.join(path, name)) else "w") as fh:
+            fh.write(data)
+            fh.truncate()
+
+def test_cgroup_monitor(tmp_path):
+    root = tmp_path / "cgroup"
+    proc_cgroup = tmp_path / "self-cgroup"
+    proc_cgroup.write_text("0::/agent.slice/agent.service\n")
+    path = root / "agent.slice" / "agent.service"
+    write_cgroup(path, 0, 1024 * 1024, 0, 0, 3, memory_max=4 * 1024 * 1024, cpu_max="200000 100000")
+
+    # describe: monitor the agent's own cgroup
+    monitor = CgroupMonitor(root=str(root), proc_cgroup=str(proc_cgroup))
+    with patch("time.monotonic", return_value=100.0):
+        monitor.start()
+    assert [c.path for c in monitor.cgroups] == ["/agent.slice/agent.service"], "it: should find the agent's cgroup"
+    handles = dict(monitor.cgroups[0].fds)
+
+    write_cgroup(path, 1000000, 2 * 1024 * 1024, 1024 * 1024, 2 * 1024 * 1024, 5, memory_max=4 * 1024 * 1024, cpu_max="200000 100000")
+    with patch("time.monotonic", return_value=101.0):
+        values = {v["name"]: v["value"] for v in monitor.get_values(1)}
+    assert monitor.cgroups[0].fds == handles, "it: should re-use open file handles"
+    assert values["Container RAM %"] == 50
+    assert values["Container RAM MB"] == 2
+    assert values["Container PIDs"] == 5
+    # 1s of CPU time, over 1s, with a quota of 2 CPUs
+    assert values["Container CPU %"] == 50
+    # it: should sum the bytes of all devices
+    assert values["Container Disk R/s"] == 2
+    assert values["Container Disk W/s"] == 2
+
+    # describe: monitor is stopped
+    monitor.stop()
+    for fd in handles.values():
+        with pytest.raises(OSError):
+            os.fstat(fd)
+    assert monitor.cgroups == [], "it: should close the cgroup's files"
+
+    # describe: monitor a list of cgroups; controllers are not enabled
+    other = root / "other.slice"
+    os.makedirs(other)
+    (other / "memory.current").write_text("0\n")
+    monitor = CgroupMonitor(["/agent.slice/agent.service", "/other.slice"], root=str(root))
+    monitor.start()
+    names = [v["name"] for v in monitor.get_values(1)]
+    assert "/agent.slice/agent.service PIDs" in names
+    assert [n for n in names if n.startswith("/other.slice")] == ["/other.slice RAM %", "/other.slice RAM MB"], "it: should only report available stats"
+
+    # describe: not a cgroup v2 system
+    proc_cgroup.write_text("12:memory:/agent\n")
+    monitor = CgroupMonitor(root=str(root), proc_cgroup=str(proc_cgroup))
+    monitor.start()
+    assert monitor.get_values(1) == [], "it: should not report any values"
+
+def write_pressure(path, some_total, full_total=None):
+    data = f"some avg10=1.50 avg60=0.75 avg300=0.10 total={some_total}\n"
+    if full_total is not None:
+        data += f"full avg10=0.50 avg60=0.25 avg300=0.00 total={full_total}\n"
+    path.write_text(data)
+
+def test_pressure_monitor(tmp_path):
+    write_pressure(tmp_path / "cpu", 1000)
+    write_pressure(tmp_path / "memory", 5000, 2000)
+
+    # describe: io pressure is not available
+    monitor = PressureMonitor(root=str(tmp_path))
+    monitor.start()
+    write_pressure(tmp_path / "cpu", 11000)
+    write_pressure(tmp_path / "memory", 5000, 4500)
+    values = {v["name"]: v["value"] for v in monitor.get_values(1)}
+    assert values == {
+        "PSI CPU some avg10": 1.5,
+        "PSI CPU some avg60": 0.75,
+        "PSI CPU some stall ms": 10,
+        "PSI RAM some avg10": 1.5,
+        "PSI RAM some avg60": 0.75,
+        "PSI RAM some stall ms": 0,
+        "PSI RAM full avg10": 0.5,
+        "PSI RAM full avg60": 0.25,
+        "PSI RAM full stall ms": 2.5
+    }, "it: should report averages and stall time since the last tick"
+    assert monitor.wait(0) == [], "it: should not wait when there are no triggers"
+
+def test_pressure_trigger():
+    trigger = parse_trigger("memory:some:150000:1000000")
+    assert (trigger.resource, trigger.kind, trigger.stall, trigger.window) == ("memory", "some", 150000, 1000000)
+
+    with pytest.raises(AgentException, match=r"^Invalid pressure resource \(disk\)"):
+        parse_trigger("disk:some:150000:1000000")
+    with pytest.raises(AgentException, match=r"^Invalid pressure kind \(most\)"):
+        parse_trigger("io:most:150000:1000000")
+    with pytest.raises(AgentException, match=r"^Pressure trigger window \(100\) must be between"):
+        parse_trigger("io:full:50:100")
+    with pytest.raises(AgentException, match=r"^Pressure trigger stall \(2000000\) must be greater than zero"):
+        parse_trigger("io:full:2000000:1000000")
+    with pytest.raises(AgentException, match=r"^Invalid pressure trigger \(io:full\)"):
+        parse_trigger("io:full")
+
+def test_pressure_trigger_unsupported(tmp_path, caplog):
+    write_pressure(tmp_path / "memory", 5000, 2000)
+    trigger = parse_trigger("memory:some:150000:1000000")
+    monitor = PressureMonitor([trigger], root=str(tmp_path))
+    with patch("os.write", side_effect=PermissionError(1, "Operation not permitted")):
+        monitor.start()
+    assert "Failed to register pressure trigger (memory:some:150000:1000000)" in caplog.text, "it: should not fail to start"
+    assert trigger.fd is None, "it: should close the trigger's file"
+    assert monitor.poller is None and monitor.wait(0) == [], "it: should fall back to polling"
+    assert [v["name"] for v in monitor.get_values(1)][0] == "PSI RAM some avg10"
+
+MOUNTINFO = """23 28 0:22 / /proc rw,relatime - proc proc rw
+26 25 0:24 / /dev/shm rw,relatime - tmpfs tmpfs rw,size=6147400k
+28 1 254:0 / / rw,relatime shared:1 - ext4 /dev/vda rw
+29 28 254:16 / /data/my\\040disk rw,relatime shared:2 master:1 - xfs /dev/vdb rw
+30 28 254:0 /home /srv/home rw,relatime - ext4 /dev/vda rw
+31 28 0:40 / /mnt/nfs rw,relatime - nfs4 server:/export rw
+"""
+
+def test_parse_mountinfo():
+    assert parse_mountinfo(MOUNTINFO) == [
+        ("/", "ext4", "/dev/vda"),
+        ("/data/my disk", "xfs", "/dev/vdb"),
+        ("/mnt/nfs", "nfs4", "server:/export")
+    ], "it: should ignore pseudo filesystems and bind mounts"
+
+def test_mount_table(tmp_path):
+    path = tmp_path / "mountinfo"
+    path.write_text(MOUNTINFO)
+    table = MountTable(str(path))
+    assert len(table.get_mounts()) == 3
+
+    # describe: mount table has not changed
+    path.write_text("")
+    assert len(table.get_mounts()) == 3, "it: should cache the mount table"
+
+    # describe: kernel signals that the mount table changed
+    table.poller = Mock(poll=Mock(return_value=[(table.fd, 0)]))
+    assert table.get_mounts() == [], "it: should re-read the mount table"
+
+    # describe: monitor is stopped
+    monitor = DiskMonitor()
+    monitor.mount_table = table
+    fd = table.fd
+    monitor.stop()
+    with pytest.raises(OSError):
+        os.fstat(fd)
+    assert monitor.mount_table is None, "it: should close the mount table"
+
+def test_disk_monitor_mounts(tmp_path):
+    path = tmp_path / "mountinfo"
+    path.write_text(MOUNTINFO)
+    monitor = DiskMonitor(mounts=["/", "/data*", "/mnt/*"], mount_timeout=0.1)
+    monitor.mount_table = MountTable(str(path))
+    hung = threading.Event()
+
+    def disk_usage(mountpoint):
+        if mountpoint == "/mnt/nfs":
+            hung.wait()
+        return psutil._common.sdiskusage(100, 25, 75, 25.0)
+
+    with patch("psutil.disk_usage", disk_usage):
+        # describe: a mount hangs
+        stats = monitor.get_mount_stats()
+        assert stats == [
+            ("/", 100, 25, 25.0),
+            ("/data/my disk", 100, 25, 25.0)
+        ], "it: should skip the hung mount"
+        hung_request = monitor.pending["/mnt/nfs"]
+        monitor.get_mount_stats()
+        assert monitor.pending["/mnt/nfs"] is hung_request, "it: should not request the hung mount again"
+
+        # describe: a mount is added
+        path.write_text(MOUNTINFO + "32 28 254:32 / /data2 rw,relatime - ext4 /dev/vdc rw\n")
+        monitor.mount_table.poller = Mock(poll=Mock(return_value=[(monitor.mount_table.fd, 0)]))
+        stats = monitor.get_mount_stats()
+        assert [mountpoint for mountpoint, _, _, _ in stats] == ["/", "/data/my disk", "/data2"]
+        assert len(monitor.pool.threads) == 4, "it: should add a worker for the new mount"
+
+        # describe: hung mount recovers
+        hung.set()
+        hung_request.result()
+        stats = monitor.get_mount_stats()
+        assert [mountpoint for mountpoint, _, _, _ in stats] == ["/", "/data/my disk", "/mnt/nfs", "/data2"]
+
+def test_counter():
+    counter = Counter("test")
+    with patch("time.monotonic", return_value=100.0):
+        counter.start(1000)
+    # describe: tick is late
+    with patch("time.monotonic", return_value=112.5):
+        assert counter.update(2000) == 80, "it: should use the elapsed time"
+    # describe: counter is reset
+    with patch("time.monotonic", return_value=127.5):
+        assert counter.update(500) == 0, "it: should not report a negative rate"
+    with patch("time.monotonic", return_value=137.5):
+        assert counter.update(1500) == 100
+
+def test_counter_store(tmp_path):
+    path = str(tmp_path / "state")
+    store = CounterStore(path, boot_time=1000)
+    counter = Counter("net.bytes_sent", store)
+    with patch("time.monotonic", return_value=50.0), patch("time.time", return_value=5000.0):
+        counter.start(100)
+    with patch("time.monotonic", return_value=60.0), patch("time.time", return_value=5010.0):
+        counter.update(200)
+    store.close()
+
+    # describe: agent restarts
+    store = CounterStore(path, boot_time=1000)
+    assert store.get("net.bytes_sent") == (200, 5010.0), "it: should persist the last value"
+    counter = Counter("net.bytes_sent", store)
+    with patch("time.monotonic", return_value=5.0), patch("time.time", return_value=5030.0):
+        counter.start(300)
+    with patch("time.monotonic", return_value=15.0), patch("time.time", return_value=5040.0):
+        assert counter.update(700) == 500 / 30, "it: should use the persisted value as the baseline"
+    store.close()
+
+    # describe: system reboots
+    store = CounterStore(path, boot_time=9000)
+    assert store.get("net.bytes_sent") is None, "it: should discard persisted values"
+    store.close()
+
+def test_log_matcher():
+    matcher = LogMatcher([parse_pattern("errors=ERROR|FATAL"), parse_pattern("5xx=\" 5\\d\\d ")])
+    counts = [0, 0]
+    matcher.count(b"INFO ok\nERROR \"GET /\" 500 \nFATAL crash\nGET \" 503 \nERROR ERROR\n", counts)
+    assert counts == [3, 2], "it: should count the lines that match each pattern"
+
+    # describe: single pattern
+    matcher = LogMatcher([parse_pattern("errors=^ERROR")])
+    counts = [0]
+    matcher.count(b"ERROR a\nINFO ERROR\nERROR b", counts)
+    assert counts == [2], "it: should match patterns against each line"
+
+    with pytest.raises(AgentException):
+        parse_pattern("ERROR")
+    with pytest.raises(AgentException):
+        parse_pattern("errors=(")
+
+def test_log_monitor(tmp_path):
+    path = str(tmp_path / "app.log")
+    with open(path, "w") as fh:
+        fh.write("ERROR before start\n")
+    monitor = LogMonitor([path, str(tmp_path / "missing.log")], [parse_pattern("errors=ERROR")])
+    monitor.start()
+
+    def write(data, mode="a"):
+        with open(path, mode) as fh:
+            fh.write(data)
+
+    # describe: lines are appended
+    write("ERROR one\nINFO two\nERROR thr")
+    counts, _ = monitor.get_stats()
+    assert counts == [1], "it: should only count complete lines written after the monitor started"
+    write("ee\n")
+    assert monitor.get_stats()[0] == [1], "it: should count a line once it is complete"
+    assert monitor.get_stats()[0] == [0], "it: should not read old data"
+
+    # describe: file is rotated
+    write("ERROR written before rotation\n")
+    os.rename(path, path + ".1")
+    write("ERROR new file\n", "w")
+    assert monitor.get_stats()[0] == [2], "it: should read the rest of the rotated file, and the new file"
+
+    # describe: file is truncated
+    write("ERROR\n", "w")
+    assert monitor.get_stats()[0] == [1]
+
+    # describe: file is created after the monitor started
+    with open(str(tmp_path / "missing.log"), "w") as fh:
+        fh.write("ERROR\nERROR\n")
+    values = monitor.get_values(0)
+    assert values[0] == {"name": "Log errors", "value": 2}
+    assert values[1]["name"] == "Log errors/sec"
+    monitor.stop()
+
+TCP_HEADER = "  sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode\n"
+
+def tcp_entry(index, port, state, rx_queue=0, local="0100007F"):
+    return f"{index:4d}: {local}:{port:04X} 0100007F:C350 {state} 00000000:{rx_queue:08X} 00:00000000 00000000     0        0 1 1 0000000000000000 100 0 0 10 0\n"
+
+def test_socket_monitor(tmp_path):
+    with open(tmp_path / "tcp", "w") as fh:
+        fh.write(TCP_HEADER)
+        fh.write(tcp_entry(0, 80, "0A", rx_queue=3))
+        fh.write(tcp_entry(1, 8080, "0A"))
+        for i in range(2, 12):
+            fh.write(tcp_entry(i, 80, "01"))
+        fh.write(tcp_entry(12, 80, "08"))
+        fh.write(tcp_entry(13, 40000, "06"))
+    with open(tmp_path / "tcp6", "w") as fh:
+        fh.write(TCP_HEADER)
+        fh.write(tcp_entry(0, 80, "0A", rx_queue=1, local="00000000000000000000000000000000"))
+        fh.write(tcp_entry(1, 80, "01", local="0000000000000000FFFF00000100007F"))
+    with open(tmp_path / "netstat", "w") as fh:
+        fh.write("TcpExt: SyncookiesSent ListenOverflows ListenDrops\nTcpExt: 0 5 5\n")
+    monitor = SocketMonitor(root=str(tmp_path))
+    monitor.start()
+    with open(tmp_path / "netstat", "w") as fh:
+        fh.write("TcpExt: SyncookiesSent ListenOverflows ListenDrops\nTcpExt: 0 7 7\n")
+
+    values = {v["name"]: v["value"] for v in monitor.get_values(0)}
+    assert values["Sockets ESTABLISHED"] == 11
+    assert values["Sockets TIME_WAIT"] == 1
+    assert values["Sockets CLOSE_WAIT"] == 1
+    assert values["Listen Overflows"] == 2, "it: should report overflows since the last report"
+    assert values["Sockets ESTABLISHED (:80)"] == 11, "it: should count sockets of both IPv4 and IPv6"
+    assert values["Sockets CLOSE_WAIT (:80)"] == 1
+    assert values["Listen Queue (:80)"] == 4
+    assert values["Sockets ESTABLISHED (:8080)"] == 0
+    assert "Sockets TIME_WAIT (:40000)" not in values, "it: should only report listening ports"
+
+    # describe: ports are provided
+    monitor = SocketMonitor(ports=[8080], root=str(tmp_path))
+    names = [v["name"] for v in monitor.get_values(0)]
+    assert "Listen Queue (:8080)" in names and "Listen Queue (:80)" not in names
+
+    # describe: lines span multiple reads
+    sockets = collections.Counter()
+    SocketTable(buffer_size=200).read(str(tmp_path / "tcp"), sockets)
+    assert sockets[(b"0050", b"01", b"00000000")] == 10
+
+def test_statsd_aggregates():
+    aggregates = Aggregates({})
+    aggregates.add(b"hits:1|c\nhits:2|c|@0.5\nlatency:10|ms\nlatency:30|ms|#env:prod\n\nusers:a|s\nusers:b|s\nusers:a|s")
+    aggregates.add(b"queue:5|g\nqueue:+2|g\nqueue:-1|g\nbad line\nbad:x|c")
+    assert aggregates.counters == {b"hits": 5}, "it: should scale sampled counters by their rate"
+    assert aggregates.gauges == {b"queue": 6}, "it: should apply relative gauge changes"
+    assert aggregates.timers[b"latency"].count == 2
+    assert aggregates.timers[b"latency"].sum == 40
+    assert aggregates.sets == {b"users": {b"a", b"b"}}
+    assert aggregates.invalid == 2, "it: should count invalid lines, but not blank lines"
+
+def test_statsd_monitor(tmp_path):
+    path = str(tmp_path / "statsd.sock")
+    monitor = StatsdMonitor(["udp://127.0.0.1:0", f"unix://{path}"])
+    monitor.start()
+    port = monitor.sockets[0].getsockname()[1]
+    udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    unix = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    for i in range(100):
+        udp.sendto(f"latency:{i}|ms".encode(), ("127.0.0.1", port))
+    unix.sendto(b"hits:1|c\nhits:1|c\nqueue:3|g\n", path)
+    udp.close()
+    unix.close()
+    # Wait for the listener to receive the packets
+    deadline = time.monotonic() + 5
+    while monitor.aggregates.packets < 101 and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    # describe: metrics were received
+    values = {v["name"]: v["value"] for v in monitor.get_values(0)}
+    assert values["StatsD Packets"] == 101
+    assert values["hits"] == 2
+    assert values["queue"] == 3
+    assert values["latency"] == 100, "it: should report the number of timer values"
+    assert abs(values["latency p50"] - 49) <= 0.49, "it: should estimate quantiles within 1%"
+    assert abs(values["latency p99"] - 98) <= 0.98
+    assert values["latency max"] == 99
+
+    # describe: no metrics were received since the last report
+    values = {v["name"]: v["value"] for v in monitor.get_values(0)}
+    assert values["queue"] == 3, "it: should report the last value of a gauge"
+    assert "hits" not in values, "it: should reset counters each interval"
+    monitor.stop()
+    assert not os.path.exists(path), "it: should remove the unix socket"
+
+    # describe: address is invalid
+    with pytest.raises(AgentException):
+        StatsdMonitor(["tcp://127.0.0.1:8125"])
+
+@pytest.mark.parametrize("watch", [False, True])
+def test_directory_monitor(tmp_path, watch):
+    with pytest.raises(AgentException):
+        DirectoryMonitor([])
+
+    spool = tmp_path / "spool"
+    (spool / "a" / "b").mkdir(parents=True)
+    (spool / "one").write_bytes(b"x" * 100)
+    (spool / "a" / "two").write_bytes(b"x" * 200)
+    (spool / "a" / "b" / "three").write_bytes(b"x" * 300)
+    now = time.time()
+    os.utime(spool / "a" / "b" / "three", (now - 600, now - 600))
+    missing = str(tmp_path / "missing")
+
+    monitor = DirectoryMonitor([str(spool), missing], watch=watch)
+    monitor.start()
+    assert (monitor.inotify is not None) == (watch and sys.platform.startswith("linux"))
+    values = {v["name"]: v["value"] for v in monitor.get_values(0)}
+    assert values[f"Dir Bytes ({spool})"] == 600, "it: should total the size of all files in the tree"
+    assert values[f"Dir Files ({spool})"] == 3
+    assert 600 <= values[f"Dir Oldest File Age ({spool})"] < 610, "it: should report the age of the oldest file"
+    assert values[f"Dir Files ({missing})"] == 0, "it: should report an empty directory if it does not exist"
+
+    # describe: a file is added to a subdirectory
+    (spool / "a" / "b" / "four").write_bytes(b"x" * 400)
+    stats = monitor.get_stats()
+    assert stats[0][1:3] == (1000, 4), "it: should rescan the subdirectory that changed"
+
+    # describe: a subdirectory is removed
+    (spool / "a" / "b" / "three").unlink()
+    (spool / "a" / "b" / "four").unlink()
+    (spool / "a" / "b").rmdir()
+    stats = monitor.get_stats()
+    assert stats[0][1:3] == (300, 2), "it: should drop the removed subdirectory"
+    assert stats[0][3] < 600
+
+    # describe: nothing changed
+    for path in [spool, spool / "a"]:
+        os.utime(path, (now - 60, now - 60))
+    monitor.get_stats()
+    with patch("os.scandir", side_effect=AssertionError("scanned")):
+        assert monitor.get_stats()[0][1:3] == (300, 2), "it: should not scan directories that did not change"
+
+    # describe: the directory is created
+    os.mkdir(missing)
+    (tmp_path / "missing" / "five").write_bytes(b"x" * 500)
+    assert monitor.get_stats()[1][1:3] == (500, 1)
+    monitor.stop()
@@ -0,0 +1,77 @@
+from .context import ays_agent
+
+import asyncio
+import json
+import os
+
+from unittest.mock import Mock
+
+from ays_agent import cli
+from ays_agent.store import RAW_SLOTS, SampleStore
+
+def test_sample_store(tmp_path):
+    path = str(tmp_path / "history")
+    store = SampleStore(path, max_series=2)
+    size = os.path.getsize(path)
+
+    # describe: add samples every 15 seconds for 2 hours
+    start = 1700000400
+    for i in range(2 * 60 * 4):
+        assert store.add("CPU %", i % 4, start + i * 15)
+    end = start + (2 * 60 * 4 - 1) * 15
+
+    raw = store.query("CPU %", end=end)
+    assert len(raw) == 60 * 4 + 1, "it: should only return the last hour of raw samples"
+    assert raw[-1] == {"time": end, "value": 3.0}
+
+    minutes = store.query("CPU %", start=end - 120, end=end, resolution="1m")
+    assert minutes[-1] == {"time": end - 45, "min": 0.0, "max": 3.0, "avg": 1.5, "count": 4}, "it: should rollup samples by minute"
+
+    ten_minutes = store.query("CPU %", end=end, resolution="10m")
+    assert len(ten_minutes) == 12
+    assert ten_minutes[0]["count"] == 40
+
+    # describe: samples exceed the raw ring
+    for i in range(RAW_SLOTS + 10):
+        store.add("RAM %", i, start + i)
+    raw = store.query("RAM %", end=start + RAW_SLOTS + 10)
+    assert len(raw) == RAW_SLOTS, "it: should overwrite the oldest samples"
+    assert raw[0]["value"] == 10
+
+    # describe: store is full
+    assert not store.add("Disk Used %", 1, start), "it: should not add a new series"
+    store.add("Disk Used %", 2, start + 1)
+    assert store.get_dropped() == {"series": 1, "samples": 2}, "it: should count the series, and samples, that were refused"
+    assert store.query("Disk Used %") is None
+    assert os.path.getsize(path) == size, "it: should not grow"
+    store.close()
+
+    # describe: agent restarts
+    store = SampleStore(path, max_series=2)
+    assert store.get_names() == ["CPU %", "RAM %"]
+    assert store.query("CPU %", end=end)[-1] == {"time": end, "value": 3.0}, "it: should load existing samples"
+    store.close()
+
+def test_query_endpoint(tmp_path):
+    store = SampleStore(str(tmp_path / "history"), max_series=2)
+    store.add("CPU %", 50, 1700000000)
+    request = Mock(app=Mock(state=Mock(store=store)))
+
+    def query(**kwargs):
+        resp = asyncio.run(cli.query(request, **kwargs))
+        if hasattr(resp, "status_code"):
+            return resp.status_code, json.loads(resp.body)
+        return 200, resp
+
+    assert query() == (200, {"names": ["CPU %"], "dropped": {"series": 0, "samples": 0}})
+    assert query(name="CPU %", end=1700000001) == (200, {
+        "name": "CPU %",
+        "resolution": "raw",
+        "points": [{"time": 1700000000, "value": 50.0}]
+    })
+    assert query(name="RAM %") == (404, {"error": "Series (RAM %) does not exist"})
+    assert query(name="CPU %", resolution="1h") == (400, {"error": "Invalid resolution (1h). Available options are (raw, 1m, 10m)"})
+
+    # describe: history is not enabled
+    request.app.state.store = None
+    assert query(name="CPU %") == (404, {"error": "History is not enabled"})
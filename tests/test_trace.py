@@ -0,0 +1,90 @@
+from .context import ays_agent
+
+import pytest
+
+from unittest.mock import Mock, patch
+
+from ays_agent import AgentException, CLIOptions, bench, cli
+from ays_agent.agent import Agent
+from ays_agent.anomaly import AnomalyDetector
+from ays_agent.trace import ReplayMonitor, TraceReader, TraceWriter, get_trace_header
+
+def test_trace(tmp_path):
+    path = str(tmp_path / "agent.trace")
+    ticks = [
+        (1000.0, [{"name": "CPU %", "value": 12.5}, {"name": "Processes", "value": 301}]),
+        (1060.0, [{"name": "CPU %", "value": 13.0, "stale": True}, {"name": "latency", "value": 3, "sketch": {"count": 3}}, {"name": "Load", "value": None}])
+    ]
+    writer = TraceWriter(path, {"interval": 60})
+    for now, values in ticks:
+        writer.write(now, values)
+    writer.close()
+
+    # describe: trace is read
+    reader = TraceReader(path)
+    assert reader.header == {"interval": 60}
+    assert list(reader.read()) == ticks, "it: should read the values of each tick"
+    assert isinstance(ticks[0][1][1]["value"], int)
+
+    # describe: last tick was partially written
+    with open(path, "rb") as fh:
+        data = fh.read()
+    with open(path, "wb") as fh:
+        fh.write(data[:-5])
+    assert list(TraceReader(path).read()) == ticks[:1], "it: should end the trace at the partial tick"
+
+    # describe: file is not a trace
+    with open(path, "wb") as fh:
+        fh.write(b"not a trace")
+    with pytest.raises(AgentException):
+        TraceReader(path)
+
+def test_record_and_replay(tmp_path):
+    path = str(tmp_path / "agent.trace")
+    options = CLIOptions(org_secret="aaa", server="", parent="com.unittest.trace", monitor_name="testing", monitor_resources="cpu", interval=60, value_names="CPU %", value_thresholds=">90")
+    config = cli.get_agent_config(options)
+    writer = TraceWriter(path, get_trace_header(config))
+    agent = Agent(config, send=lambda server, msg: True, recorder=writer)
+    values = iter([20, 95, 30])
+    agent.collector.collect = lambda delay: [{"name": "CPU %", "value": next(values)}]
+    for _ in range(3):
+        agent.get_message()
+    writer.close()
+
+    # describe: agent records
+    reader = TraceReader(path)
+    assert "org_secret" not in reader.header["msg"], "it: should not record the org secret"
+    assert [v[0]["value"] for _, v in reader.read()] == [20, 95, 30]
+
+    # describe: trace is replayed
+    monitor = ReplayMonitor(list(reader.read()))
+    replay_config = bench.get_replay_config(reader.header, "http://localhost/agent/", monitor)
+    msg = Agent(replay_config, send=lambda server, msg: True).get_message()
+    assert msg["values"] == [{"name": "CPU %", "value": 20, "threshold": config.thresholds["CPU %"]}], "it: should apply the recorded thresholds"
+
+    sink = Mock()
+    result = bench.replay_trace(path, cli.post_request, repeat=2, sinks=[sink])
+    assert result["ticks"] == 6
+    assert result["recorded"] >= 0
+    assert len(result["timings"]["send"]) == 6
+    assert result["queue"]["classes"]["values"]["sent"] == 4, "it: should send each tick through the send queue"
+    assert result["queue"]["classes"]["status"]["sent"] == 2, "it: should queue breaches as urgent"
+    assert sink.put.call_count == 6, "it: should export each tick to the sinks"
+
+def test_replay_clock(tmp_path):
+    path = str(tmp_path / "agent.trace")
+    writer = TraceWriter(path, {"msg": {"parent": {"property": "path", "value": "com.unittest.trace"}}, "interval": 60, "anomaly_detection": "seasonal"})
+    for i in range(3):
+        writer.write(1000.0 + 60 * i, [{"name": "CPU %", "value": 10}])
+    writer.close()
+
+    times = []
+    update = AnomalyDetector.update
+
+    def record_time(self, values, now):
+        times.append(now)
+        return update(self, values, now)
+
+    with patch.object(AnomalyDetector, "update", record_time):
+        bench.replay_trace(path, lambda server, msg: True, repeat=2)
+    assert times == [1000, 1060, 1120, 1180, 1240, 1300], "it: should run on the recorded time of each tick"
@@ -0,0 +1,125 @@
+from .context import ays_agent
+
+import http.server
+import pytest
+import socket
+import threading
+import time
+
+from ays_agent.transport import EndpointPool, get_endpoint_pool, parse_servers
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    def respond(self):
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        self.server.requests += 1
+        self.send_response(self.server.status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    do_POST = respond
+    do_HEAD = respond
+
+    def log_message(self, *args):
+        pass
+
+def start_server(status=204, delay=0):
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.status = status
+    server.delay = delay
+    server.requests = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/agent/"
+
+def get_closed_url():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return f"http://127.0.0.1:{port}/agent/"
+
+def test_parse_servers():
+    assert parse_servers("https://a/agent/, https://b/agent/,") == ["https://a/agent/", "https://b/agent/"]
+    assert get_endpoint_pool("https://a/agent/,https://b/agent/") is get_endpoint_pool("https://a/agent/,https://b/agent/"), "it: should share the health of endpoints"
+
+def test_failover():
+    server, url = start_server()
+    failing, failing_url = start_server(status=503)
+    pool = EndpointPool([get_closed_url(), failing_url, url], timeout=2, probe_interval=60)
+
+    # describe: preferred endpoints are unavailable
+    resp = pool.send(json={"value": 1})
+    assert resp.status_code == 204, "it: should fail over to the next endpoint"
+    assert server.requests == 1
+    down, erroring, up = pool.endpoints
+    assert down.error_rate > 0 and erroring.error_rate > 0
+
+    # describe: next request
+    failing.requests = 0
+    pool.send(json={"value": 2})
+    assert server.requests == 2 and failing.requests == 0, "it: should send requests to the healthiest endpoint first"
+
+    # describe: endpoints fail repeatedly
+    pool.stop()
+    pool = EndpointPool([failing_url, url], timeout=2, max_failures=2, probe_interval=60)
+    erroring, up = pool.endpoints
+    for _ in range(2):
+        erroring.latency = up.latency = None
+        erroring.error_rate = 0
+        pool.send(json={"value": 3})
+    assert erroring.breaker.is_open(), "it: should remove the endpoint from rotation"
+    assert pool.get_endpoints() == [up]
+    failing.requests = 0
+    erroring.error_rate = 0
+    pool.send(json={"value": 4})
+    assert failing.requests == 0, "it: should not send requests to endpoints out of rotation"
+
+    # describe: endpoint recovers
+    failing.status = 204
+    erroring.breaker.opened_at -= 60
+    assert pool.probe(erroring), "it: should probe the endpoint"
+    assert not erroring.breaker.is_open(), "it: should return the endpoint to rotation"
+    pool.stop()
+
+    # describe: all endpoints are unavailable
+    pool = EndpointPool([get_closed_url()], timeout=2)
+    for _ in range(4):
+        assert pool.send(json={"value": 1}) is None
+    assert len(pool.get_endpoints()) == 1, "it: should still try endpoints out of rotation"
+    server.shutdown()
+    failing.shutdown()
+
+def test_latency_routing():
+    slow, slow_url = start_server(delay=0.2)
+    fast, fast_url = start_server()
+    pool = EndpointPool([slow_url, fast_url], timeout=2)
+    for _ in range(5):
+        assert pool.send(json={}).status_code == 204
+    assert slow.requests == 1 and fast.requests == 4, "it: should route to the endpoint with the lowest latency"
+    assert pool.get_endpoints()[0].url == fast_url
+    slow.shutdown()
+    fast.shutdown()
+
+def test_primary_recovers():
+    primary, primary_url = start_server(status=503)
+    secondary, secondary_url = start_server()
+    pool = EndpointPool([primary_url, secondary_url], timeout=2)
+
+    # describe: primary fails once
+    assert pool.send(json={}).status_code == 204
+    first, second = pool.endpoints
+    assert not first.breaker.is_open()
+    assert pool.get_endpoints()[0] is second, "it: should prefer the healthy endpoint"
+
+    # describe: primary recovers
+    primary.status = 204
+    primary.requests = 0
+    first.updated_at -= 10 * 60
+    # The primary's latency is not known, as it did not respond
+    second.latency = 0.001
+    assert first.get_error_rate() == 0, "it: should decay the error rate of an endpoint that is no longer sent requests"
+    assert pool.send(json={}).status_code == 204
+    assert primary.requests == 1, "it: should prefer the primary again"
+    pool.stop()
+    primary.shutdown()
+    secondary.shutdown()
@@ -0,0 +1,39 @@
+from .context import ays_agent
+
+import os
+import threading
+import time
+
+from ays_agent.watch import FileWatcher, get_inotify
+
+def watch_file(watcher, path):
+    # describe: file is not changed
+    assert not watcher.wait(0.2), "it: should time out"
+
+    # describe: file is written
+    threading.Timer(0.1, lambda: open(path, "w").write("interval: 30\n")).start()
+    assert watcher.wait(5), "it: should detect the change"
+
+    # describe: file is replaced by a rename
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as fh:
+        fh.write("interval: 60\n")
+    threading.Timer(0.1, lambda: os.rename(tmp_path, path)).start()
+    assert watcher.wait(5), "it: should detect the change"
+    assert not watcher.wait(0.2), "it: should not report the same change twice"
+    watcher.close()
+
+def test_file_watcher(tmp_path):
+    path = str(tmp_path / "ays-agent")
+    if get_inotify() is not None:
+        watcher = FileWatcher(path)
+        assert watcher.inotify is not None
+        watch_file(watcher, path)
+
+    # describe: inotify is not available
+    watcher = FileWatcher(path, poll_interval=0.05)
+    # Falls back to polling the modification time
+    watcher.close()
+    # Ensure the modification time changes
+    time.sleep(0.01)
+    watch_file(watcher, path)